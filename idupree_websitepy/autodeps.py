@@ -0,0 +1,252 @@
+"""
+Finds out which files a buildsystem 'do' body actually uses.
+
+While a body runs, a Recorder notes
+  * files it opens for reading and directories it lists
+    (seen through a sys.addaudithook hook),
+  * Python source files whose functions it calls (through sys.setprofile),
+  * the programs and existing files named on the command lines of
+    subprocesses it starts, or, for subprocesses started through
+    check_call() or check_output() when strace is installed, every file
+    they open or stat.
+
+Only the thread running the body is observed.  Files in Python's own
+installation and in /proc, /sys and /dev are ignored, and so are the
+temporary directory and the files in it that no longer exist when the
+body finishes.
+
+DiscoveredDeps keeps what was found for each rule (identified by its
+dests, as in freshness_db) from one run to the next.
+"""
+
+import os, sys, re, codecs, threading, subprocess, tempfile
+from shutil import which
+
+from . import utils
+from .utils import normpath
+
+_format_version = 1
+
+_ignored_prefixes = tuple(sorted({normpath(p) + '/' for p in
+  [sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix,
+   '/proc', '/sys', '/dev']}))
+
+_temp_prefix = normpath(tempfile.gettempdir()) + '/'
+
+def _ignored(path):
+  if path.startswith(_ignored_prefixes) or path.startswith('<'):
+    return True
+  if (path + '/').startswith(_temp_prefix):
+    # Scratch files that are gone again.  (A build, and its sources,
+    # can be in the temporary directory too.)
+    return path + '/' == _temp_prefix or not os.path.lexists(path)
+  return False
+
+_state = threading.local()
+_hook_lock = threading.Lock()
+_hook_installed = False
+
+def _recorders():
+  return getattr(_state, 'recorders', ())
+
+def _abs(path):
+  if isinstance(path, bytes): path = os.fsdecode(path)
+  return normpath(os.path.join(os.getcwd(), path))
+
+def _audit_hook(event, args):
+  recorders = _recorders()
+  if len(recorders) == 0: return
+  if event == 'open':
+    path, mode, flags = args
+    if path == None or isinstance(path, int): return
+    writing = (('w' in mode or 'a' in mode or 'x' in mode or '+' in mode) if mode != None
+               else flags & (os.O_WRONLY | os.O_RDWR) != 0)
+    if writing: return
+    paths = [_abs(path)]
+  elif event in ('os.listdir', 'os.scandir'):
+    path = args[0]
+    if isinstance(path, int): return
+    paths = [_abs(path if path != None else '.')]
+  elif event == 'subprocess.Popen':
+    executable, popen_args, cwd, env = args
+    if isinstance(popen_args, (str, bytes)): popen_args = [popen_args]
+    paths = _command_line_files(list(popen_args), cwd)
+  else:
+    return
+  for recorder in recorders:
+    recorder.add_files(paths)
+
+def _command_line_files(args, cwd = None):
+  """The program and the arguments that name existing files."""
+  result = []
+  if len(args) > 0:
+    program = which(os.fsdecode(args[0]))
+    if program != None: result.append(normpath(os.path.abspath(program)))
+  for arg in args[1:]:
+    arg = os.fsdecode(arg)
+    # (e.g. --template=foo.html)
+    for candidate in [arg] + re.findall(r'=(.+)$', arg):
+      path = normpath(os.path.join(cwd or os.getcwd(), candidate))
+      if os.path.isfile(path):
+        result.append(path)
+  return result
+
+def note_command(args):
+  """
+  Records what running the command args would (its program and the files
+  named on its command line), for work handed to an already running
+  process instead, e.g. by pandoc_pool.
+  """
+  recorders = _recorders()
+  if len(recorders) == 0: return
+  paths = _command_line_files(list(args))
+  for recorder in recorders:
+    recorder.add_files(paths)
+
+def _profile(frame, event, arg):
+  if event == 'call':
+    for recorder in _recorders():
+      if frame.f_code not in recorder.ignore:
+        recorder.code.add(frame.f_code.co_filename)
+
+class Recorder(object):
+  """
+  What one body used: files (absolute paths of data files and
+  directories) and code (Python source files).
+
+  ignore: code objects whose calls don't count, e.g. the generator that
+  yields to the body (resuming a generator counts as calling it).
+  """
+  def __init__(self, ignore = ()):
+    self.files = set()
+    self.code = set()
+    self.ignore = set(ignore) | {Recorder.stop.__code__}
+    self._old_profile = None
+
+  def add_files(self, paths):
+    self.files.update(paths)
+
+  def start(self):
+    """Starts recording what this thread does."""
+    global _hook_installed
+    with _hook_lock:
+      if not _hook_installed:
+        sys.addaudithook(_audit_hook)
+        _hook_installed = True
+    _state.recorders = _recorders() + (self,)
+    self._old_profile = sys.getprofile()
+    sys.setprofile(_profile)
+
+  def stop(self):
+    sys.setprofile(self._old_profile)
+    _state.recorders = tuple(r for r in _recorders() if r is not self)
+
+  def result(self, exclude = ()):
+    """
+    Returns {'files': [...], 'code': [...]}, leaving out paths
+    in exclude (e.g. the rule's own dests and declared sources).
+    """
+    exclude = set(exclude)
+    def keep(path):
+      return path not in exclude and not _ignored(path)
+    return {
+      'files': sorted(filter(keep, self.files)),
+      'code': sorted(filter(keep, (normpath(os.path.abspath(f)) for f in self.code
+                                   if not f.startswith('<')))),
+      }
+
+_strace = None
+def _strace_command():
+  global _strace
+  if _strace == None:
+    _strace = which('strace') or ''
+  return _strace
+
+# e.g. 1234  openat(AT_FDCWD, "/etc/ld.so.cache", O_RDONLY|O_CLOEXEC) = 3
+_strace_line_re = re.compile(
+  r'^(?:\d+\s+)?(\w+)\((?:AT_FDCWD, |\d+, )?"((?:[^"\\]|\\.)*)"(.*)\)\s+= (-?\d+)')
+
+def _strace_files(output, cwd):
+  files = set()
+  for line in output.splitlines():
+    m = _strace_line_re.match(line)
+    if m == None: continue
+    call, path, rest, result = m.groups()
+    if int(result) < 0: continue
+    if call in ('open', 'openat', 'creat') and re.search(r'O_WRONLY|O_RDWR|O_CREAT', rest):
+      continue
+    path = os.fsdecode(codecs.escape_decode(path.encode('utf-8'))[0])
+    files.add(normpath(os.path.join(cwd, path)))
+  return files
+
+def _run(run, args, kwargs):
+  """run(args, **kwargs) (a subprocess function), under strace if recording."""
+  recorders = _recorders()
+  if len(recorders) == 0 or _strace_command() == '' or kwargs.get('shell'):
+    return run(args, **kwargs)
+  cwd = os.path.abspath(kwargs.get('cwd') or os.getcwd())
+  files = set(_command_line_files(list(args), cwd))
+  with tempfile.NamedTemporaryFile('r', suffix = '.strace') as log:
+    # (Not recording strace's own command line, which names the log.)
+    _state.recorders = ()
+    try:
+      result = run(
+        [_strace_command(), '-f', '-qq', '-e', 'trace=%file', '-o', log.name, '--'] + list(args),
+        **kwargs)
+    finally:
+      _state.recorders = recorders
+    files |= _strace_files(log.read(), cwd)
+  for recorder in recorders:
+    recorder.add_files(files)
+  return result
+
+def check_call(args, **kwargs):
+  """
+  subprocess.check_call.  While recording, if strace is installed, it runs
+  the command under strace to record every file that it and its children
+  open or stat.
+  """
+  return _run(subprocess.check_call, args, kwargs)
+
+def check_output(args, **kwargs):
+  """subprocess.check_output, recorded like check_call."""
+  return _run(subprocess.check_output, args, kwargs)
+
+def _rule_key(dests):
+  return '\0'.join(dests)
+
+class DiscoveredDeps(object):
+  def __init__(self, path):
+    """
+    path: the file to keep them in.  It needn't exist yet.
+    """
+    self.path = path
+    old = utils.read_json_or(path, {})
+    if old.get('version') != _format_version:
+      old = {}
+    self._old_rules = old.get('rules', {})
+    self._rules = {}
+    self._lock = threading.Lock()
+
+  def previous(self, dests):
+    """{'files': [...], 'code': [...]} from the last time these dests were built, or None."""
+    return self._old_rules.get(_rule_key(dests))
+
+  def record(self, dests, found):
+    with self._lock:
+      self._rules[_rule_key(dests)] = found
+
+  def carry_forward(self, dests):
+    """Keeps the previous record for dests, which were reused."""
+    old = self.previous(dests)
+    if old != None:
+      self.record(dests, old)
+
+  def count(self):
+    return len(self._rules)
+
+  def save(self):
+    utils.write_json_atomically(self.path, {
+      'version': _format_version,
+      'rules': self._rules,
+      })
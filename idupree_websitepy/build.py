@@ -10,9 +10,15 @@ from . import utils
 from . import errdocs
 from . import urlregexps
 from . import resource_rewriting
+from . import autodeps
+from . import fingerprints
+from . import output_cache
+from . import pandoc_pool
+from . import scss_deps
 from .utils import join, normpath, abspath, relpath
 
-cmd = subprocess.check_call
+# (subprocess.check_call, but visible to discover_build_deps)
+cmd = autodeps.check_call
 
 class SasscDefault: pass
 
@@ -28,7 +34,11 @@ class Config(object):
     site_document_root_relative_to_source_dir = '.',
     pandoc_template_relative_to_source_dir = None,
     pandoc_command = 'pandoc',
+    pandoc_workers = None,
+    pandoc_worker_checks = 4,
     sassc_command = SasscDefault,
+    sass_load_paths_relative_to_source_dir = (),
+    html_filters = None,
     list_of_compilation_source_files,
     canonical_scheme_and_domain = None,
     origins_to_assume_contain_the_resources = None,
@@ -50,7 +60,18 @@ class Config(object):
     # is that this library's Content-Length header code isn't buggy for
     # those things.
     test_all_content_lengths = False,
-    test_status_codes = None
+    test_status_codes = None,
+    content_hash_freshness = False,
+    build_jobs = None,
+    source_staging = 'copy',
+    snapshot_source_dirs = False,
+    build_trace = False,
+    build_rule_log = False,
+    reuse_build_subtrees = False,
+    discover_build_deps = False,
+    build_cache_dir = None,
+    build_cache_max_bytes = 2**30,
+    content_hash_algorithm = 'sha384'
     ):
     """
     os.path.join(site_source_dir, site_document_root_relative_to_source_dir):
@@ -71,6 +92,30 @@ class Config(object):
     pandoc_command: executable to use for pandoc (relevant if you have
       markdown files)
 
+    pandoc_workers: if set, markdown is rendered by up to this many
+      long-lived pandoc processes (needs pandoc 3.1.1 or later) instead
+      of a pandoc per file, which is much faster for many short files.
+      The output is the same; see pandoc_pool.  pandoc_worker_checks:
+      how many files with the same templates, and how many using each
+      markdown feature (math, code, raw HTML, ...), are rendered both
+      ways and compared byte for byte before the workers are trusted
+      with such files (None: every file, keeping the per-file output,
+      e.g. to try a new pandoc version).
+
+    sass_load_paths_relative_to_source_dir: directories that .scss and .sass
+      files can import from (besides their own directory and SASS_PATH),
+      passed to sassc_command as -I.  Stylesheets are recompiled when they
+      or anything they import change; see scss_deps.
+
+    html_filters: what every .html and .md page goes through on its way
+      into the site, in order: functions (html bytes, HtmlPage) -> html
+      bytes.  Defaults to default_html_filters (<!--AUTOHEAD--> and
+      AUTO_OBFUSCATE_*); add site-specific ones with e.g.
+      html_filters = build.default_html_filters + [my_filter].
+      Each page is read and written once however many filters there
+      are.  Their code is part of the pages' build fingerprint (but not
+      the functions they call).
+
     list_of_compilation_source_files: used so the recompilation checker can
       check if your code is doing something different now. Make sure to include
       at least the file you're calling this code from.  For example,
@@ -155,6 +200,53 @@ class Config(object):
         '/some/dir/': 200,
         '/not/a/page': 404
         }
+
+    content_hash_freshness: if True, rebuilds are skipped when sources'
+      contents are unchanged even if their mtimes changed (e.g. after
+      a git checkout).  See buildsystem.run_basic.
+
+    build_jobs: how many build rules (pandoc, gzip, hashing...) to run
+      in parallel.  None (default) runs everything in order.
+
+    source_staging, snapshot_source_dirs: how the build copies
+      site_source_dir into its build directory; see
+      buildsystem.stage_source_tree.  source_staging='reflink' or
+      'hardlink' avoids copying file contents, which helps a lot with
+      big images and videos.
+
+    build_trace: if True, record how long each build rule and phase takes
+      and write a Chrome trace and a summary into build_output_dir.
+      See buildsystem.run_basic.
+
+    build_rule_log: if True, each build records its rules in
+      build_output_dir/rule-log, so that python -m idupree_websitepy.explain
+      can say which rules the next build would rerun and why.
+      See buildsystem.run_basic.
+
+    reuse_build_subtrees: if True, directories of the previous build whose
+      contents are all still up to date are moved into the new build whole
+      instead of file by file, which makes no-op rebuilds much cheaper.
+      See buildsystem.run_basic's reuse_subtrees.
+
+    discover_build_deps: if True, each build rule is watched for which of
+      this library's Python files it actually runs code from (and which
+      files it reads), so that changing one of them only rebuilds the
+      rules that use it.  list_of_compilation_source_files still count
+      for every rule.  See buildsystem.run_basic's discover_deps.
+
+    build_cache_dir: a directory (perhaps shared with other checkouts or
+      machines) in which to keep the outputs of build rules (pandoc,
+      gzip, hashing...) by the contents of their inputs, so that a build
+      that needs the same output again restores it from there instead of
+      rebuilding it.  The least recently used outputs are removed when it
+      gets bigger than build_cache_max_bytes (None: no limit).
+      See buildsystem.run_basic's output_cache.
+
+    content_hash_algorithm: the hash that resource names (see
+      resource_rewriting) and nginx pagecontent paths come from, e.g.
+      'blake2b-256' (see utils.new_hash; python -m
+      idupree_websitepy.hash_benchmark compares them on your files).
+      Changing it renames every resource and pagecontent file.
     """
     assert(not re.search(r'\.\.|^/', site_document_root_relative_to_source_dir))
     if pandoc_template_relative_to_source_dir != None:
@@ -167,6 +259,12 @@ class Config(object):
       self.build_output_dir = buildsystem.default_builds_dir_name(self.site_source_dir)
     self.pandoc_template_relative_to_source_dir = pandoc_template_relative_to_source_dir
     self.pandoc_command = pandoc_command
+    self.pandoc_workers = pandoc_workers
+    self.pandoc_worker_checks = pandoc_worker_checks
+    for p in sass_load_paths_relative_to_source_dir:
+      assert(not re.search(r'\.\.|^/', p))
+    self.sass_load_paths_relative_to_source_dir = list(sass_load_paths_relative_to_source_dir)
+    self.html_filters = list(html_filters if html_filters != None else default_html_filters)
     if sassc_command != SasscDefault:
       self.sassc_command = sassc_command
     elif find_executable('sassc'):
@@ -237,6 +335,19 @@ class Config(object):
     if self.test_status_codes == None:
       self.test_status_codes = {}
 
+    self.content_hash_freshness = content_hash_freshness
+    self.build_jobs = build_jobs
+    self.source_staging = source_staging
+    self.snapshot_source_dirs = snapshot_source_dirs
+    self.build_trace = build_trace
+    self.build_rule_log = build_rule_log
+    self.reuse_build_subtrees = reuse_build_subtrees
+    self.discover_build_deps = discover_build_deps
+    self.build_cache_dir = build_cache_dir
+    self.build_cache_max_bytes = build_cache_max_bytes
+    utils.new_hash(content_hash_algorithm)
+    self.content_hash_algorithm = content_hash_algorithm
+
   def is_fake_rr(self, route):
     return route[:len(self.fake_resource_route)] == self.fake_resource_route
   def fake_rr_to_f(self, route):
@@ -277,17 +388,115 @@ def build(config, pre_action = None):
   pre_action is a function. pre_action(do) happens before other stuff
   but gets to share the build-temp directory...
   """
-  sources = (set(config.list_of_compilation_source_files) |
-             get_python_file_names_under(dirname_of_this_library()))
+  sources = set(config.list_of_compilation_source_files)
+  library_sources = get_python_file_names_under(dirname_of_this_library()) - sources
+  cache = None
+  if config.build_cache_dir != None:
+    cache = output_cache.LocalDirectoryCache(config.build_cache_dir, config.build_cache_max_bytes)
   for do in buildsystem.run(config.site_source_dir, sources,
-                            config.build_output_dir):
+                            config.build_output_dir,
+                            content_hash_freshness = config.content_hash_freshness,
+                            jobs = config.build_jobs,
+                            staging = config.source_staging,
+                            snapshot_source_dirs = config.snapshot_source_dirs,
+                            trace = config.build_trace,
+                            rule_log = config.build_rule_log,
+                            reuse_subtrees = config.reuse_build_subtrees,
+                            discover_deps = config.discover_build_deps,
+                            code_sources = library_sources,
+                            output_cache = cache):
     if pre_action != None:
-      pre_action(do)
+      with do.span('pre_action'):
+        pre_action(do)
+
+    with do.span('custom_site_preprocessing'):
+      route_metadata, rewriter = \
+          custom_site_preprocessing(config, do)
+
+    with do.span('nginx_openresty'):
+      nginx_openresty(config, do, rewriter, route_metadata)
+
+class HtmlPage(object):
+  """
+  What html filters (see Config's html_filters) know about the page
+  they're filtering.
+  file: its path relative to site/, e.g. 'blog/post.html'
+  canonical_url: its canonical URL, or None if there's no
+    canonical_scheme_and_domain
+  """
+  def __init__(self, file, canonical_url = None):
+    self.file = file
+    self.canonical_url = canonical_url
 
-    route_metadata, rewriter = \
-        custom_site_preprocessing(config, do)
+def autohead(html, page):
+  """
+  <!--AUTOHEAD--> --> the page's <link rel="canonical"> and its favicon link,
+  each on a line with the comment's indentation.
+  """
+  #utils.file_re_sub(src, dest, b'{{:canonical}}', url.encode('utf-8'))
+  # TODO test/allow alternate explicit icons.
+  # My browsers don't fetch '/favicon.ico' at all.
+  html_for_canonical = (br'<link rel="canonical" href="' +
+                        page.canonical_url.encode('utf-8') + br'" />')
+  html_for_favicon = br'<link rel="shortcut icon" href="/favicon.ico?rr" />'
+  return re.sub(br'((?:\n|^)[ \t]*)<!--AUTOHEAD-->',
+    (lambda m:
+       m.group(1) + html_for_canonical +
+       m.group(1) + html_for_favicon),
+    html)
+
+def autoobfuscate(html, page):
+  """
+  AUTO_OBFUSCATE_URL(addr example.com) --> mailto:addr@example.com obfuscated for
+    use in an HTML href="".  Note: one obfuscation, newlines in the address,
+    is not HTML-valid but still works in at least Firefox and Chromium and
+    makes it harder for bots that just preprocess pages with &-decoding and
+    case-folding.
+  AUTO_OBFUSCATE_HTML(addr example.com) --> addr@example.com obfuscated for
+    use in HTML body text.
+
+  The source syntaxes are written without an @ and without mentioning the word "mail"
+  in the hopes that if the source document is visible to the Web, or the replacement
+  fails to work for some reason, it will still be difficult to automatically harvest
+  the email address from the source.
+  """
 
-    nginx_openresty(config, do, rewriter, route_metadata)
+  # Percent encoding: not much use: https://code.google.com/p/chromium/issues/detail?id=335322
+  # (Firefox (26) is fine, Chromium (31) not)
+  #def obf_percent_encode_char(c):
+  #  return b'%'+
+  def obf_html_encode_char(c):
+    return b'&#'+str(ord(c)).zfill(4).encode()+b';'
+  def obf1(match):
+    return (
+      re.sub(br'(.)$', lambda m: b'\n\n'+obf_html_encode_char(m.group(1))+b'\n', match.group(1))+
+      b'&#0064;\n\n'+
+      re.sub(br'(.)\.(.)',
+        lambda m: b'\n'+obf_html_encode_char(m.group(1))+b'&#0046;\n'+obf_html_encode_char(m.group(2))+b'\n',
+        match.group(2)))
+  def mailto_obf(match):
+    return b'&#0109;aI&#x4c;tO&#0058;\n'+obf1(match)
+  def html_obf(match):
+    return re.sub(br'\n', b'<span\n></span\n>', obf1(match))
+  html = re.sub(br'\bAUTO_OBFUSCATE_URL\(([^() \t\r\n]*) ([^() \t\r\n]*)\)',
+                mailto_obf, html)
+  return re.sub(br'\bAUTO_OBFUSCATE_HTML\(([^() \t\r\n]*) ([^() \t\r\n]*)\)',
+                html_obf, html)
+
+default_html_filters = [autohead, autoobfuscate]
+
+def filtered_html(filters, html, page):
+  """html bytes passed through filters, each a function (html bytes, HtmlPage) -> html bytes, in order."""
+  for f in filters:
+    html = f(html, page)
+  return html
+
+def filter_html(filters, src, dest, page):
+  """
+  Writes src's contents to dest after passing them through filters:
+  one read and one write however many filters there are.
+  """
+  utils.write_file_binary(dest, filtered_html(filters, utils.read_file_binary(src), page))
 
 class RouteInfo(object):
   """
@@ -352,58 +561,6 @@ def custom_site_preprocessing(config, do):
     else:
       route_metadata[route] = RouteInfo()
 
-  def autohead(src, dest, canonical_url = None):
-    #utils.file_re_sub(src, dest, b'{{:canonical}}', url.encode('utf-8'))
-    # TODO test/allow alternate explicit icons.
-    # My browsers don't fetch '/favicon.ico' at all.
-    html_for_canonical = (br'<link rel="canonical" href="' +
-                          canonical_url.encode('utf-8') + br'" />')
-    html_for_favicon = br'<link rel="shortcut icon" href="/favicon.ico?rr" />'
-    utils.file_re_sub(src, dest, br'((?:\n|^)[ \t]*)<!--AUTOHEAD-->',
-      (lambda m:
-         m.group(1) + html_for_canonical +
-         m.group(1) + html_for_favicon))
-  def autoobfuscate(src, dest):
-    """
-    AUTO_OBFUSCATE_URL(addr example.com) --> mailto:addr@example.com obfuscated for
-      use in an HTML href="".  Note: one obfuscation, newlines in the address,
-      is not HTML-valid but still works in at least Firefox and Chromium and
-      makes it harder for bots that just preprocess pages with &-decoding and
-      case-folding.
-    AUTO_OBFUSCATE_HTML(addr example.com) --> addr@example.com obfuscated for
-      use in HTML body text.
-
-    The source syntaxes are written without an @ and without mentioning the word "mail"
-    in the hopes that if the source document is visible to the Web, or the replacement
-    fails to work for some reason, it will still be difficult to automatically harvest
-    the email address from the source.
-    """
-
-    # Percent encoding: not much use: https://code.google.com/p/chromium/issues/detail?id=335322
-    # (Firefox (26) is fine, Chromium (31) not)
-    #def obf_percent_encode_char(c):
-    #  return b'%'+
-    def obf_html_encode_char(c):
-      return b'&#'+str(ord(c)).zfill(4).encode()+b';'
-    def obf1(match):
-      return (
-        re.sub(br'(.)$', lambda m: b'\n\n'+obf_html_encode_char(m.group(1))+b'\n', match.group(1))+
-        b'&#0064;\n\n'+
-        re.sub(br'(.)\.(.)',
-          lambda m: b'\n'+obf_html_encode_char(m.group(1))+b'&#0046;\n'+obf_html_encode_char(m.group(2))+b'\n',
-          match.group(2)))
-    def mailto_obf(match):
-      return b'&#0109;aI&#x4c;tO&#0058;\n'+obf1(match)
-    def html_obf(match):
-      return re.sub(br'\n', b'<span\n></span\n>', obf1(match))
-    utils.file_re_sub(src, dest,
-      br'\bAUTO_OBFUSCATE_URL\(([^() \t\r\n]*) ([^() \t\r\n]*)\)',
-      mailto_obf)
-    utils.file_re_sub(dest, dest,
-      br'\bAUTO_OBFUSCATE_HTML\(([^() \t\r\n]*) ([^() \t\r\n]*)\)',
-      html_obf)
-
-
   def add_file(f, guess_mime_type = True):
     """
     Records some basic info about f, a file that might be used
@@ -452,88 +609,125 @@ def custom_site_preprocessing(config, do):
     #route_metadata[from_route].headers.append((
     #    'Location', urljoin(from_route, to)))
 
-  for srcf in files_to_consider:
-    src = join(src_document_root, srcf)
-    route = None
-    f = None
-    if config.published_as_is('/'+srcf):
-      f = srcf
-      route = config.hypothetical_scheme_and_domain+'/'+f
-      dest = join('site', f)
-      for _ in do([src], [dest]):
-        os.link(src, dest)
-    elif re.search(r'\.(html|md)$', srcf):
-      is_markdown = re.search(r'\.md$', srcf)
-      extless_path = re.sub(r'\.(html|md)$', '', srcf)
-      f = extless_path+'.html'
-      dest = join('site', f)
-      # slight hack for index.html file
-      domainrelative_route = re.sub('/index$', '/', '/'+extless_path)
-      route = config.hypothetical_scheme_and_domain + domainrelative_route
-      url = (config.canonical_scheme_and_domain + domainrelative_route
-             if config.canonical_scheme_and_domain != None else None)
-      if is_markdown:
-        if config.pandoc_template_relative_to_source_dir != None:
-          pandoc_template = join('src', config.pandoc_template_relative_to_source_dir)
-          pandoc_templates = [pandoc_template]
+  # Rules' fingerprints (see buildsystem.BuildRun.__call__) say which code
+  # and tools they use, so that changing other code doesn't rebuild them.
+  link_fingerprint = fingerprints.fingerprint(os.link)
+  html_filters_fingerprint = fingerprints.fingerprint(filter_html, filtered_html,
+                                                      *config.html_filters)
+  pandoc = (pandoc_pool.PandocPool(config.pandoc_command, config.pandoc_workers,
+                                   config.pandoc_worker_checks)
+            if config.pandoc_workers != None else None)
+  # (The pandoc workers are stopped however the build goes.)
+  try:
+    for srcf in files_to_consider:
+      src = join(src_document_root, srcf)
+      route = None
+      f = None
+      if config.published_as_is('/'+srcf):
+        f = srcf
+        route = config.hypothetical_scheme_and_domain+'/'+f
+        dest = join('site', f)
+        for _ in do([src], [dest], fingerprint = link_fingerprint):
+          os.link(src, dest)
+      elif re.search(r'\.(html|md)$', srcf):
+        is_markdown = re.search(r'\.md$', srcf)
+        extless_path = re.sub(r'\.(html|md)$', '', srcf)
+        f = extless_path+'.html'
+        dest = join('site', f)
+        # slight hack for index.html file
+        domainrelative_route = re.sub('/index$', '/', '/'+extless_path)
+        route = config.hypothetical_scheme_and_domain + domainrelative_route
+        url = (config.canonical_scheme_and_domain + domainrelative_route
+               if config.canonical_scheme_and_domain != None else None)
+        if is_markdown:
+          if config.pandoc_template_relative_to_source_dir != None:
+            pandoc_template = join('src', config.pandoc_template_relative_to_source_dir)
+            pandoc_templates = [pandoc_template]
+          else:
+            pandoc_templates = []
+          def render_markdown(srcs, dests, src=src, dest=dest, f=f, url=url,
+                              pandoc_templates=pandoc_templates):
+            # (pandoc's output goes through the filters in memory.)
+            if pandoc != None:
+              html = pandoc.render(src, dest, pandoc_templates)
+            else:
+              html = autodeps.check_output(
+                pandoc_pool.command_line(config.pandoc_command, src, dest, pandoc_templates))
+            utils.write_file_binary(dest, filtered_html(config.html_filters, html, HtmlPage(f, url)))
+          do.later([src] + pandoc_templates, [dest], render_markdown,
+            fingerprint = fingerprints.fingerprint(
+              fingerprints.tool_version(config.pandoc_command, '--version'),
+              render_markdown, pandoc_pool.command_line, html_filters_fingerprint))
         else:
-          pandoc_templates = []
-        for _ in do([src] + pandoc_templates, [dest]):
-          cmd([config.pandoc_command, '--standalone'] +
-              ['--template='+t for t in pandoc_templates] +
-              ['-t', 'html5', '-o', dest, src])
-          autohead(dest, dest, url)
-          autoobfuscate(dest, dest)
-      else:
-        for _ in do([src], [dest]):
-          autohead(src, dest, url)
-          autoobfuscate(dest, dest)
-    elif re.search(r'\.(scss|sass)$', srcf):
-      f = re.sub(r'\.(scss|sass)$', '.css', srcf)
-      # don't disturb precompiled scss:
-      if exists(join(src_document_root, f)):
-        f = None
+          def process_html(srcs, dests, src=src, dest=dest, f=f, url=url):
+            filter_html(config.html_filters, src, dest, HtmlPage(f, url))
+          do.later([src], [dest], process_html,
+            fingerprint = fingerprints.fingerprint(process_html, html_filters_fingerprint))
+      elif re.search(r'\.(scss|sass)$', srcf):
+        f = re.sub(r'\.(scss|sass)$', '.css', srcf)
+        # don't disturb precompiled scss:
+        if exists(join(src_document_root, f)):
+          f = None
+        else:
+          assert(config.sassc_command) #install `sassc` (preferred) or `sass`
+          f_map = f+'.map'
+          dest = join('site', f)
+          load_paths = [join('src', p) for p in config.sass_load_paths_relative_to_source_dir]
+          imports, unresolved = scss_deps.sass_imports(
+            src, load_paths + scss_deps.env_load_paths())
+          def compile_sass(srcs, dests, src=src, dest=dest, load_paths=load_paths):
+            # Creates both f and f_map:
+            cmd([config.sassc_command, '--sourcemap'] +
+                [arg for p in load_paths for arg in ['-I', p]] + [src, dest])
+          # The imports are found again every build, so the fingerprint
+          # covers which files they resolve to (e.g. a new partial that
+          # takes precedence), and the sources cover those files' contents.
+          do.later([src] + imports, [dest, join('site', f_map)], compile_sass,
+            fingerprint = fingerprints.fingerprint(
+              fingerprints.tool_version(config.sassc_command, '--version'),
+              compile_sass, '\n'.join(imports), '\n'.join(unresolved)))
+      elif re.search(r'\.(3[0-9][0-9])$', srcf):
+        extless_path = re.sub(r'\.(3[0-9][0-9])$', '', srcf)
+        # Hmm should 'index.301' be a thing? or '.301'? or just use dirname.301
+        route = config.hypothetical_scheme_and_domain+'/'+extless_path
+        # Alas, this code currently can't support redirecting to a resource. TODO
+        add_redirect(int(srcf[-3:]), route, utils.read_file_text(src).strip())
+        # Don't add the route again below
+        route = None
       else:
-        assert(config.sassc_command) #install `sassc` (preferred) or `sass`
-        f_map = f+'.map'
+        f = srcf
         dest = join('site', f)
-        #I don't have a scss dependency chaser, so I can't easily give
-        #the correct set of dependencies to do(), but sassc is pretty fast
-        #so I'll run it every time.
-        # Creates both f and f_map:
-        cmd([config.sassc_command, '--sourcemap', src, dest])
-    elif re.search(r'\.(3[0-9][0-9])$', srcf):
-      extless_path = re.sub(r'\.(3[0-9][0-9])$', '', srcf)
-      # Hmm should 'index.301' be a thing? or '.301'? or just use dirname.301
-      route = config.hypothetical_scheme_and_domain+'/'+extless_path
-      # Alas, this code currently can't support redirecting to a resource. TODO
-      add_redirect(int(srcf[-3:]), route, utils.read_file_text(src).strip())
-      # Don't add the route again below
-      route = None
-    else:
-      f = srcf
-      dest = join('site', f)
-      for _ in do([src], [dest]):
-        os.link(src, dest)
-    if f != None:
-      add_file(f)
-    if route != None:
-      add_route(route, f)
-
-  f = '404.html'
-  for [], [dest] in do([], [join('site', f)]):
-    utils.write_file_text(dest, errdocs.errdoc(404))
-  add_file(f)
-  file_metadata[f].status = 404
+        for _ in do([src], [dest], fingerprint = link_fingerprint):
+          os.link(src, dest)
+      if f != None:
+        add_file(f)
+      if route != None:
+        add_route(route, f)
+
+    # Everything below reads site/ directly.
+    do.wait()
+
+    f = '404.html'
+    for [], [dest] in do([], [join('site', f)], fingerprint = fingerprints.fingerprint(errdocs)):
+      utils.write_file_text(dest, errdocs.errdoc(404))
+    add_file(f)
+    file_metadata[f].status = 404
+    do.settle('site')
+  finally:
+    if pandoc != None:
+      pandoc.close()
 
   # It's not super elegant calling the rewriter inside custom processing
   # rather than after, but it'll do.
-  rewriter = resource_rewriting.ResourceRewriter(
-    rewritable_files = files_to_rewrite,
-    site_source_prefix = 'site',
-    hashed_data_prepend = config.rr_hash_random_bytes,
-    origins_to_assume_contain_the_resources = config.origins_to_assume_contain_the_resources,
-    do=do)
+  with do.span('ResourceRewriter'):
+    rewriter = resource_rewriting.ResourceRewriter(
+      rewritable_files = files_to_rewrite,
+      site_source_prefix = 'site',
+      hashed_data_prepend = config.rr_hash_random_bytes,
+      origins_to_assume_contain_the_resources = config.origins_to_assume_contain_the_resources,
+      hash_jobs = config.build_jobs,
+      hash_algorithm = config.content_hash_algorithm,
+      do=do)
 
   nonresource_routes = {route_ for route_ in route_metadata}
   missing_resource = False
@@ -611,9 +805,10 @@ def custom_site_preprocessing(config, do):
           nonlocal broken_link_found
           broken_link_found = True
     return result
-  routes_robots_should_index = set(utils.make_transitive(
-      lambda f: filter(lambda f2: f2 not in config.butdontindexfrom, find_internal_links(f)),
-    True, True)(config.doindexfrom))
+  with do.span('find_internal_links'):
+    routes_robots_should_index = set(utils.make_transitive(
+        lambda f: filter(lambda f2: f2 not in config.butdontindexfrom, find_internal_links(f)),
+      True, True)(config.doindexfrom))
   if broken_link_found:
     sys.stderr.write("""
 If some of the broken-link files actually exist, do you need to rr:ify
@@ -696,8 +891,9 @@ Exiting due to broken internal and/or resource links.
 def nginx_openresty(config, do, rewriter, route_metadata):
   nginx_subdir_name = 'deploy'
   rewritten_dir = 'rewritten-towards/nocdn-content-encoding-negotiable'
-  rewriter.rewrite(rewritten_dir,
-    lambda f, o: config.nocdn_resources_path + f, os.link, os.link)
+  with do.span('rewrite'):
+    rewriter.rewrite(rewritten_dir,
+      lambda f, o: config.nocdn_resources_path + f, os.link, os.link)
   # nginx_routes e.g.
   #   {'/foo': 'http://www.idupree.com/foo',
   #    '/_resources/bar.css': 'http://fake-rr.idupree.com/bar.css'
@@ -724,20 +920,43 @@ def nginx_openresty(config, do, rewriter, route_metadata):
   # TODO could make this path include a random secret component
   nginx_pagecontent_url_prefix_deploy = '/pagecontent/'
   #for route in nginx_routes.values():
+  # (The rules share the hashing threads and their in-flight byte
+  #  budget, as ResourceRewriter's hashing does.)
+  hasher = utils.ParallelHasher(config.content_hash_algorithm, config.build_jobs)
+  def write_pagecontent_hash(srcs, dests):
+    [src], [dest] = srcs, dests
+    utils.write_file_text(dest, hasher.submit(src).result().hex())
+  def gzip_pagecontent(srcs, dests):
+    [src], [dest] = srcs, dests
+    utils.gzip_omitting_metadata(src, dest)
+  def link_pagecontent(srcs, dests):
+    [src], [dest] = srcs, dests
+    os.link(src, dest)
+  files = {route_metadata[route].file for route in route_metadata
+           if route_metadata[route].file != None}
+  hash_fingerprint = fingerprints.fingerprint(write_pagecontent_hash, utils.hashfile,
+                                              config.content_hash_algorithm)
+  with hasher:
+    for f in files:
+      do.later([join(rewritten_dir, f)], ['nginx-pagecontent-hash/'+f],
+               write_pagecontent_hash, fingerprint = hash_fingerprint)
+    # The pagecontent paths below are named by these hashes.
+    do.wait()
+  gzip_fingerprint = fingerprints.fingerprint(gzip_pagecontent, utils.gzip_omitting_metadata)
+  link_fingerprint = fingerprints.fingerprint(link_pagecontent)
   for route in route_metadata:
     if route_metadata[route].file != None:
       f = route_metadata[route].file
       worth_gzipping = route_metadata[route].worth_gzipping
       src = join(rewritten_dir, f)
-      for [_], [dest] in do([src], ['nginx-pagecontent-hash/'+f]):
-        utils.write_file_text(dest, utils.sha384file(src).hexdigest())
       for gz in [True, False] if worth_gzipping else [False]:
-        cp_ish = utils.gzip_omitting_metadata if gz else os.link
-        for [_], [dest] in do(
-            [src],
-            [nginx_pagecontent_dir_build+recall_nginx_pagecontent_path(f, gz)]):
-            #['nginx/pages/'+('gz/' if gz else 'nogz/')+f]):
-          cp_ish(src, dest)
+        dest = nginx_pagecontent_dir_build+recall_nginx_pagecontent_path(f, gz)
+        #['nginx/pages/'+('gz/' if gz else 'nogz/')+f]):
+        if gz:
+          do.later([src], [dest], gzip_pagecontent, fingerprint = gzip_fingerprint)
+        else:
+          do.later([src], [dest], link_pagecontent, fingerprint = link_fingerprint)
+  do.wait()
   def make_etag(status, headers, f):
     h = hashlib.sha384()
     # There's probably nothing hidden by adding a random secret here,
@@ -832,12 +1051,13 @@ def nginx_openresty(config, do, rewriter, route_metadata):
     rule.append("""end""")
     return "\n  ".join(rule)
 
-  rules = []
-  for nginx_route, route in nginx_routes.items():
-    rules.append(
-      "[{route}] = {rule},".format(route=repr(nginx_route), rule = make_rule(route)))
+  with do.span('nginx Lua generation'):
+    rules = []
+    for nginx_route, route in nginx_routes.items():
+      rules.append(
+        "[{route}] = {rule},".format(route=repr(nginx_route), rule = make_rule(route)))
 
-  s404 = make_rule(None)
+    s404 = make_rule(None)
 
   init_lua = (
   """
@@ -27,12 +27,23 @@ those blocks won't be run so the Python variables won't be set).
 
 import itertools
 import sys
-from os import stat, utime, rename, link, mkdir, chdir, makedirs, getcwd, walk, listdir
-from os.path import join, abspath, dirname, basename, exists, relpath
-from shutil import rmtree, copyfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from os import stat, utime, rename, link, unlink, mkdir, rmdir, chdir, makedirs, getcwd, walk, listdir, scandir
+from os.path import join, abspath, dirname, basename, exists, relpath, isdir, samestat
+from shutil import rmtree, copyfile, copymode
 import re
+from stat import S_ISREG
 
 from . import utils
+from .utils import normpath
+from .freshness_db import FreshnessDB
+from .fingerprints import Fingerprints
+from .explain import RuleLog
+from .buildtrace import BuildTrace
+from . import autodeps
+from . import output_cache
 
 # TODO somehow make it work in Python 2 without losing precision
 # stat's _ns were only added in Python 3.3
@@ -102,45 +113,792 @@ def merge_older_stuff_into(targetdir, olderstuffdir):
         pass  #errors resulting from olderdirpath not being a directory
     rmtree(olderstuffdir)
 
-def generic_do(sources, dests, build_system_sources, dirs_with_already_built_stuff = ()):
+class StatCache(object):
+  """
+  The mtimes of files and directories that a BuildRun has looked at or
+  set, so that it doesn't stat the same build_system_sources, sources
+  and directories again for every rule.  Entries are only invalidated by
+  the BuildRun's own writes (running a rule's body invalidates its dests
+  and their directories), so files must not be changed behind its back
+  during a run, other than by 'do' bodies writing their dests.
+  (Code that does should call invalidate() or clear().)
+
+  hits, misses and invalidations count lookups answered from the cache,
+  lookups that had to go to the filesystem, and entries dropped.
+  (With rules running in parallel, the counts are approximate.)
+
+  Paths are absolute and normalized.
+  """
+  def __init__(self):
+    self._mtimes = {}
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def mtime(self, path):
+    mtime = self._mtimes.get(path)
+    if mtime != None:
+      self.hits += 1
+      return mtime
+    self.misses += 1
+    mtime = self._mtimes[path] = _mtime(path)
+    return mtime
+
+  def mtime_or_ancestor_mtime(self, path):
+    """_mtime_or_ancestor_mtime, remembering it if path exists."""
+    try: return self.mtime(path)
+    except (FileNotFoundError, NotADirectoryError):
+      return _mtime_or_ancestor_mtime(dirname(path))
+
+  def exists(self, path):
+    if path in self._mtimes:
+      self.hits += 1
+      return True
+    self.misses += 1
+    return exists(path)
+
+  def set(self, path, mtime):
+    """Records that path now exists with this mtime."""
+    self._mtimes[path] = mtime
+
+  def set_all(self, paths, mtime):
+    for path in paths:
+      self._mtimes[path] = mtime
+
+  def invalidate(self, path):
+    if self._mtimes.pop(path, None) != None:
+      self.invalidations += 1
+
+  def invalidate_all(self, paths):
+    for path in paths:
+      self.invalidate(path)
+
+  def invalidate_under(self, path):
+    """Invalidates path and everything under it."""
+    prefix = path + '/'
+    self.invalidate_all([p for p in self._mtimes if p == path or p.startswith(prefix)])
+
+  def clear(self):
+    self.invalidations += len(self._mtimes)
+    self._mtimes.clear()
+
+  def metrics(self):
+    return {
+      'stat_cache_hits': self.hits,
+      'stat_cache_misses': self.misses,
+      'stat_cache_invalidations': self.invalidations,
+      }
+
+_subtree_manifest_version = 1
+
+class SubtreeReuse(object):
+  """
+  Lets a run take whole directories from the previous build (build_dir)
+  instead of hardlinking their up-to-date files one at a time.
+
+  At the end of each run, a manifest records every dest that 'do' was
+  asked for and which directories contain nothing else.  The next run,
+  when a rule's dest is in such a directory and the directory doesn't
+  exist in building_dir yet, it is renamed over from build_dir whole.
+  The files in it then count as 'adopted': when a rule asks for one,
+  it's checked like a file in build_dir would be (and removed if it's out
+  of date); adopted files that no rule asks for are removed at the end.
+
+  It also remembers the directories it knows exist, so that 'do' doesn't
+  check every parent directory of every dest every time.
+
+  Until the run succeeds, build_dir is still the last good build, so
+  the adopted files that the run replaces or drops are moved aside to
+  set_aside_dir rather than deleted, and if the run fails, give_back()
+  puts the adopted directories back as they were.
+
+  Paths given to its methods are absolute, and the caller holds
+  the BuildRun's lock.
+  """
+  def __init__(self, manifest_path, build_dir, building_dir, set_aside_dir):
+    self.manifest_path = manifest_path
+    self.build_dir = build_dir
+    self.building_dir = building_dir
+    self.set_aside_dir = set_aside_dir
+    old = utils.read_json_or(manifest_path, {})
+    if old.get('version') != _subtree_manifest_version or not exists(build_dir):
+      old = {}
+    self._reusable = set(old.get('dirs', []))
+    self._previous_dests = old.get('dests', [])
+    # relative to building_dir:
+    self._adopted = set()
+    self._declared = set()
+    self._set_aside = set()
+    # absolute:
+    self._known_dirs = set()
+
+  def _rel(self, path):
+    return relpath(path, self.building_dir)
+
+  def _in_adopted(self, rel):
+    return any(d in self._adopted for d in _parent_dirs(rel))
+
+  def makedirs(self, d, mtime):
+    """makedirs_with_mtime(d, mtime), adopting the topmost missing directory if it can."""
+    d = normpath(d)
+    if d in self._known_dirs: return
+    missing = []
+    p = d
+    while p not in self._known_dirs and not exists(p):
+      missing.append(p)
+      p = dirname(p)
+    if len(missing) > 0:
+      top = missing[-1]
+      if self._rel(top) in self._reusable:
+        parent_mtime = _mtime(dirname(top))
+        try:
+          rename(join(self.build_dir, self._rel(top)), top)
+        except (FileNotFoundError, NotADirectoryError):
+          pass  #e.g. taken by a run that then failed
+        else:
+          self._adopted.add(self._rel(top))
+          _set_mtime(dirname(top), parent_mtime)
+      makedirs_with_mtime(d, mtime)
+    self._known_dirs.update(missing)
+    self._known_dirs.add(p)
+
+  def is_adopted(self, path):
+    """Whether path is in an adopted directory and hasn't been declared yet."""
+    rel = self._rel(path)
+    return rel not in self._declared and self._in_adopted(rel)
+
+  def declare(self, path):
+    self._declared.add(self._rel(path))
+
+  def remove(self, path):
+    """Removes the file path, moving it aside if it's an adopted one."""
+    rel = self._rel(path)
+    if rel not in self._set_aside and self._in_adopted(rel):
+      aside = join(self.set_aside_dir, rel)
+      makedirs(dirname(aside), exist_ok = True)
+      try:
+        rename(path, aside)
+      except (FileNotFoundError, NotADirectoryError):
+        return
+      self._set_aside.add(rel)
+    else:
+      try: unlink(path)
+      except (FileNotFoundError, NotADirectoryError): pass
+
+  def give_back(self):
+    """
+    For a failed run: returns the adopted directories to build_dir,
+    with the files the run moved aside back in them and the ones it
+    made removed.  Call when no rule is running anymore.
+    """
+    previous_dests = set(self._previous_dests)
+    for top in sorted(self._adopted):
+      top_path = join(self.building_dir, top)
+      if not isdir(top_path) or exists(join(self.build_dir, top)): continue
+      for d, dirs, files in walk(top_path, topdown = False):
+        for name in files:
+          rel = self._rel(join(d, name))
+          if rel in self._set_aside or rel not in previous_dests:
+            unlink(join(d, name))
+        for name in dirs:
+          try: rmdir(join(d, name))
+          except OSError: pass  #not empty
+      for rel in self._set_aside:
+        if rel.startswith(top + '/'):
+          makedirs(dirname(join(self.building_dir, rel)), exist_ok = True)
+          rename(join(self.set_aside_dir, rel), join(self.building_dir, rel))
+      makedirs(dirname(join(self.build_dir, top)), exist_ok = True)
+      rename(top_path, join(self.build_dir, top))
+
+  def claim(self, dests, mtime):
+    """
+    Declares dests (relative to the current directory), first creating
+    or adopting their parent directories.  Returns the dests that are
+    adopted (which may or may not exist).
+    """
+    cwd = getcwd()
+    adopted = []
+    for dest in dests:
+      path = join(cwd, dest)
+      self.makedirs(dirname(path), mtime)
+      if self.is_adopted(path):
+        adopted.append(dest)
+      self.declare(path)
+    return adopted
+
+  def remove_leftovers(self, under = None):
+    """
+    Removes adopted files (and then-empty directories) that no rule asked
+    for this run, only those under the directory 'under' if given.
+    Call when the rules for them are done.
+    """
+    prefix = None if under == None else self._rel(under) + '/'
+    dir_mtimes = {}
+    for rel in self._previous_dests:
+      if rel in self._declared or not self._in_adopted(rel): continue
+      if prefix != None and not rel.startswith(prefix): continue
+      for d in _parent_dirs(rel):
+        if d in dir_mtimes: break
+        dir_mtimes[d] = _mtime_opt(join(self.building_dir, d))
+      self.remove(join(self.building_dir, rel))
+    # Deepest first, so that emptied parents can go too.
+    for d in sorted(dir_mtimes, key = lambda d: -d.count('/')):
+      if d != '' and self._in_adopted(join(d, '_')):
+        try: rmdir(join(self.building_dir, d))
+        except OSError: pass  #not empty
+    for d, mtime in dir_mtimes.items():
+      if mtime != None and exists(join(self.building_dir, d)):
+        _set_mtime(join(self.building_dir, d), mtime)
+
+  def _pure_dirs(self, root, rel, result):
+    """
+    Appends to result the directories under join(root, rel) that contain
+    only declared files; returns whether join(root, rel) itself does.
+    """
+    pure = True
+    for entry in scandir(join(root, rel)):
+      entry_rel = join(rel, entry.name) if rel != '' else entry.name
+      if entry.is_dir(follow_symlinks = False):
+        if not self._pure_dirs(root, entry_rel, result): pure = False
+      elif not (entry.is_file(follow_symlinks = False) and entry_rel in self._declared):
+        pure = False
+    if pure and rel != '': result.append(rel)
+    return pure
+
+  def save(self, built_dir):
+    """Writes the manifest for the next run.  built_dir: where the build is now."""
+    dirs = []
+    self._pure_dirs(built_dir, '', dirs)
+    utils.write_json_atomically(self.manifest_path, {
+      'version': _subtree_manifest_version,
+      'dirs': sorted(dirs),
+      'dests': sorted(self._declared),
+      })
+
+class BuildRun(object):
+  """
+  Everything 'do' needs to know besides its arguments: the files that
+  everything depends on, the directories to get already-built files from,
+  etc.  Calling a BuildRun is 'do'; run_basic() yields one.
+
+  jobs: if more than 1, rules declared with later() are collected into
+  a dependency graph (a rule depends on the rules whose dests are its
+  sources) and run on a pool of that many worker threads.
+  pool: 'thread' (default) runs the bodies passed to later() on the
+  worker threads; 'process' sends them to a process pool, in which case
+  they must be picklable (e.g. module-level functions).  Either way, the
+  mtime bookkeeping happens in this process.
+  trace: a buildtrace.BuildTrace to record every rule in, or None.
+  subtrees: a SubtreeReuse, or None.
+  code_sources: sources of every rule except those with a fingerprint
+  or declared with uses_code=False (see later()).
+  discovered_deps: an autodeps.DiscoveredDeps, or None.  If given, each
+  rule's body is watched to find the files and code it really uses (see
+  autodeps.py), and code_sources only count as sources of the rules that
+  haven't run while being watched yet; the rest depend on what was found
+  instead.  Bodies run in a process pool can't be watched.
+  fingerprints: a fingerprints.Fingerprints to remember the rules'
+  fingerprints (see __call__) in, or None to make a temporary one.
+  output_cache: a backend from output_cache.py to restore the dests of
+  rules that would run from, and to store them in once they have run,
+  or None.  It needs freshness_db, for the sources' digests.
+  rule_log: an explain.RuleLog to record every rule that isn't elided
+  in, or None.
+  """
+  def __init__(self, build_system_sources, dirs_with_already_built_stuff = (), *,
+               freshness_db = None, jobs = None, pool = 'thread', trace = None,
+               subtrees = None, discovered_deps = None, code_sources = (),
+               fingerprints = None, output_cache = None, rule_log = None):
+    if pool not in ('thread', 'process'):
+      raise ValueError("pool must be 'thread' or 'process': " + repr(pool))
+    if output_cache != None and freshness_db == None:
+      raise ValueError("output_cache needs a freshness_db")
+    self.build_system_sources = list(build_system_sources)
+    self.dirs_with_already_built_stuff = list(dirs_with_already_built_stuff)
+    self.freshness_db = freshness_db
+    self.trace = trace
+    self.subtrees = subtrees
+    self.discovered_deps = discovered_deps
+    self.code_sources = list(code_sources)
+    self.fingerprints = fingerprints if fingerprints != None else Fingerprints()
+    self.output_cache = output_cache
+    self.rule_log = rule_log
+    self.jobs = jobs
+    self._executor = None
+    self._body_executor = None
+    if jobs != None and jobs > 1:
+      self._executor = ThreadPoolExecutor(jobs)
+      if pool == 'process':
+        self._body_executor = ProcessPoolExecutor(jobs)
+    # Protects directory creation and directory-mtime bookkeeping,
+    # which rules running in parallel can share.
+    self._lock = threading.RLock()
+    # {directory: [number of rules writing in it, mtime to give it after]}
+    self._dirs_in_use = {}
+    self.stat_cache = StatCache()
+    # {'build_system_sources' or 'code_sources': their max mtime}
+    self._fixed_latest = {}
+    # {normpath(dest): Future} for every rule declared with later()
+    self._futures = {}
+    # {(st_dev, st_ino)} of the source files that hardlink staging put
+    # into the build: their mtimes are the source tree's.
+    self.source_inodes = set()
+
+  def __call__(self, sources, dests, fingerprint = None):
+    """
+    'do'.  See run_basic.  If some of the sources are dests of rules
+    declared with later(), waits for those rules to finish first.
+
+    fingerprint: a string (e.g. from fingerprints.fingerprint()) standing
+    for all the code and tools that the body depends on.  If given,
+    code_sources aren't sources of this rule; instead it's rebuilt when
+    its fingerprint differs from the one it was last built with (see
+    fingerprints.py).  build_system_sources still count.
+    """
+    self.wait(list(sources) + list(dests) + self._discovered_files(dests))
+    return self._do(sources, dests, declared_in = sys._getframe(1).f_code.co_filename,
+                    fingerprint = fingerprint)
+
+  def later(self, sources, dests, function, uses_code = True, fingerprint = None):
+    """
+    Like 'do', but instead of a 'for' block, pass the build body as
+    function(sources, dests).  It may run later and on another thread:
+    once the rules producing its sources have finished.  Without jobs,
+    this is the same as
+      for s, d in do(sources, dests): function(s, d)
+
+    Returns a concurrent.futures.Future.  Failures are also raised by
+    wait() and at the end of the run.
+
+    Code outside 'do' that reads a file produced by later() should call
+    wait() first (a 'do' whose sources include it waits by itself).
+
+    uses_code=False says that the body doesn't depend on code_sources
+    (e.g. it just copies its source), so they aren't sources of this rule
+    (and with discovered_deps, the body isn't watched).  fingerprint: as
+    for 'do'.
+    """
+    future = Future()
+    name = getattr(function, '__name__', None)
+    if name == '<lambda>': name = None
+    declared_in = sys._getframe(1).f_code.co_filename
+    if self._executor == None:
+      try:
+        for s, d in self._do(sources, dests, name, declared_in, uses_code,
+                             fingerprint = fingerprint):
+          function(s, d)
+      except BaseException as e:
+        future.set_exception(e)
+        raise
+      future.set_result(None)
+      return future
+    deps = self._pending_futures(list(sources) + self._discovered_files(dests))
+    with self._lock:
+      # Like 'do', saying to generate files that are already
+      # being generated is elided.
+      if len(dests) > 0 and all(normpath(dest) in self._futures for dest in dests):
+        return self._futures[normpath(dests[0])]
+      for dest in dests:
+        self._futures[normpath(dest)] = future
+    def execute():
+      try:
+        for s, d in self._do(sources, dests, name, declared_in, uses_code,
+                             watch = self._body_executor == None,
+                             fingerprint = fingerprint):
+          if self._body_executor != None:
+            self._body_executor.submit(function, s, d).result()
+          else:
+            function(s, d)
+      except BaseException as e:
+        future.set_exception(e)
+      else:
+        future.set_result(None)
+    remaining = [len(deps)]
+    def dep_done(dep):
+      with self._lock:
+        if future.done(): return
+        if dep.exception() != None:
+          future.set_exception(dep.exception())
+          return
+        remaining[0] -= 1
+        if remaining[0] == 0:
+          self._executor.submit(execute)
+    if len(deps) == 0:
+      self._executor.submit(execute)
+    for dep in deps:
+      dep.add_done_callback(dep_done)
+    return future
+
+  def _pending_futures(self, paths):
+    """
+    Futures of the rules (declared by later()) producing these paths or,
+    for paths that are directories, producing anything under them.
+    """
+    if len(self._futures) == 0: return []
+    result = set()
+    with self._lock:
+      for path in map(normpath, paths):
+        if path in self._futures:
+          result.add(self._futures[path])
+        elif isdir(path):
+          prefix = path + '/'
+          result.update(fut for dest, fut in self._futures.items() if dest.startswith(prefix))
+    return list(result)
+
+  def wait(self, paths = None):
+    """
+    Waits for the rules declared by later() that produce paths
+    (default: all such rules) to finish.  Raises their exceptions, if any.
+    """
+    if paths == None:
+      with self._lock:
+        futures = set(self._futures.values())
+    else:
+      futures = self._pending_futures(paths)
+    for future in futures:
+      future.result()
+
+  def close(self):
+    """Waits for all rules and shuts down the worker pools."""
+    try:
+      self.wait()
+    finally:
+      if self._executor != None: self._executor.shutdown()
+      if self._body_executor != None: self._body_executor.shutdown()
+
+  def metrics(self):
+    """Counters about this run so far, e.g. the stat cache's hits and misses."""
+    result = self.stat_cache.metrics()
+    if self.discovered_deps != None:
+      result['discovered_deps_rules'] = self.discovered_deps.count()
+    result['fingerprints'] = self.fingerprints.count()
+    if self.output_cache != None:
+      result.update(self.output_cache.metrics())
+    return result
+
+  def settle(self, path):
+    """
+    Says that every 'do' with dests in the directory 'path' has been
+    declared, and waits for them.  With subtrees, this removes files
+    adopted along with the directory that no 'do' asked for, so that
+    code that lists the directory doesn't see them.
+    """
+    self.wait([path])
+    if self.subtrees != None:
+      with self._lock:
+        self.subtrees.remove_leftovers(join(getcwd(), path))
+        self.stat_cache.invalidate_under(normpath(abspath(path)))
+
+  def span(self, name):
+    """
+    A context manager that records the time spent in it as a phase of
+    the build in the trace, if there is one.  For work outside 'do'.
+    """
+    if self.trace != None:
+      return self.trace.span(name)
+    return _null_context()
+
+  def _discovered_files(self, dests):
+    if self.discovered_deps == None: return []
+    previous = self.discovered_deps.previous(dests)
+    return previous['files'] if previous != None else []
+
+  def _do(self, sources, dests, name = None, declared_in = None, uses_code = True,
+          watch = True, fingerprint = None):
+    if self.trace == None:
+      yield from self._rule(sources, dests, [None], declared_in, uses_code, watch,
+                            fingerprint)
+      return
+    start = self.trace.now()
+    outcome = ['failed']
+    try:
+      yield from self._rule(sources, dests, outcome, declared_in, uses_code, watch,
+                            fingerprint)
+    finally:
+      self.trace.record_rule(name, sources, dests, outcome[0], start)
+
+  def _rule(self, sources, dests, outcome, declared_in = None, uses_code = True,
+            watch = True, fingerprint = None):
+    """
+    The implementation of 'do'.  Sets outcome[0] to what happened
+    (for the trace).  declared_in: the Python file that declared the rule.
+    uses_code, fingerprint: see later().  watch: whether the body can be
+    watched (see discovered_deps).
+    """
+    build_system_sources = self.build_system_sources
+    dirs_with_already_built_stuff = self.dirs_with_already_built_stuff
+    freshness_db = self.freshness_db
+    stat_cache = self.stat_cache
+    discovered_deps = self.discovered_deps
+    previous = discovered_deps.previous(dests) if discovered_deps != None else None
+    if not uses_code or fingerprint != None:
+      previous = {'files': [], 'code': []}
+      watch = False
+    if fingerprint != None:
+      implicit_sources = []
+      fingerprint_mtime = self.fingerprints.mtime(dests, fingerprint)
+      implicit_latest = max(self._build_system_latest(), fingerprint_mtime)
+    elif previous == None:
+      implicit_sources = self.code_sources
+      implicit_latest = max(self._build_system_latest(), self._code_sources_latest())
+    else:
+      implicit_sources = previous['files'] + previous['code']
+      implicit_latest = self._build_system_latest()
+    fullsources = list(itertools.chain(build_system_sources, implicit_sources, sources))
+    cwd = getcwd()
+    dest_paths = [normpath(join(cwd, dest)) for dest in dests]
+    source_paths = [normpath(join(cwd, source)) for source in sources]
+    def latest_of(paths):
+      return _max_mtime(map(stat_cache.mtime_or_ancestor_mtime, paths))
+    latest_modified_source = max(implicit_latest, latest_of(source_paths),
+      latest_of(implicit_sources) if previous != None else _unix_epoch)
+    # Dests that came along with a directory taken whole from the
+    # previous build.  They are checked in place, like files in
+    # dirs_with_already_built_stuff, and removed if they don't pass.
+    adopted = []
+    if self.subtrees != None:
+      with self._lock:
+        # (This also creates the parent directories.)
+        adopted = self.subtrees.claim(dests, latest_modified_source)
+      if len(adopted) > 0:
+        dirs_with_already_built_stuff = [''] + dirs_with_already_built_stuff
+    # Saying to generate a file when it's already there is elided.
+    if len(adopted) == 0 and all(map(stat_cache.exists, dest_paths)):
+      outcome[0] = 'elided'
+      return
+    # Make sure that directories keep consistent mtimes (for e.g.
+    # rsync efficiency).
+    parent_dir_mtimes = {}
+    with self._lock:
+      for dest_path in dest_paths:
+        parent_dir = dirname(dest_path)
+        # Helpfully auto-generate parent directories.
+        if self.subtrees == None and not stat_cache.exists(parent_dir):
+          makedirs_with_mtime(parent_dir, latest_modified_source)
+        if parent_dir not in parent_dir_mtimes:
+          parent_dir_mtimes[parent_dir] = self._enter_dir(parent_dir)
+    for built in dirs_with_already_built_stuff:
+      # Check == not >= so that reverting to an older source file version,
+      # or manually modifying a dest file, will trigger a rebuild.
+      up_to_date = all(_mtime_opt(join(built, dest)) == latest_modified_source for dest in dests)
+      if up_to_date:
+        if built != '':
+          self._remove_files(adopted)
+          for dest in dests:
+            link(join(built, dest), dest)
+        stat_cache.set_all(dest_paths, latest_modified_source)
+        if freshness_db != None and not freshness_db.carry_forward(dests, built):
+          freshness_db.record(dests, freshness_db.inputs_digest(fullsources, fingerprint))
+        if discovered_deps != None:
+          discovered_deps.carry_forward(dests)
+        outcome[0] = 'reused from ' + _built_name(built)
+        break
+    else: #A loop's "else" runs if 'break' was not called
+      # The mtimes say to rebuild, but maybe only the mtimes changed
+      # (e.g. from a git checkout).
+      inputs_digest = None
+      same_contents_built = None
+      if freshness_db != None:
+        inputs_digest = freshness_db.inputs_digest(fullsources, fingerprint)
+        for built in dirs_with_already_built_stuff:
+          if freshness_db.reusable(dests, inputs_digest, built):
+            same_contents_built = built
+            break
+      if same_contents_built != None:
+        if same_contents_built != '':
+          self._remove_files(adopted)
+          for dest in dests:
+            link(join(same_contents_built, dest), dest)
+        previous_output_keys = freshness_db.stat_keys(dests)
+        for dest in dests:
+          self._set_dest_mtime(dest, latest_modified_source)
+        stat_cache.set_all(dest_paths, latest_modified_source)
+        freshness_db.record(dests, inputs_digest, previous_output_keys)
+        if discovered_deps != None:
+          discovered_deps.carry_forward(dests)
+        outcome[0] = 'reused same contents from ' + _built_name(same_contents_built)
+      else:
+        self._remove_files(adopted)
+        # The building code can write anything in the dests' directories.
+        stat_cache.invalidate_all(dest_paths)
+        stat_cache.invalidate_all(parent_dir_mtimes)
+        # (Rules that only copy their sources aren't worth caching.)
+        cache_key = None
+        if self.output_cache != None and uses_code:
+          cache_key = output_cache.rule_key(fingerprint, dests,
+            [(source, freshness_db.digest(source)) for source in sources],
+            [freshness_db.digest(source) for source in
+             itertools.chain(build_system_sources, implicit_sources)])
+        if cache_key != None and self.output_cache.get(cache_key, dests):
+          if discovered_deps != None:
+            discovered_deps.carry_forward(dests)
+          outcome[0] = 'restored from output cache'
+        else:
+          recorder = None
+          if discovered_deps != None and watch:
+            recorder = autodeps.Recorder(ignore = _generator_code)
+            recorder.start()
+          try:
+            # Call the building code.
+            yield sources, dests
+          finally:
+            if recorder != None: recorder.stop()
+          outcome[0] = 'executed'
+          if recorder != None:
+            found = recorder.result(exclude = dest_paths + source_paths)
+            if declared_in != None and not autodeps._ignored(normpath(abspath(declared_in))):
+              found['code'] = sorted(set(found['code']) | {normpath(abspath(declared_in))})
+            discovered_deps.record(dests, found)
+            implicit_sources = found['files'] + found['code']
+            # What the next run will compare the dests' mtime to.
+            latest_modified_source = max(self._build_system_latest(), latest_of(source_paths),
+                                         latest_of(found['files'] + found['code']))
+          if cache_key != None and _worth_caching(sources, dests):
+            self.output_cache.put(cache_key, dests)
+        # Make sure the dests will be seen as up-to-date.
+        for dest in dests:
+          self._set_dest_mtime(dest, latest_modified_source)
+        stat_cache.set_all(dest_paths, latest_modified_source)
+        if freshness_db != None:
+          freshness_db.record(dests, inputs_digest)
+    if fingerprint != None:
+      self.fingerprints.record(dests, fingerprint, fingerprint_mtime, latest_modified_source)
+    if self.rule_log != None:
+      mtimes = lambda paths: [(p, stat_cache.mtime_or_ancestor_mtime(p)) for p in paths]
+      self.rule_log.record(mtimes(source_paths), dest_paths,
+        'code' if implicit_sources is self.code_sources else
+          mtimes(normpath(abspath(p)) for p in implicit_sources),
+        fingerprint_mtime if fingerprint != None else None,
+        latest_modified_source, fingerprint = fingerprint,
+        fingerprint_changed = fingerprint != None and self.fingerprints.changed(dests, fingerprint))
+    for parent_dir, mtime in parent_dir_mtimes.items():
+      self._leave_dir(parent_dir, max(mtime, latest_modified_source))
+
+  def _set_dest_mtime(self, dest, mtime_ns):
+    """
+    _set_mtime, except that a dest that is a hardlink to a staged source
+    file (e.g. made by os.link from src/ with hardlink staging) is
+    replaced by a copy first: a build must never change the source tree.
+    """
+    if len(self.source_inodes) > 0:
+      st = stat(dest)
+      if (st.st_dev, st.st_ino) in self.source_inodes:
+        if st.st_mtime_ns == mtime_ns: return
+        tmp = dest + '.unshare-tmp'
+        utils.clone_file(dest, tmp)
+        copymode(dest, tmp)
+        rename(tmp, dest)
+    _set_mtime(dest, mtime_ns)
+
+  def _build_system_latest(self):
+    """The max mtime of build_system_sources, which is the same for every rule."""
+    return self._fixed_sources_latest('build_system_sources')
+
+  def _code_sources_latest(self):
+    return self._fixed_sources_latest('code_sources')
+
+  def _fixed_sources_latest(self, attr):
+    paths = getattr(self, attr)
+    with self._lock:
+      if attr not in self._fixed_latest:
+        self._fixed_latest[attr] = _max_mtime(
+          self.stat_cache.mtime_or_ancestor_mtime(path) for path in paths)
+      else:
+        self.stat_cache.hits += len(paths)
+      return self._fixed_latest[attr]
+
+  def _remove_files(self, fpaths):
+    if self.subtrees != None:
+      with self._lock:
+        for fpath in fpaths:
+          self.subtrees.remove(abspath(fpath))
+    else:
+      _remove_files(fpaths)
+    self.stat_cache.invalidate_all(normpath(abspath(fpath)) for fpath in fpaths)
+
+  # When rules in the same directory run in parallel, one of them can
+  # see the directory's mtime while another is writing there, and the
+  # last one to finish mustn't undo the mtime another one set.  So the
+  # directory's mtime is read when the first one starts and set when
+  # the last one finishes.
+  # (Directories here are absolute and normalized, for the stat cache.)
+  def _enter_dir(self, d):
+    """Returns d's mtime from before any rule now running started writing in it."""
+    with self._lock:
+      entry = self._dirs_in_use.get(d)
+      if entry == None:
+        entry = self._dirs_in_use[d] = [0, self.stat_cache.mtime(d)]
+      entry[0] += 1
+      return entry[1]
+
+  def _leave_dir(self, d, mtime):
+    with self._lock:
+      entry = self._dirs_in_use[d]
+      entry[0] -= 1
+      entry[1] = max(entry[1], mtime)
+      if entry[0] == 0:
+        del self._dirs_in_use[d]
+        _set_mtime(d, entry[1])
+        self.stat_cache.set(d, entry[1])
+
+  def _restore_dir_mtime(self, d, mtime):
+    with self._lock:
+      entry = self._dirs_in_use.get(d)
+      if entry != None:
+        entry[1] = max(entry[1], mtime)
+      else:
+        _set_mtime(d, mtime)
+        self.stat_cache.set(d, mtime)
+
+# What runs between a 'do' body and the buildsystem.
+_generator_code = (BuildRun._do.__code__, BuildRun._rule.__code__)
+
+@contextmanager
+def _null_context():
+  yield
+
+def _remove_files(fpaths):
+  for fpath in fpaths:
+    try: unlink(fpath)
+    except FileNotFoundError: pass
+
+def _worth_caching(sources, dests):
+  """
+  Whether dests are all files, none of them a hard link to a source
+  (which is cheaper to make again than to restore).
+  """
+  source_stats = []
+  for source in sources:
+    try: source_stats.append(stat(source))
+    except (FileNotFoundError, NotADirectoryError): pass
+  for dest in dests:
+    try: st = stat(dest)
+    except (FileNotFoundError, NotADirectoryError): return False
+    if not S_ISREG(st.st_mode) or any(samestat(st, s) for s in source_stats):
+      return False
+  return True
+
+def _built_name(built):
+  # ('' is where adopted files already are; see SubtreeReuse.)
+  return basename(built) if built != '' else 'adopted directory'
+
+def generic_do(sources, dests, build_system_sources, dirs_with_already_built_stuff = (),
+               freshness_db = None):
   """
   Version of 'do' that doesn't depend on a run* invocation.
   Normally the only dependencies on the run* invocation are
-    * listing the set of files that everything depends on, and
-    * listing the directories to get already-built files from.
+    * listing the set of files that everything depends on,
+    * listing the directories to get already-built files from, and
+    * the freshness_db, if any (see freshness_db.py).
   If you use this directly, you specify those explicitly instead.
   """
-  fullsources = itertools.chain(build_system_sources, sources)
-  latest_modified_source = _max_mtime(
-    _mtime_or_ancestor_mtime(source) for source in fullsources)
-  # Saying to generate a file when it's already there is elided.
-  if all(map(exists, dests)):
-    return
-  # Make sure that directories keep consistent mtimes (for e.g.
-  # rsync efficiency).
-  parent_dir_mtimes = {}
-  for dest in dests:
-    # Helpfully auto-generate parent directories.
-    makedirs_with_mtime(dirname(dest), latest_modified_source)
-    parent_dir_mtimes[dirname(dest)] = _mtime(dirname(dest))
-  for built in dirs_with_already_built_stuff:
-    # Check == not >= so that reverting to an older source file version,
-    # or manually modifying a dest file, will trigger a rebuild.
-    up_to_date = all(_mtime_opt(join(built, dest)) == latest_modified_source for dest in dests)
-    if up_to_date:
-      for dest in dests:
-        link(join(built, dest), dest)
-      break
-  else: #A loop's "else" runs if 'break' was not called
-    # Call the building code.
-    yield sources, dests
-    # Make sure the dests will be seen as up-to-date.
-    for dest in dests:
-      _set_mtime(dest, latest_modified_source)
-  for parent_dir, mtime in parent_dir_mtimes.items():
-    _set_mtime(parent_dir, max(mtime, latest_modified_source))
+  return BuildRun(build_system_sources, dirs_with_already_built_stuff,
+                  freshness_db = freshness_db)._do(sources, dests)
 
-def run_basic(builds_dir, build_system_sources):
+def run_basic(builds_dir, build_system_sources, content_hash_freshness = False,
+              jobs = None, pool = 'thread', trace = False, reuse_subtrees = False,
+              discover_deps = False, code_sources = (), output_cache = None,
+              rule_log = False):
   """
   Usage:
 
@@ -172,6 +930,80 @@ def run_basic(builds_dir, build_system_sources):
   to keep track of previously built versions of files and provide them when
   their mtime indicates they're up-to-date.
 
+  If content_hash_freshness, a FreshnessDB (see freshness_db.py) in
+  builds_dir additionally lets 'do' reuse previously built files whose
+  sources' mtimes changed but whose contents (and build_system_sources'
+  contents) didn't, for example after switching git branches back and forth.
+  This costs reading each source once (and again whenever it changes)
+  to hash it.
+
+  'do' is a BuildRun.  With jobs > 1, rules declared with do.later()
+  instead of 'for' run in parallel (see BuildRun.later), with the same
+  mtime guarantees.  Plain 'do' keeps running its block inline, after
+  waiting for any later() rules that produce its sources.  Code that reads
+  files produced by later() rules without going through 'do' should call
+  do.wait() first.  The run waits for all rules before it finishes.
+
+  If trace, every rule's sources, dests, wall time and outcome (executed,
+  or reused from build/ or building-old/, ...) are recorded, along with
+  phases marked with do.span(name).  A successful run writes them to
+  builds_dir/trace.json (load it in chrome://tracing or ui.perfetto.dev)
+  and a summary, with the slowest rules and the critical path through
+  the rules, to builds_dir/trace-summary.txt and stderr.  They include
+  do.metrics(), such as how many stats 'do' saved by remembering the
+  mtimes of build_system_sources and of the files and directories it
+  wrote (see StatCache).  Don't modify files that 'do' has looked at
+  during the run other than in the 'do' that makes them.
+
+  If reuse_subtrees, directories of the previous build that contained
+  nothing but dests of 'do' are moved into building_dir whole, the first
+  time a 'do' has a dest in one, rather than each of their up-to-date
+  files being linked separately; see SubtreeReuse.  Their files are still
+  checked for being up to date when their 'do' comes, but that is one
+  stat rather than a link, and a no-op build doesn't re-check every parent
+  directory of every dest either.  Files in such a directory that no 'do'
+  asks for anymore are removed at the end of the run, or earlier by
+  do.settle(directory): call that before listing a directory of dests.
+  If the run fails, the directories go back to build_dir as they were,
+  so that it still holds the last successful build.
+  Only use this if your build doesn't write files in the building dir
+  outside of 'do' that it expects not to be there yet.
+
+  code_sources are like build_system_sources, except for rules declared
+  with a fingerprint (see BuildRun.__call__) or with later(...,
+  uses_code=False): those depend on their fingerprint, which says which
+  code and tool versions they use, in place of code_sources.  When a
+  rule's fingerprint changes, it's rebuilt, and its dests get a newer
+  mtime so that the rules using them are too.  The fingerprints are
+  kept in builds_dir/fingerprints.
+
+  If discover_deps, the buildsystem watches each 'do' body that runs (see autodeps.py)
+  and remembers, in builds_dir, the files it read and the Python files
+  whose code it ran (and the file that declared the rule).  The next run
+  uses those as the rule's sources in place of code_sources, so changing
+  one Python file only rebuilds the rules that used it.  Rules that
+  haven't run while watched yet still depend on all code_sources.
+  Rules with a fingerprint aren't watched.  build_system_sources still
+  count for every rule.  Watching can't see
+  how values computed outside the body (e.g. by code that isn't run
+  inside it) affect it, and it sees subprocesses' files only through
+  their command lines, or fully if they're started with
+  autodeps.check_call and strace is installed.
+
+  output_cache: a shared cache of rules' outputs (see output_cache.py),
+  e.g. output_cache.LocalDirectoryCache(some_dir, max_bytes), or None.
+  A rule that would run is first looked up there by its fingerprint and
+  its sources' contents, and its dests are stored there after it runs,
+  so builds in other builds_dirs or on other machines sharing the cache
+  needn't redo it.  Rules declared with uses_code=False aren't cached.
+  This implies content_hash_freshness.
+
+  If rule_log, the run records its rules' sources, dests, mtimes and
+  fingerprints in builds_dir/rule-log, so that explain.explain(builds_dir)
+  (or python -m idupree_websitepy.explain builds_dir) can say, without
+  running anything, which rules the next run would rerun and why, and
+  which rules the run reran because their fingerprint had changed.
+  Otherwise any old rule-log is removed, since it would be out of date.
 
   'for' is used because
   it allows 'do' to take an action at the beginning and end of the block
@@ -192,14 +1024,16 @@ def run_basic(builds_dir, build_system_sources):
     for [src], [dest] in do(['src'], ['dest']):
       ...
   """
-  if len(build_system_sources) == 0:
+  if len(build_system_sources) + len(code_sources) == 0:
     sys.stderr.write('Warning: no build system sources listed? think about whether you are risking the recompilation checker not realizing something needs to be done when you change your code but not data files in the future\n')
   dirs_with_already_built_stuff = []
   builds_dir = abspath(builds_dir)
   build_dir = join(builds_dir, 'build')
   building_dir = join(builds_dir, 'building')
   building_old_dir = join(builds_dir, 'building-old')
+  set_aside_dir = join(builds_dir, 'subtree-set-aside')
   build_system_sources = [abspath(p) for p in build_system_sources]
+  code_sources = [abspath(p) for p in code_sources]
   makedirs(builds_dir, exist_ok=True)
   if exists(build_dir):
     dirs_with_already_built_stuff.append(build_dir)
@@ -211,15 +1045,62 @@ def run_basic(builds_dir, build_system_sources):
   if exists(building_old_dir):
     dirs_with_already_built_stuff.append(building_old_dir)
   mkdir(building_dir)
-  _set_mtime(building_dir, _max_mtime(_mtime(source) for source in build_system_sources))
+  _set_mtime(building_dir, _max_mtime(_mtime(source)
+                                      for source in build_system_sources + code_sources))
+  freshness_db = (FreshnessDB(join(builds_dir, 'freshness-db'))
+                  if content_hash_freshness or output_cache != None else None)
+  if exists(set_aside_dir): rmtree(set_aside_dir)
+  subtrees = (SubtreeReuse(join(builds_dir, 'subtree-manifest'), build_dir, building_dir,
+                           set_aside_dir)
+              if reuse_subtrees else None)
+  discovered_deps = (autodeps.DiscoveredDeps(join(builds_dir, 'discovered-deps'))
+                     if discover_deps else None)
+  fingerprints = Fingerprints(join(builds_dir, 'fingerprints'))
+  rule_log_path = join(builds_dir, 'rule-log')
+  rule_log = (RuleLog(rule_log_path, building_dir, build_system_sources, code_sources)
+              if rule_log else None)
   # 'do': callback used to run a build rule if rebuild is needed.
-  def do(sources, dests):
-    return generic_do(sources, dests, build_system_sources, dirs_with_already_built_stuff)
-  yield building_dir, do
+  do = BuildRun(build_system_sources, dirs_with_already_built_stuff,
+                freshness_db = freshness_db, jobs = jobs, pool = pool,
+                trace = BuildTrace() if trace else None, subtrees = subtrees,
+                discovered_deps = discovered_deps, code_sources = code_sources,
+                fingerprints = fingerprints, output_cache = output_cache,
+                rule_log = rule_log)
+  try:
+    yield building_dir, do
+    do.close()
+  except BaseException:
+    if subtrees != None:
+      # Keep the last good build whole.
+      try: do.close()
+      except BaseException: pass
+      subtrees.give_back()
+    raise
+  if subtrees != None:
+    subtrees.remove_leftovers()
   # Success: move the build to the completed-build location; clean up.
   if exists(building_old_dir): rmtree(building_old_dir)
   if exists(build_dir): rmtree(build_dir)
   rename(building_dir, build_dir)
+  if exists(set_aside_dir): rmtree(set_aside_dir)
+  if subtrees != None:
+    subtrees.save(build_dir)
+  # (Its stat keys don't depend on the files' directory names.)
+  if freshness_db != None:
+    freshness_db.save()
+  if discovered_deps != None:
+    discovered_deps.save()
+  fingerprints.save()
+  if rule_log != None:
+    rule_log.save()
+  elif exists(rule_log_path):
+    unlink(rule_log_path)
+  if output_cache != None:
+    output_cache.trim()
+  if do.trace != None:
+    do.trace.metrics.update(do.metrics())
+    do.trace.write(join(builds_dir, 'trace.json'), join(builds_dir, 'trace-summary.txt'))
+    sys.stderr.write(do.trace.summary())
 
 
 def default_builds_dir_name(srcdir):
@@ -229,7 +1110,165 @@ def default_builds_dir_name(srcdir):
 
 exclude_files_default_re = re.compile('~$|\.(swp|new|kate-swp)$|(^|/)(\.git|__pycache__|_darcs|\.svn|\.hg)(/|$)')
 def exclude_files_default(f): return bool(exclude_files_default_re.search(f))
-def run(srcdir, build_system_sources, builds_dir = None, exclude_src_files = exclude_files_default):
+def _copy_source_file(sources, dests):
+  [src], [dest] = sources, dests
+  copyfile(src, dest)
+
+def _clone_source_file(sources, dests):
+  [src], [dest] = sources, dests
+  utils.clone_file(src, dest)
+
+def _list_source_dir(srcdir, reldir, old_snapshot, new_snapshot):
+  """
+  Returns (subdirectories to descend into, files) of join(srcdir, reldir),
+  like os.walk would, but without reading the directory when its mtime
+  says its entries are the same as in old_snapshot.
+  """
+  path = join(srcdir, reldir)
+  mtime = _mtime(path)
+  old = old_snapshot.get(reldir)
+  if old != None and old['mtime'] == mtime:
+    entry = old
+  else:
+    dirs, files = [], []
+    for e in scandir(path):
+      if e.is_dir():
+        # (os.walk lists symlinks to directories but doesn't follow them)
+        if not e.is_symlink(): dirs.append(e.name)
+      else:
+        files.append(e.name)
+    entry = {'mtime': mtime, 'dirs': sorted(dirs), 'files': sorted(files)}
+  new_snapshot[reldir] = entry
+  return entry['dirs'], entry['files']
+
+def stage_source_tree(do, srcdir, buildsrcdir, exclude_src_files = exclude_files_default,
+                      staging = 'copy', snapshot_file = None):
+  """
+  Makes buildsrcdir a copy of srcdir (except files that return True
+  from exclude_src_files), in the way run() does.
+
+  staging:
+    'copy': use copyfile (through 'do', so unchanged files are reused
+      from the previous build rather than copied again).
+    'reflink': like 'copy' but copies with utils.clone_file, which costs
+      almost nothing on filesystems that support reflinks (btrfs, XFS...)
+      and avoids copying through userspace on the rest.
+    'hardlink': hardlink each file instead of copying.  This doesn't read
+      or write any file contents at all, but the staged files are the
+      source files: build commands must not modify files in buildsrcdir
+      in place (creating new files there is fine), and the staged files'
+      mtimes are their own rather than including build_system_sources'.
+      Falls back to copying if srcdir is on a different filesystem.
+
+  snapshot_file: if given, remembers each source directory's mtime and
+  entries there, so directories that haven't changed aren't re-read.
+  (Files are still stat'ed each time; their contents can change without
+  their directory changing.)  With 'copy' and 'reflink', files that are
+  up to date in the previous build are linked directly rather than going
+  through a full 'do' each.
+
+  If do has subtrees (see run_basic's reuse_subtrees), unchanged files in
+  directories it takes from the previous build are left where they are.
+  """
+  if staging not in ('copy', 'reflink', 'hardlink'):
+    raise ValueError("staging must be 'copy', 'reflink' or 'hardlink': " + repr(staging))
+  copy_rule = _clone_source_file if staging == 'reflink' else _copy_source_file
+  old_snapshot = utils.read_json_or(snapshot_file, {}) if snapshot_file != None else {}
+  new_snapshot = {}
+  build_system_latest = do._build_system_latest()
+  cwd = getcwd()
+  def log_staged(src, src_st, dest_path, mtime):
+    # (What 'do' would record for the files staged without a 'do'.)
+    if do.rule_log != None:
+      do.rule_log.record([(normpath(src), src_st.st_mtime_ns)], [normpath(dest_path)], [],
+                         None, mtime, build_system = staging != 'hardlink')
+  pending_dirs = ['.']
+  while pending_dirs:
+    reldir = pending_dirs.pop()
+    dirs, files = _list_source_dir(srcdir, reldir, old_snapshot, new_snapshot)
+    pending_dirs.extend(normpath(join(reldir, d)) for d in reversed(dirs))
+    destdir = normpath(join(cwd, buildsrcdir, reldir))
+    # The mtime to give destdir after linking files into it, if we do.
+    destdir_mtime = None
+    to_copy = []
+    for name in files:
+      filepath = normpath(join(reldir, name))
+      if exclude_src_files(filepath):
+        continue
+      src, dest = join(srcdir, filepath), join(buildsrcdir, filepath)
+      try: src_st = stat(src)
+      except (FileNotFoundError, NotADirectoryError): src_st = None
+      link_src = None
+      if src_st != None:
+        latest = max(build_system_latest, src_st.st_mtime_ns)
+        if do.subtrees != None:
+          # As in 'do', but checking adopted files without a 'do' each.
+          path = join(cwd, dest)
+          with do._lock:
+            if destdir_mtime == None:
+              do.subtrees.makedirs(destdir, latest)
+              destdir_mtime = _mtime(destdir)
+            adopted = do.subtrees.is_adopted(path)
+            do.subtrees.declare(path)
+          if adopted:
+            try: dest_st = stat(dest)
+            except FileNotFoundError: dest_st = None
+            if dest_st != None and (samestat(src_st, dest_st) if staging == 'hardlink'
+                                    else dest_st.st_mtime_ns == latest):
+              if staging == 'hardlink':
+                do.source_inodes.add((src_st.st_dev, src_st.st_ino))
+              destdir_mtime = max(destdir_mtime, latest)
+              do.stat_cache.set(normpath(path), dest_st.st_mtime_ns)
+              log_staged(src, src_st, path, dest_st.st_mtime_ns)
+              if do.trace != None:
+                do.trace.record_rule('stage_source_tree', [src], [dest],
+                                     'reused from adopted directory', do.trace.now())
+              continue
+            do._remove_files([dest])
+        if staging == 'hardlink':
+          link_src = src
+          link_mtime = src_st.st_mtime_ns
+          outcome = 'hardlinked'
+          do.source_inodes.add((src_st.st_dev, src_st.st_ino))
+        elif snapshot_file != None:
+          # The freshness check from 'do', minus re-checking
+          # build_system_sources for every file.
+          for built in do.dirs_with_already_built_stuff:
+            if _mtime_opt(join(built, dest)) == latest:
+              link_src = join(built, dest)
+              link_mtime = latest
+              outcome = 'reused from ' + basename(built)
+              break
+      if link_src != None:
+        if destdir_mtime == None:
+          with do._lock:
+            makedirs_with_mtime(destdir, latest)
+            destdir_mtime = _mtime(destdir)
+        try:
+          start = do.trace.now() if do.trace != None else None
+          link(link_src, dest)
+          destdir_mtime = max(destdir_mtime, latest)
+          do.stat_cache.set(normpath(join(cwd, dest)), link_mtime)
+          log_staged(src, src_st, join(cwd, dest), link_mtime)
+          if do.trace != None:
+            do.trace.record_rule('stage_source_tree', [src], [dest], outcome, start)
+          continue
+        except OSError:
+          pass
+      to_copy.append((src, dest))
+    # Restore destdir's mtime before any 'do' in it
+    # records destdir's mtime to restore.
+    if destdir_mtime != None:
+      do._restore_dir_mtime(destdir, destdir_mtime)
+    for src, dest in to_copy:
+      do.later([src], [dest], copy_rule, uses_code = False)
+  do.settle(buildsrcdir)
+  do.wait()
+  if snapshot_file != None:
+    utils.write_json_atomically(snapshot_file, new_snapshot)
+
+def run(srcdir, build_system_sources, builds_dir = None, exclude_src_files = exclude_files_default,
+        staging = 'copy', snapshot_source_dirs = False, **run_basic_options):
   """
   Like run_basic(), but:
   * Indicates building_dir by chdir'ing into it for the duration of
@@ -242,6 +1281,11 @@ def run(srcdir, build_system_sources, builds_dir = None, exclude_src_files = exc
     the source directory.
   * Chooses builds_dir by default to be srcdir/../+xxxxxx-builds where xxxxxx
     is basename(srcdir), or you can specify builds_dir yourself.
+  staging ('copy', 'reflink' or 'hardlink') says how to copy the source
+  files, and snapshot_source_dirs whether to remember the source tree's
+  directories between runs; see stage_source_tree().
+  Other keyword arguments (e.g. content_hash_freshness, jobs) are passed on
+  to run_basic().
 
   Usage:
   for do in run(srcdir, build_system_sources):
@@ -256,15 +1300,19 @@ def run(srcdir, build_system_sources, builds_dir = None, exclude_src_files = exc
     raise OSError("You can't use / as your src dir in this wrapper because it would obviously have to include the build dir and be copied into itself!")
   if builds_dir == None:
     builds_dir = default_builds_dir_name(srcdir)
-  for building_dir, do in run_basic(builds_dir, build_system_sources):
+  snapshot_file = (abspath(join(builds_dir, 'src-snapshot'))
+                   if snapshot_source_dirs else None)
+  for building_dir, do in run_basic(builds_dir, build_system_sources, **run_basic_options):
     with utils.pushd(building_dir):
       # set up src
       buildsrcdir = 'src' #join(building_dir, 'src')
-      for filepath in utils.relpath_files_under(srcdir):
-        if not exclude_src_files(filepath):
-          for [src], [dest] in do([join(srcdir, filepath)], [join(buildsrcdir, filepath)]):
-            copyfile(src, dest)
+      # (This waits for all the files to be there: the build code will
+      #  expect to be able to look around in src/.)
+      stage_source_tree(do, srcdir, buildsrcdir, exclude_src_files,
+                        staging, snapshot_file)
       # run the build
       yield do
+      # Rules running in parallel use relative paths too.
+      do.wait()
 
 
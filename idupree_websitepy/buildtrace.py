@@ -0,0 +1,149 @@
+"""
+Records where build time goes, for buildsystem.
+
+A BuildTrace gets one record per 'do' rule (its sources, dests, wall time,
+and whether it was executed or its outputs were reused, and from where),
+plus named spans for other phases of a build (e.g. Lua generation),
+and counters such as the buildsystem's stat cache hits (metrics).
+It can write them as a Chrome trace (the JSON format read by
+chrome://tracing and https://ui.perfetto.dev ) and summarize them:
+time per outcome and per kind of rule, the slowest rules, and the
+critical path through the rule dependency graph (a rule depends on the
+rules whose dests are its sources).
+"""
+
+import time, threading, json
+from contextlib import contextmanager
+
+from . import utils
+from .utils import normpath
+
+class RuleRecord(object):
+  def __init__(self, name, sources, dests, outcome, start, end, thread):
+    self.name = name
+    self.sources = sources
+    self.dests = dests
+    self.outcome = outcome
+    self.start = start
+    self.end = end
+    self.thread = thread
+  @property
+  def duration(self):
+    return self.end - self.start
+
+  def kind(self):
+    """name, or failing that, the first dest's top-level directory"""
+    if self.name != None: return self.name
+    if len(self.dests) == 0: return '(no dests)'
+    return normpath(self.dests[0]).split('/')[0]
+
+class BuildTrace(object):
+  def __init__(self):
+    self._epoch = time.perf_counter()
+    self._lock = threading.Lock()
+    self._thread_numbers = {}
+    self.rules = []
+    # [(name, start, end, thread)]
+    self.spans = []
+    # {name: number}
+    self.metrics = {}
+
+  def now(self):
+    """seconds since this trace started"""
+    return time.perf_counter() - self._epoch
+
+  def _thread(self):
+    ident = threading.get_ident()
+    with self._lock:
+      return self._thread_numbers.setdefault(ident, len(self._thread_numbers) + 1)
+
+  def record_rule(self, name, sources, dests, outcome, start):
+    """start: from now(), when the rule started.  It ends now."""
+    record = RuleRecord(name, list(sources), list(dests), outcome,
+                        start, self.now(), self._thread())
+    with self._lock:
+      self.rules.append(record)
+
+  @contextmanager
+  def span(self, name):
+    start = self.now()
+    try:
+      yield
+    finally:
+      record = (name, start, self.now(), self._thread())
+      with self._lock:
+        self.spans.append(record)
+
+  def chrome_trace(self):
+    def us(seconds): return round(seconds * 1e6)
+    events = []
+    for r in self.rules:
+      events.append({'name': r.kind() + ': ' + ' '.join(r.dests), 'cat': r.outcome,
+        'ph': 'X', 'ts': us(r.start), 'dur': us(r.duration), 'pid': 1, 'tid': r.thread,
+        'args': {'sources': r.sources, 'dests': r.dests, 'outcome': r.outcome}})
+    for name, start, end, thread in self.spans:
+      events.append({'name': name, 'cat': 'phase', 'ph': 'X',
+        'ts': us(start), 'dur': us(end - start), 'pid': 1, 'tid': thread})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': self.metrics}
+
+  def slowest(self, n):
+    return sorted(self.rules, key=lambda r: r.duration, reverse=True)[:n]
+
+  def critical_path(self):
+    """
+    Returns the chain of rules, each producing a source of the next,
+    with the largest total duration.
+    """
+    # Rules can only depend on rules that finished before they started.
+    rules = sorted(self.rules, key=lambda r: r.start)
+    producer = {}   # dest -> index into rules
+    best = []       # index -> (total duration of best chain ending here, prev index)
+    for i, r in enumerate(rules):
+      deps = {producer[s] for s in map(normpath, r.sources) if s in producer}
+      prev = max(deps, key=lambda j: best[j][0], default=None)
+      best.append((r.duration + (best[prev][0] if prev != None else 0), prev))
+      for d in map(normpath, r.dests):
+        producer[d] = i
+    if len(best) == 0: return []
+    i = max(range(len(best)), key=lambda j: best[j][0])
+    path = []
+    while i != None:
+      path.append(rules[i])
+      i = best[i][1]
+    return list(reversed(path))
+
+  def summary(self, n = 20):
+    lines = []
+    def totals(title, key):
+      lines.append(title)
+      groups = {}
+      for r in self.rules:
+        count, secs = groups.get(key(r), (0, 0.0))
+        groups[key(r)] = (count + 1, secs + r.duration)
+      for k, (count, secs) in sorted(groups.items(), key=lambda kv: -kv[1][1]):
+        lines.append('  {:9.3f}s {:7d}  {}'.format(secs, count, k))
+    lines.append('{} rules; wall time {:.3f}s'.format(len(self.rules), self.now()))
+    totals('time per outcome:', lambda r: r.outcome)
+    totals('time per kind of rule:', lambda r: r.kind())
+    if self.metrics:
+      lines.append('metrics:')
+      for name, value in sorted(self.metrics.items()):
+        lines.append('  {:>10}  {}'.format(value, name))
+    if self.spans:
+      lines.append('phases:')
+      for name, start, end, thread in self.spans:
+        lines.append('  {:9.3f}s  {}'.format(end - start, name))
+    lines.append('slowest {} rules:'.format(n))
+    for r in self.slowest(n):
+      lines.append('  {:9.3f}s  {} [{}] {}'.format(r.duration, r.kind(), r.outcome, ' '.join(r.dests)))
+    path = self.critical_path()
+    lines.append('critical path ({:.3f}s over {} rules):'.format(
+      sum(r.duration for r in path), len(path)))
+    for r in path:
+      lines.append('  {:9.3f}s  {} [{}] {}'.format(r.duration, r.kind(), r.outcome, ' '.join(r.dests)))
+    return '\n'.join(lines) + '\n'
+
+  def write(self, trace_path, summary_path = None, n = 20):
+    utils.write_file_text_atomically(trace_path, json.dumps(self.chrome_trace()))
+    if summary_path != None:
+      utils.write_file_text_atomically(summary_path, self.summary(n))
@@ -0,0 +1,205 @@
+"""
+Explains which buildsystem rules the next build would rerun, and why,
+without running anything.
+
+Each successful run_basic(..., rule_log=True) leaves a RuleLog in
+builds_dir: every rule's sources, dests and what the mtime check
+compared (its sources' mtimes, the build_system_sources' and
+code_sources' mtimes, its fingerprint and that fingerprint's virtual
+mtime).  explain() goes through those rules in the order they finished,
+stats their inputs now, and reports each rule whose dests wouldn't be
+up to date: a dest is missing or was modified, or a source's, build
+system source's or code source's mtime changed.  The dests of rules
+that would rerun count as having the mtime they'd get.  It only stats
+files, so it's cheap enough to run before every build, e.g. from
+inotify_daemon.
+
+What it can't see: rules that the build would declare for the first
+time (e.g. for new source files), fingerprints that the next build
+would compute differently (computing them means running the build
+script; fingerprint_changes() says which rules the last build reran
+because their fingerprint had changed), rules reused anyway by
+content_hash_freshness or the output cache, and what dests that are
+hard links to each other (e.g. with hardlink staging) do to each other's
+mtimes, which can make it report more rules than would rerun.
+
+Usage: python -m idupree_websitepy.explain <builds_dir>
+"""
+
+import sys, threading
+from os import stat
+from os.path import join, dirname
+
+from . import utils
+from .utils import normpath
+
+_format_version = 2
+
+def _mtime_or_ancestor_mtime(fpath):
+  # (as in buildsystem)
+  while True:
+    try: return stat(fpath).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+      if fpath == dirname(fpath): return 0
+      fpath = dirname(fpath)
+
+def _mtime_opt(fpath):
+  try: return stat(fpath).st_mtime_ns
+  except (FileNotFoundError, NotADirectoryError): return None
+
+class RuleLog(object):
+  """
+  Collects the rules of one run.  Paths inside building_dir are kept
+  relative to it, so that they can be found in the build dir it becomes.
+  """
+  def __init__(self, path, building_dir, build_system_sources, code_sources):
+    self.path = path
+    self._prefix = normpath(building_dir) + '/'
+    self._build_system_sources = {p: _mtime_or_ancestor_mtime(p) for p in build_system_sources}
+    self._code_sources = {p: _mtime_or_ancestor_mtime(p) for p in code_sources}
+    self._rules = []
+    self._lock = threading.Lock()
+
+  def _name(self, fpath):
+    return fpath[len(self._prefix):] if fpath.startswith(self._prefix) else fpath
+
+  def record(self, sources, dests, implicit, fixed_mtime, mtime, build_system = True,
+             fingerprint = None, fingerprint_changed = False):
+    """
+    sources: [(absolute normalized path, mtime)]
+    dests: absolute normalized paths.
+    implicit: 'code' if code_sources were sources of the rule, else
+      other sources like 'sources' (e.g. discovered ones).
+    fixed_mtime: the mtime of the rule's fingerprint, or None.
+    mtime: what the dests' mtime was set to.
+    build_system: whether build_system_sources were sources of the rule.
+    fingerprint: the rule's fingerprint, or None.
+    fingerprint_changed: whether the previous run built the rule with
+      another fingerprint.
+    """
+    rule = {
+      'sources': [[self._name(s), m] for s, m in sources],
+      'dests': [self._name(d) for d in dests],
+      'implicit': implicit if implicit == 'code' else
+                  [[self._name(s), m] for s, m in implicit],
+      'fixed_mtime': fixed_mtime,
+      'build_system': build_system,
+      'mtime': mtime,
+      'fingerprint': fingerprint,
+      'fingerprint_changed': fingerprint_changed,
+      }
+    with self._lock:
+      self._rules.append(rule)
+
+  def save(self):
+    utils.write_json_atomically(self.path, {
+      'version': _format_version,
+      'build_system_sources': self._build_system_sources,
+      'code_sources': self._code_sources,
+      'rules': self._rules,
+      })
+
+def _read_log(builds_dir):
+  log = utils.read_json_or(join(builds_dir, 'rule-log'), {})
+  return log if log.get('version') == _format_version else None
+
+def fingerprint_changes(builds_dir):
+  """
+  Returns [(dests, fingerprint)] for the rules whose fingerprint had
+  changed since the build before the last one (so the last build reran
+  them), or None if there is no log of a previous build.
+  """
+  log = _read_log(builds_dir)
+  if log == None:
+    return None
+  return [(rule['dests'], rule['fingerprint'])
+          for rule in log['rules'] if rule['fingerprint_changed']]
+
+def explain(builds_dir):
+  """
+  Returns [(dests, [reason, ...])] for the rules that the next build
+  would rerun, in the order the last build finished them, or None if
+  there is no log of a previous build.
+  """
+  log = _read_log(builds_dir)
+  if log == None:
+    return None
+  build_dir = join(builds_dir, 'build')
+  def path(name):
+    return join(build_dir, name) if not name.startswith('/') else name
+  # {dest of a rule that would rerun: the mtime it would get}
+  predicted = {}
+  def changes(kind, old_mtimes):
+    result = []
+    latest = 0
+    for name, old in old_mtimes:
+      if name in predicted:
+        now = predicted[name]
+        what = 'source would be rebuilt'
+      else:
+        now = _mtime_or_ancestor_mtime(path(name))
+        what = kind + ' changed'
+      latest = max(latest, now)
+      if now != old:
+        result.append('{}: {} (mtime {} -> {})'.format(
+          what, name, _show_mtime(old), _show_mtime(now)))
+    return latest, result
+  build_system_latest, build_system_changes = \
+    changes('build system source', log['build_system_sources'].items())
+  code_latest, code_changes = changes('code source', log['code_sources'].items())
+  result = []
+  for rule in log['rules']:
+    latest, source_changes = changes('source', rule['sources'])
+    latest = max(latest, rule['fixed_mtime'] or 0)
+    if rule['build_system']:
+      latest = max(latest, build_system_latest)
+    if rule['implicit'] == 'code':
+      latest = max(latest, code_latest)
+      implicit_changes = code_changes
+    else:
+      implicit_latest, implicit_changes = changes('used file', rule['implicit'])
+      latest = max(latest, implicit_latest)
+    # The check 'do' does.
+    dest_mtimes = [_mtime_opt(path(dest)) for dest in rule['dests']]
+    if all(m == latest for m in dest_mtimes):
+      continue
+    reasons = []
+    for dest, dest_mtime in zip(rule['dests'], dest_mtimes):
+      if dest_mtime == None:
+        reasons.append('missing dest: ' + dest)
+      elif dest_mtime != rule['mtime'] and dest_mtime != latest:
+        reasons.append('dest modified: ' + dest)
+    if latest != rule['mtime']:
+      reasons.extend(source_changes + implicit_changes)
+      if rule['build_system']:
+        reasons.extend(build_system_changes)
+    for dest in rule['dests']:
+      predicted[dest] = latest
+    result.append((rule['dests'], reasons))
+  return result
+
+def _show_mtime(ns):
+  return '{:.9f}'.format(ns / 1e9)
+
+def format_explanation(explanation, fingerprint_changes = None):
+  if explanation == None:
+    return 'No log of a previous build.\n'
+  lines = []
+  for dests, fingerprint in fingerprint_changes or ():
+    lines.append(' '.join(dests) + ':')
+    lines.append('  fingerprint changed in the last build (now {})'.format(fingerprint))
+  for dests, reasons in explanation:
+    lines.append(' '.join(dests) + ':')
+    lines.extend('  ' + reason for reason in reasons)
+  lines.append('{} rules would rerun.'.format(len(explanation)))
+  return '\n'.join(lines) + '\n'
+
+def main():
+  if len(sys.argv) == 2 and sys.argv[1] != '--help':
+    sys.stdout.write(format_explanation(explain(sys.argv[1]),
+                                        fingerprint_changes(sys.argv[1])))
+  else:
+    sys.stderr.write('{} <builds_dir>\n  explains which build rules would rerun\n'.format(sys.argv[0]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,140 @@
+"""
+Rule fingerprints for buildsystem.
+
+By default every 'do' rule depends on all of the build's Python code
+(code_sources), so editing any of it rebuilds everything.  A rule can
+instead say exactly what code and tools it depends on, by passing
+do(..., fingerprint=fingerprint(some_function, some_module,
+tool_version('pandoc', '--version'))).  Then it's rebuilt when that
+fingerprint changes rather than when code_sources do.
+
+The buildsystem compares mtimes, and the rules that use a rebuilt file
+must see it as modified, so a fingerprint acts as a virtual source file
+of its rule.  Fingerprints remembers, per rule (identified by its dests,
+as in freshness_db), the fingerprint it was last built with, that
+virtual file's mtime and the dests' mtime.  When the fingerprint
+changes, the virtual file's mtime becomes the next whole second after
+the dests' old mtime (not the current time, which would be newer than
+sources restored later with their older mtimes).
+"""
+
+import sys, hashlib, inspect, marshal, subprocess, threading
+
+from . import utils
+
+_format_version = 1
+
+_lock = threading.Lock()
+# {code object, module name or command: text}
+_cache = {}
+
+def _cached(key, compute):
+  with _lock:
+    if key in _cache: return _cache[key]
+  value = compute()
+  with _lock:
+    return _cache.setdefault(key, value)
+
+def _function_text(f):
+  code = getattr(f, '__code__', None)
+  if code == None:
+    # (e.g. builtins; their behaviour only changes with Python)
+    return 'builtin ' + getattr(f, '__qualname__', repr(f)) + ' ' + sys.version
+  def compute():
+    try: return inspect.getsource(f)
+    except (OSError, TypeError): return marshal.dumps(code).hex()
+  return _cached(code, compute)
+
+def _module_text(m):
+  path = getattr(m, '__file__', None)
+  if path == None:
+    return 'builtin module ' + m.__name__ + ' ' + sys.version
+  return _cached(m.__name__, lambda: utils.read_file_binary(path).decode('utf-8', 'replace'))
+
+def tool_version(*command):
+  """
+  The output of e.g. tool_version('pandoc', '--version'), run once per
+  process, or a note that the tool couldn't be run.
+  """
+  def compute():
+    try:
+      p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+      return 'cannot run {}: {}'.format(command[0], e.strerror)
+    return p.stdout.decode('utf-8', 'replace')
+  return _cached(command, compute)
+
+def fingerprint(*parts):
+  """
+  A hex digest of parts: functions (and classes) contribute their
+  source code, modules their file's contents, and str or bytes
+  themselves (e.g. a tool_version()).  Functions' source doesn't include
+  the functions they call; list those too if they might change.
+  """
+  h = hashlib.sha384()
+  for part in parts:
+    if isinstance(part, bytes):
+      text = part
+    elif isinstance(part, str):
+      text = part.encode('utf-8')
+    elif inspect.ismodule(part):
+      text = _module_text(part).encode('utf-8')
+    elif inspect.isclass(part):
+      text = _cached(part, lambda: inspect.getsource(part)).encode('utf-8')
+    elif callable(part):
+      text = _function_text(part).encode('utf-8')
+    else:
+      raise TypeError("can't fingerprint " + repr(part))
+    h.update(str(len(text)).encode('ascii') + b':' + text)
+  return h.hexdigest()
+
+def _rule_key(dests):
+  return '\0'.join(dests)
+
+class Fingerprints(object):
+  def __init__(self, path = None):
+    """
+    path: the file to remember rules' fingerprints in, which needn't exist
+    yet, or None to keep them only as long as this object.
+    """
+    self.path = path
+    old = utils.read_json_or(path, {}) if path != None else {}
+    if old.get('version') != _format_version:
+      old = {}
+    self._old_rules = old.get('rules', {})
+    self._rules = {}
+    self._lock = threading.Lock()
+
+  def mtime(self, dests, fingerprint):
+    """The mtime (in ns) of the rule's virtual source file."""
+    old = self._old_rules.get(_rule_key(dests))
+    if old == None:
+      # (Any dests already there were built before fingerprints were
+      # recorded for them, and are checked against their sources.)
+      return 0
+    if old['fingerprint'] == fingerprint:
+      return old['mtime']
+    # (Whole seconds, so that filesystems with coarser mtimes
+    # than nanoseconds can store it.)
+    return (old['dests_mtime'] // 10**9 + 1) * 10**9
+
+  def changed(self, dests, fingerprint):
+    """Whether the rule was last built with another fingerprint."""
+    old = self._old_rules.get(_rule_key(dests))
+    return old != None and old['fingerprint'] != fingerprint
+
+  def record(self, dests, fingerprint, mtime, dests_mtime):
+    with self._lock:
+      self._rules[_rule_key(dests)] = {
+        'fingerprint': fingerprint, 'mtime': mtime, 'dests_mtime': dests_mtime}
+
+  def count(self):
+    return len(self._rules)
+
+  def save(self):
+    """Saves the rules recorded this run; the others are forgotten."""
+    if self.path == None: return
+    utils.write_json_atomically(self.path, {
+      'version': _format_version,
+      'rules': self._rules,
+      })
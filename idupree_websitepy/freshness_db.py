@@ -0,0 +1,126 @@
+"""
+Content-hash freshness information for buildsystem.
+
+buildsystem decides that a rule's dests are up to date when their mtimes
+equal the max mtime of the rule's sources.  A `git checkout`, `touch`,
+or an rsync that preserves contents but not mtimes makes that check fail
+for everything, even though nothing really changed.
+
+A FreshnessDB remembers, for each rule (identified by its dests), a digest
+of the contents of all its inputs and the identity of the output files
+it produced.  When the mtime check fails, buildsystem can ask the
+FreshnessDB whether the inputs still hash the same and the previously
+built outputs are untouched, and if so reuse them anyway.
+
+Content digests are cached keyed by (st_dev, st_ino, st_size, st_mtime_ns)
+so that files that haven't changed aren't re-read.  The database is a single
+file per builds_dir.  Entries that aren't used in a run are dropped when
+the database is saved at the end of that run.
+"""
+
+import hashlib
+from os import stat
+from os.path import join
+
+from . import utils
+
+_format_version = 1
+
+def _stat_key(st):
+  return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _stat_key_opt(fpath):
+  try: return _stat_key(stat(fpath))
+  except (FileNotFoundError, NotADirectoryError): return None
+
+def _rule_key(dests):
+  return '\0'.join(dests)
+
+class FreshnessDB(object):
+  def __init__(self, path):
+    """
+    path: the database file.  It needn't exist yet.
+    """
+    self.path = path
+    old = utils.read_json_or(path, {})
+    if old.get('version') != _format_version:
+      old = {}
+    self._old_digests = old.get('digests', {})
+    self._old_rules = old.get('rules', {})
+    self._digests = {}
+    self._rules = {}
+
+  def digest(self, fpath):
+    """
+    Returns a hex digest of fpath's contents (directories are hashed
+    as in utils.sha384file), or None if fpath doesn't exist.
+    """
+    try: st = stat(fpath)
+    except (FileNotFoundError, NotADirectoryError): return None
+    key = _stat_key(st)
+    d = self._digests.get(key) or self._old_digests.get(key)
+    if d == None:
+      d = utils.sha384file(fpath).hexdigest()
+    self._digests[key] = d
+    return d
+
+  def inputs_digest(self, sources, fingerprint = None):
+    """
+    A digest of the names and contents of all the sources (including
+    build-system sources) of a rule, and of its fingerprint, if any.
+    """
+    h = hashlib.sha384()
+    if fingerprint != None:
+      h.update(b'fingerprint\0' + fingerprint.encode('utf-8') + b'\n')
+    for source in sources:
+      h.update(source.encode('utf-8') + b'\0' +
+               (self.digest(source) or '-').encode('ascii') + b'\n')
+    return h.hexdigest()
+
+  def reusable(self, dests, inputs_digest, built_dir):
+    """
+    Whether join(built_dir, dest) for all dests are the very files that
+    were produced the last time this rule ran with these same inputs.
+    """
+    old = self._old_rules.get(_rule_key(dests))
+    if old == None or old['inputs'] != inputs_digest:
+      return False
+    return old['outputs'] == [_stat_key_opt(join(built_dir, dest)) for dest in dests]
+
+  def carry_forward(self, dests, built_dir):
+    """
+    Keeps the record for a rule whose outputs were reused by mtime.
+    Returns False (and keeps nothing) if there is no matching record.
+    """
+    key = _rule_key(dests)
+    old = self._old_rules.get(key)
+    if old == None or old['outputs'] != [
+        _stat_key_opt(join(built_dir, dest)) for dest in dests]:
+      return False
+    self._rules[key] = old
+    return True
+
+  def stat_keys(self, fpaths):
+    return [_stat_key_opt(fpath) for fpath in fpaths]
+
+  def record(self, dests, inputs_digest, previous_output_keys = None):
+    """
+    Records that dests (as they are now) were produced from inputs
+    with inputs_digest.  If the dests are old outputs that just had their
+    mtime changed, pass their stat keys from before the change as
+    previous_output_keys so that their cached content digests carry over.
+    """
+    outputs = self.stat_keys(dests)
+    if previous_output_keys != None:
+      for old_key, new_key in zip(previous_output_keys, outputs):
+        d = self._digests.get(old_key) or self._old_digests.get(old_key)
+        if d != None and new_key != None:
+          self._digests[new_key] = d
+    self._rules[_rule_key(dests)] = {'inputs': inputs_digest, 'outputs': outputs}
+
+  def save(self):
+    utils.write_json_atomically(self.path, {
+      'version': _format_version,
+      'digests': self._digests,
+      'rules': self._rules,
+      })
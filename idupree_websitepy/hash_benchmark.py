@@ -0,0 +1,51 @@
+"""
+Compares how fast hash algorithms (see utils.new_hash) hash the files
+under a directory, e.g. a site's resources, for choosing
+Config.content_hash_algorithm.  Each algorithm's time is the best of a
+few runs, so the files are mostly hashed from the page cache.
+
+Usage: python -m idupree_websitepy.hash_benchmark [--jobs N] <dir> [algorithm ...]
+"""
+
+import sys, os, time
+
+from . import utils
+from .utils import join
+
+default_algorithms = ['sha384', 'sha256', 'blake2b-256', 'blake2b', 'blake2s', 'sha3_256']
+
+def benchmark(paths, algorithms = default_algorithms, jobs = None, repeat = 3):
+  """
+  Returns (total bytes, [(algorithm, bytes per second)]) for hashing
+  paths with utils.hashfiles.
+  """
+  total = sum(os.stat(path).st_size for path in paths)
+  results = []
+  for algorithm in algorithms:
+    best = None
+    for _ in range(repeat):
+      start = time.perf_counter()
+      utils.hashfiles(paths, algorithm, jobs = jobs)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best == None else min(best, elapsed)
+    results.append((algorithm, total / best if best > 0 else float('inf')))
+  return total, results
+
+def main():
+  args = sys.argv[1:]
+  jobs = None
+  if args[:1] == ['--jobs'] and len(args) >= 2:
+    jobs = int(args[1])
+    args = args[2:]
+  if len(args) == 0 or args[0] == '--help':
+    sys.stderr.write('{} [--jobs N] <dir> [algorithm ...]\n'
+                     '  compares hash algorithms on the files under dir\n'.format(sys.argv[0]))
+    return
+  paths = [join(args[0], f) for f in utils.relpath_files_under(args[0])]
+  total, results = benchmark(paths, args[1:] or default_algorithms, jobs)
+  print('{} files, {:.1f} MB, jobs={}'.format(len(paths), total / 1e6, jobs))
+  for algorithm, speed in sorted(results, key=lambda result: -result[1]):
+    print('{:>14} {:10.1f} MB/s'.format(algorithm, speed / 1e6))
+
+if __name__ == "__main__":
+  main()
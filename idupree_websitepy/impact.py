@@ -0,0 +1,62 @@
+"""
+Answers "which files change if I edit these?" from the records the last
+build's ResourceRewriter saved, without building: the rewritable files
+(pages, and the CSS and JS that rr-refer to things) that refer to the
+edited files through any chain of ?rr refs, so that their rewritten
+output changes (see resource_rewriting.ReferencerIndex).  That's what
+an incremental rebuild, a targeted test run or a CDN purge needs to
+cover.
+
+Files are named relative to the built site directory (e.g. style.css,
+not the source it was compiled from).
+
+Usage: python -m idupree_websitepy.impact [--direct] <builds_dir> <file> ...
+  --direct: instead, list the files that directly rr-refer to each file.
+"""
+
+import sys
+from os.path import join, isfile
+
+from . import record_store
+from .resource_rewriting import ReferencerIndex, deserialize_paths
+
+def referencer_index(builds_dir, rr_cache_dir = 'rr'):
+  """
+  (the ReferencerIndex of the last build in builds_dir, its rewritable files)
+  Raises FileNotFoundError if there are no records there.
+  """
+  path = join(builds_dir, 'build', rr_cache_dir, 'index.sqlite')
+  if not isfile(path):
+    raise FileNotFoundError(path)
+  def deps(kind):
+    return {f: deserialize_paths(value.decode('utf-8'))
+            for f, value in record_store.read_records(path, kind).items()}
+  rewritable_deps = deps('direct-deps')
+  dir_deps = deps('dir-deps')
+  return (ReferencerIndex(dict(rewritable_deps, **dir_deps), dir_deps),
+          frozenset(rewritable_deps))
+
+def main():
+  args = sys.argv[1:]
+  direct = args[:1] == ['--direct']
+  if direct: args = args[1:]
+  usage = ('{} [--direct] <builds_dir> <file> ...\n'
+           '  lists the rewritable files that change if files are edited\n'.format(sys.argv[0]))
+  if len(args) < 2 or args[0] == '--help':
+    sys.stderr.write(usage)
+    return
+  try:
+    index, rewritable_files = referencer_index(args[0])
+  except FileNotFoundError as e:
+    sys.stderr.write(usage + 'No records of a build at {} (has {} been built?)\n'.format(
+                     e.args[0], args[0]))
+    sys.exit(2)
+  if direct:
+    for f in args[1:]:
+      sys.stdout.write(f + ':\n' + ''.join('  ' + g + '\n' for g in sorted(index.direct(f))))
+  else:
+    for f in sorted(index.affected(args[1:]) & rewritable_files):
+      sys.stdout.write(f + '\n')
+
+if __name__ == "__main__":
+  main()
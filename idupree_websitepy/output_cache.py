@@ -0,0 +1,139 @@
+"""
+A content-addressed cache of build rules' outputs, for buildsystem,
+that can be shared between builds_dirs, branches and machines.
+
+A rule's key is a digest of its fingerprint (see fingerprints.py), its
+dests' names, and the contents of its sources (and, by name, which
+sources they are) and of the build_system_sources and other implicit
+sources (only by contents, since those are absolute paths that differ
+between machines).  When 'do' would execute a rule, it first asks the
+cache for that key, and if the cache has it, restores the dests from
+there instead.  Otherwise it stores the dests once the rule has run.
+
+Backends have
+  get(key, dests): restores the dests; returns whether the key was there
+  put(key, dests): stores the dests under key
+  trim(): evicts entries if the cache is too big (called once per run)
+  metrics(): a dict of counters, for buildtrace
+LocalDirectoryCache is the only one so far; one on a shared filesystem
+can serve several machines.
+"""
+
+import os, hashlib, threading, tempfile
+from os.path import join, exists
+from shutil import rmtree
+
+from . import utils
+
+def rule_key(fingerprint, dests, named_digests, other_digests):
+  """
+  named_digests: [(source as named by the rule, its content digest or None)]
+  other_digests: content digests of the other sources (e.g. build
+  system sources) in a consistent order.
+  """
+  h = hashlib.sha384()
+  h.update(b'fingerprint\0' + (fingerprint or '-').encode('utf-8') + b'\n')
+  for dest in dests:
+    h.update(b'dest\0' + dest.encode('utf-8') + b'\n')
+  for name, digest in named_digests:
+    h.update(b'source\0' + name.encode('utf-8') + b'\0' + (digest or '-').encode('ascii') + b'\n')
+  for digest in other_digests:
+    h.update(b'other\0' + (digest or '-').encode('ascii') + b'\n')
+  return h.hexdigest()
+
+class LocalDirectoryCache(object):
+  """
+  Keeps each entry in path/<first two hex digits of key>/<key>/, holding
+  the dests as files named 0, 1, ...  An entry directory's mtime is when
+  it was last stored or restored; trim() removes the least recently used
+  entries until the total size of the entries is at most max_bytes
+  (None: unlimited).
+
+  Entries are written to a temporary directory and renamed into place,
+  so several builds can share the cache at once.
+  """
+  def __init__(self, path, max_bytes = None):
+    self.path = os.path.abspath(path)
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.stores = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    os.makedirs(self.path, exist_ok=True)
+
+  def _entry(self, key):
+    return join(self.path, key[:2], key)
+
+  def _count(self, counter):
+    with self._lock:
+      setattr(self, counter, getattr(self, counter) + 1)
+
+  def get(self, key, dests):
+    entry = self._entry(key)
+    try:
+      for i, dest in enumerate(dests):
+        utils.clone_file(join(entry, str(i)), dest)
+      os.utime(entry)
+    except FileNotFoundError:
+      # (Not there, or evicted by another build while we were copying.)
+      for dest in dests:
+        try: os.unlink(dest)
+        except FileNotFoundError: pass
+      self._count('misses')
+      return False
+    self._count('hits')
+    return True
+
+  def put(self, key, dests):
+    entry = self._entry(key)
+    if exists(entry):
+      os.utime(entry)
+      return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+    try:
+      for i, dest in enumerate(dests):
+        utils.clone_file(dest, join(tmp, str(i)))
+      utils.write_file_text(join(tmp, 'dests'), '\n'.join(dests))
+      try:
+        os.rename(tmp, entry)
+      except OSError:
+        # (Another build stored the same entry first.)
+        pass
+      else:
+        self._count('stores')
+    finally:
+      if exists(tmp): rmtree(tmp)
+
+  def trim(self):
+    if self.max_bytes == None: return
+    entries = []
+    total = 0
+    for prefix in os.listdir(self.path):
+      prefix_dir = join(self.path, prefix)
+      if prefix.startswith('.') or not os.path.isdir(prefix_dir): continue
+      for key in os.listdir(prefix_dir):
+        entry = join(prefix_dir, key)
+        try:
+          size = sum(os.stat(join(entry, f)).st_size for f in os.listdir(entry))
+          entries.append((os.stat(entry).st_mtime_ns, size, entry))
+        except FileNotFoundError:
+          continue
+        total += size
+    for mtime, size, entry in sorted(entries):
+      if total <= self.max_bytes: break
+      # (Renamed first so that no one sees a half-removed entry.)
+      doomed = tempfile.mkdtemp(prefix='.evicted-', dir=self.path)
+      try:
+        os.rename(entry, join(doomed, 'entry'))
+      except FileNotFoundError:
+        pass
+      else:
+        total -= size
+        self._count('evictions')
+      rmtree(doomed)
+
+  def metrics(self):
+    return {'output_cache_hits': self.hits, 'output_cache_misses': self.misses,
+            'output_cache_stores': self.stores, 'output_cache_evictions': self.evictions}
@@ -0,0 +1,66 @@
+-- The worker process of pandoc_pool.py, run as: pandoc lua pandoc-worker.lua
+--
+-- Each line of stdin is a JSON request {"src": ..., "dest": ..., "template": ...}
+-- (template is optional), which it renders the way
+--   pandoc --standalone [--template=TEMPLATE] -t html5 -V outputfile=DEST SRC
+-- would.  It answers each with a line of JSON: {"html": the output} or
+-- {"error": message}.
+
+local json = require 'pandoc.json'
+
+-- What pandoc's command line does to text input before reading it:
+-- drop a byte order mark and carriage returns, expand tabs (to tab
+-- stops of 4) and end the last line.
+local function expand_tabs(line)
+  local out, column = {}, 0
+  for part, tab in line:gmatch('([^\t]*)(\t?)') do
+    out[#out + 1] = part
+    column = column + utf8.len(part)
+    if tab ~= '' then
+      out[#out + 1] = string.rep(' ', 4 - column % 4)
+      column = column + 4 - column % 4
+    end
+  end
+  return table.concat(out)
+end
+
+local function input_text(data)
+  if data:sub(1, 3) == '\239\187\191' then data = data:sub(4) end
+  data = data:gsub('\r', '')
+  if data ~= '' and data:sub(-1) ~= '\n' then data = data .. '\n' end
+  return (data:gsub('[^\n]*\t[^\n]*', expand_tabs))
+end
+
+local function read_file(path)
+  local f = assert(io.open(path, 'rb'))
+  local data = f:read('a')
+  f:close()
+  return data
+end
+
+local function render(request)
+  local template
+  if request.template then
+    template = pandoc.template.compile(read_file(request.template), request.template)
+  else
+    template = pandoc.template.compile(pandoc.template.default('html5'))
+  end
+  -- (--standalone also tells the reader, e.g. for the markdown reader's
+  -- handling of a title block.)
+  local doc = pandoc.read(input_text(read_file(request.src)), 'markdown',
+                          pandoc.ReaderOptions{standalone = true})
+  return pandoc.write(doc, 'html5', pandoc.WriterOptions{
+    template = template,
+    variables = {
+      sourcefile = request.src,
+      outputfile = request.dest,
+      ['pandoc-version'] = tostring(PANDOC_VERSION),
+    },
+  })
+end
+
+for line in io.lines() do
+  local ok, result = pcall(render, json.decode(line))
+  io.stdout:write(json.encode(ok and {html = result} or {error = tostring(result)}), '\n')
+  io.stdout:flush()
+end
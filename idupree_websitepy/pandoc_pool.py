@@ -0,0 +1,197 @@
+"""
+Renders markdown with a few long-lived pandoc processes instead of
+starting a pandoc for each document, which for many short documents
+is most of the time pandoc takes.
+
+Each worker is 'pandoc lua pandoc-worker.lua' (pandoc 3.1.1 or later),
+which renders one document after another the way command_line() does.
+A document goes to the workers only once its templates and each
+markdown feature it looks like it uses (math, code, raw HTML, citations,
+...; see document_features()) have been seen in a few documents that
+were also rendered by command_line() and came out the same byte for
+byte; until then it's rendered both ways.  If the two differ (e.g. with
+a pandoc whose command line does something the worker doesn't) or the
+workers can't be started, the pool warns and runs command_line() for
+every document instead.  With check_documents=None every document is
+checked, and command_line()'s output kept, e.g. to try the workers
+with a new pandoc version on a whole site.
+"""
+
+import os, re, sys, json, threading, subprocess
+from os.path import dirname
+
+from . import autodeps
+from .utils import join
+
+worker_script = join(dirname(os.path.abspath(__file__)), 'pandoc-worker.lua')
+
+def command_line(pandoc_command, src, dest, templates = ()):
+  """
+  The pandoc command that renders markdown src to standalone HTML on
+  stdout, for dest (which templates see as $outputfile$).
+  """
+  return ([pandoc_command, '--standalone'] +
+          ['--template='+t for t in templates] +
+          ['-t', 'html5', '-V', 'outputfile=' + dest, src])
+
+# Markdown that pandoc renders with code of its own (which might be
+# where the worker and the command line differ).  These are loose:
+# false positives only mean more checking.
+_features = [
+  ('math', re.compile(rb'\$|\\[(\[]')),
+  ('code', re.compile(rb'```|~~~|`\{|^(    |\t)', re.M)),
+  ('raw html', re.compile(rb'<[A-Za-z!?/]|&[#A-Za-z]')),
+  ('raw tex', re.compile(rb'\\[A-Za-z]')),
+  ('citations', re.compile(rb'@[\w{]')),
+  ('footnotes', re.compile(rb'\[\^|\^\[')),
+  ('tables', re.compile(rb'\|')),
+  ('metadata', re.compile(rb'^(---|\.\.\.|%)', re.M)),
+  ('attributes', re.compile(rb':::|\{[#.=-]|\{\w+=')),
+  ]
+
+def document_features(data):
+  """The names of the _features that markdown data (bytes) seems to use."""
+  return [name for name, regex in _features if regex.search(data)]
+
+class PandocError(Exception):
+  pass
+
+class _Worker(object):
+  def __init__(self, pandoc_command):
+    self._process = subprocess.Popen([pandoc_command, 'lua', worker_script],
+      stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+  def render(self, src, dest, templates):
+    request = {'src': src, 'dest': dest}
+    if len(templates) > 0:
+      request['template'] = templates[-1]
+    self._process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+    self._process.stdin.flush()
+    reply = self._process.stdout.readline()
+    if reply == b'':
+      raise OSError('pandoc worker exited with status {}'.format(self._process.wait()))
+    reply = json.loads(reply.decode('utf-8'))
+    if 'error' in reply:
+      raise PandocError('{}: {}'.format(src, reply['error']))
+    return reply['html'].encode('utf-8')
+
+  def close(self):
+    try:
+      self._process.stdin.close()
+    except OSError:
+      pass
+    self._process.wait()
+
+class PandocPool(object):
+  def __init__(self, pandoc_command = 'pandoc', workers = 1, check_documents = 4):
+    """
+    workers: the most documents to render at once, and so the most
+      pandoc processes to keep (they're started as needed).
+    check_documents: how many documents with the same templates, and
+      how many using each markdown feature, to render both ways and
+      compare before trusting the workers with them (None: all of them).
+    """
+    self._pandoc_command = pandoc_command
+    self._check_all = check_documents == None
+    self._check_documents = check_documents
+    # {('templates', templates) or ('feature', name): documents checked}
+    self._checked = {}
+    self._slots = threading.Semaphore(workers)
+    self._lock = threading.Lock()
+    self._idle = []
+    self._workers = []
+    self._use_workers = True
+
+  def render(self, src, dest, templates = ()):
+    """The output of command_line(pandoc_command, src, dest, templates), as bytes."""
+    command = command_line(self._pandoc_command, src, dest, templates)
+    if not self._use_workers:
+      return autodeps.check_output(command)
+    kinds = self._kinds(src, templates)
+    if kinds != None:
+      with self._slots:
+        html, same = self._check(src, dest, templates, command)
+      if same:
+        with self._lock:
+          for kind in kinds:
+            self._checked[kind] = self._checked.get(kind, 0) + 1
+      return html
+    autodeps.note_command(command)
+    with self._slots:
+      return self._run(src, dest, templates)
+
+  def _kinds(self, src, templates):
+    """
+    What rendering src both ways would check, or None if the workers are
+    trusted with it.
+    """
+    if self._check_all:
+      return []
+    with open(src, 'rb') as f:
+      data = f.read()
+    kinds = ([('templates', tuple(templates))] +
+             [('feature', name) for name in document_features(data)])
+    with self._lock:
+      if all(self._checked.get(kind, 0) >= self._check_documents for kind in kinds):
+        return None
+    return kinds
+
+  def _run(self, src, dest, templates):
+    worker = self._take()
+    try:
+      html = worker.render(src, dest, templates)
+    except PandocError:
+      self._give_back(worker)
+      raise
+    except (OSError, ValueError, KeyError):
+      self._discard(worker)
+      raise
+    self._give_back(worker)
+    return html
+
+  def _check(self, src, dest, templates, command):
+    """
+    Renders src both ways.  Returns (command_line()'s output, whether the
+    worker's was the same); if it wasn't, warns and stops the workers.
+    """
+    expected = autodeps.check_output(command)
+    try:
+      same = self._run(src, dest, templates) == expected
+    except (OSError, ValueError, KeyError, PandocError) as e:
+      sys.stderr.write('WARNING: running pandoc per document: '
+                       'pandoc workers failed: {}\n'.format(e))
+      same = None
+    else:
+      if not same:
+        sys.stderr.write('WARNING: running pandoc per document: '
+                         'pandoc workers rendered {} differently\n'.format(src))
+    if not same:
+      self._use_workers = False
+      self.close()
+    return expected, bool(same)
+
+  def _take(self):
+    with self._lock:
+      if len(self._idle) > 0:
+        return self._idle.pop()
+      worker = _Worker(self._pandoc_command)
+      self._workers.append(worker)
+      return worker
+
+  def _give_back(self, worker):
+    with self._lock:
+      self._idle.append(worker)
+
+  def _discard(self, worker):
+    with self._lock:
+      self._workers.remove(worker)
+    worker.close()
+
+  def close(self):
+    """Stops the workers."""
+    with self._lock:
+      workers = self._workers
+      self._workers = []
+      self._idle = []
+    for worker in workers:
+      worker.close()
@@ -0,0 +1,139 @@
+"""
+A single-file store of many small build records, for ResourceRewriter.
+
+Keeping each record in a file of its own made by 'do' costs a handful of
+syscalls and an inode per record.  A RecordStore keeps them all in one
+sqlite database instead, with the same freshness rule as 'do': each
+record has a stamp, the max mtime of the files it was computed from (or
+of the stamps of the records it was computed from), and a record from
+a previous build is reused only if that stamp is the same now.  The
+stamp also covers which files and records those were, as 'do' rules'
+sources are covered by the build script's mtime.
+
+As with 'do' and building directories, each run writes a new store,
+taking what's still fresh from the stores of previous builds.  Those are
+only consulted if they were made with the same 'config' (a string that
+should change whenever the way records are computed does).
+"""
+
+import os, hashlib, sqlite3
+
+_format_version = 1
+
+class RecordStore(object):
+  def __init__(self, path, previous_paths = (), config = '', mtime_of = lambda path: 0):
+    """
+    path: the database file to write, or ':memory:'.
+    previous_paths: stores from previous builds (those that don't exist
+      are skipped), which can include path.
+    mtime_of: the function that gives the mtimes of files that records
+      are computed from.
+    """
+    self.path = path
+    self._config = config
+    self._mtime_of = mtime_of
+    # {(kind, key): ((latest mtime, inputs digest), value)}
+    self._records = {}
+    self._previous = []
+    for previous_path in previous_paths:
+      try:
+        db = sqlite3.connect('file:' + previous_path + '?mode=ro', uri = True)
+        row = db.execute('SELECT version, config FROM meta').fetchone()
+      except sqlite3.Error:
+        continue
+      if row == (_format_version, config):
+        self._previous.append(db)
+      else:
+        db.close()
+    self.reused = 0
+    self.computed = 0
+
+  def stamp(self, files = (), records = ()):
+    """
+    The stamp of a record computed from files and from records
+    (each a (kind, key) pair already in this store).
+    """
+    h = hashlib.sha1()
+    for f in files:
+      h.update(b'file\0' + f.encode('utf-8') + b'\n')
+    for kind, key in records:
+      h.update(b'record\0' + kind.encode('utf-8') + b'\0' + key.encode('utf-8') + b'\n')
+    return (max([0] + [self._mtime_of(f) for f in files] +
+                      [self._records[record][0][0] for record in records]),
+            h.hexdigest())
+
+  def lookup(self, kind, key, stamp):
+    """
+    The value of the record if it's in this store, or fresh (has this
+    stamp) in a previous one (then it's copied to this store); else None.
+    """
+    record = self._records.get((kind, key))
+    if record != None:
+      return record[1]
+    for db in self._previous:
+      row = db.execute('SELECT latest, inputs, value FROM records WHERE kind = ? AND key = ?',
+                       (kind, key)).fetchone()
+      if row != None and row[:2] == stamp:
+        self._records[(kind, key)] = (stamp, row[2])
+        self.reused += 1
+        return row[2]
+    return None
+
+  def stale(self, kind, key):
+    """
+    The value of the record in a previous store whether it's fresh or
+    not, or None: for updating a record piecewise.
+    """
+    for db in self._previous:
+      row = db.execute('SELECT value FROM records WHERE kind = ? AND key = ?',
+                       (kind, key)).fetchone()
+      if row != None:
+        return row[0]
+    return None
+
+  def mtime(self, path):
+    return self._mtime_of(path)
+
+  def put(self, kind, key, stamp, value):
+    """value: bytes"""
+    self._records[(kind, key)] = (stamp, value)
+    self.computed += 1
+
+  def forget(self, kind, key):
+    """Removes a record from this store, if it's there."""
+    self._records.pop((kind, key), None)
+
+  def get(self, kind, key, default = None):
+    """The value of a record in this store, or default."""
+    record = self._records.get((kind, key))
+    return default if record == None else record[1]
+
+  def save(self):
+    """Writes this store to path, and closes the previous stores."""
+    for db in self._previous:
+      db.close()
+    self._previous = []
+    if self.path == ':memory:': return
+    tmp = self.path + '.tmp'
+    if os.path.exists(tmp): os.unlink(tmp)
+    db = sqlite3.connect(tmp)
+    try:
+      with db:
+        db.execute('CREATE TABLE meta (version INTEGER, config TEXT)')
+        db.execute('INSERT INTO meta VALUES (?, ?)', (_format_version, self._config))
+        db.execute('CREATE TABLE records (kind TEXT, key TEXT, latest INTEGER,'
+                   ' inputs TEXT, value BLOB, PRIMARY KEY (kind, key)) WITHOUT ROWID')
+        db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?)',
+          ((kind, key, latest, inputs, value)
+           for (kind, key), ((latest, inputs), value) in self._records.items()))
+    finally:
+      db.close()
+    os.replace(tmp, self.path)
+
+def read_records(path, kind):
+  """{key: value} for the records of one kind in the store saved at path."""
+  db = sqlite3.connect('file:' + path + '?mode=ro', uri = True)
+  try:
+    return dict(db.execute('SELECT key, value FROM records WHERE kind = ?', (kind,)))
+  finally:
+    db.close()
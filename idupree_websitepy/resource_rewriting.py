@@ -1,9 +1,11 @@
 
-import re, hashlib, base64, os, sys
+import re, hashlib, base64, os, sys, json, itertools
 from os.path import exists, dirname, basename, isdir
 
 from . import urlregexps
 from . import utils
+from . import fingerprints
+from . import record_store
 from .utils import join, normpath, abspath, relpath
 # from . import buildsystem  #not directly used
 
@@ -18,15 +20,94 @@ def joinif(a, b):
   elif a: return a
   else: return b
 
-def direct_rr_deps_of_file(rr_ref_re, fpath, site_files_prefix, origins_to_assume_contain_the_resources):
+default_rr_ref_re = (br'(?<!'+urlregexps.urlbyte+br')'+
+                     br'(?P<ref>'+urlregexps.urlbytes+br')\?rr'+
+                     br'(?!'+urlregexps.urlbyte+br')')
+
+_nonurl_byte_re = re.compile(br'['+urlregexps.nonurl_byteset+br']')
+_nonurl_bytes = frozenset(b for b in range(256) if _nonurl_byte_re.match(bytes([b])))
+
+def _last_nonurl_byte(data, end):
+  """The index of the last non-URL byte in data[:end], or -1."""
+  window = 256
+  while True:
+    start = max(0, end - window)
+    last = -1
+    for match in _nonurl_byte_re.finditer(data, start, end):
+      last = match.start()
+    if last != -1 or start == 0:
+      return last
+    window *= 16
+
+def scan_rr_refs(chunks):
+  """
+  Yields (start, end, ref) for each match of default_rr_ref_re in the
+  bytes that are the concatenation of chunks, just as re.finditer would
+  find them, but faster: a match is a whole run of URL bytes that ends
+  in ?rr, so this looks for ?rr with bytes.find() and then back to the
+  start of its run, rather than trying the regex at every byte.  Only
+  the last, unfinished run of a chunk is kept for the next one.
+  """
+  data = b''
+  # (the position of data in the whole)
+  offset = 0
+  for chunk in itertools.chain(chunks, [None]):
+    if chunk != None:
+      data += chunk
+      # Runs before the last non-URL byte are finished.
+      limit = _last_nonurl_byte(data, len(data))
+      if limit == -1: continue
+    else:
+      limit = len(data)
+    i = data.find(b'?rr', 0, limit)
+    while i != -1:
+      end = i + 3
+      if end == len(data) or data[end] in _nonurl_bytes:
+        start = _last_nonurl_byte(data, i) + 1
+        if start < i:
+          yield (offset + start, offset + end, data[start:i])
+      i = data.find(b'?rr', i + 1, limit)
+    if chunk == None: break
+    data = data[limit + 1:]
+    offset += limit + 1
+
+def _rr_ref_matches(rr_ref_re, fpath):
+  """(start, end, ref) for the matches of rr_ref_re in fpath."""
+  if rr_ref_re == default_rr_ref_re:
+    return scan_rr_refs(utils.read_file_chunks(fpath))
+  return ((match.start(), match.end(), match.group('ref'))
+          for match in re.finditer(rr_ref_re, utils.read_file_binary(fpath)))
+
+class RRRef(object):
+  """
+  A ?rr reference in a file: where it is (start() and end(), as with a
+  re.Match), its origin if it had one (e.g. 'https://example.com', or ''),
+  and ref, the path it refers to (relative to the current directory, and
+  ending in '/' if it's written that way).
+  """
+  __slots__ = ('_start', '_end', 'origin', 'ref')
+  def __init__(self, start, end, origin, ref):
+    self._start = start
+    self._end = end
+    self.origin = origin
+    self.ref = ref
+  def start(self): return self._start
+  def end(self): return self._end
+
+def rr_refs_of_file(rr_ref_re, fpath, site_files_prefix, origins_to_assume_contain_the_resources):
+  """
+  The RRRefs in fpath.
+  origins_to_assume_contain_the_resources: None to allow any origin.
+  """
   fdirname = dirname(fpath)
-  contents = utils.read_file_binary(fpath)
-  for match in re.finditer(rr_ref_re, contents):
-    rel_ref = match.group('ref').decode('utf-8')
-    origin_match = re.search(r'^(?:https?:)?//([^/]+)(.*)$', rel_ref)
+  for start, end, rel_ref in _rr_ref_matches(rr_ref_re, fpath):
+    rel_ref = rel_ref.decode('utf-8')
+    origin_match = re.search(r'^((?:https?:)?//([^/]+))(.*)$', rel_ref)
     if origin_match:
-      protocolless_origin = origin_match.group(1)
-      if protocolless_origin not in origins_to_assume_contain_the_resources:
+      origin = origin_match.group(1)
+      protocolless_origin = origin_match.group(2)
+      if (origins_to_assume_contain_the_resources != None and
+          protocolless_origin not in origins_to_assume_contain_the_resources):
         #sys.stderr.write("WARNING: origin we don't know how to rewrite\n" +
         raise RewriterError("ERROR: " + repr(fpath) + ":\n" +
                 "  origin we don't know how to rewrite:\n" +
@@ -34,34 +115,113 @@ def direct_rr_deps_of_file(rr_ref_re, fpath, site_files_prefix, origins_to_assum
           "  in " + repr(rel_ref) + "\n" +
           "  Origin not listed in origins_to_assume_contain_the_resources:\n" +
           "  " + repr(origins_to_assume_contain_the_resources) + "\n")
-      rel_ref = origin_match.group(2)
-    #rel_ref = re.sub(r'^(?:https?:)?//[^/]+', '', rel_ref)
-    #rel_ref = re.search(r'^((https?:)?//([^/]+))?(.*)$', '', rel_ref)
-    if rel_ref[:1] == '/': ref = site_files_prefix+rel_ref
-    else: ref = join(fdirname, rel_ref)
-    yield normpath(ref)
-
-def resolve_rr_deps_of_file(rr_ref_re, fpath, fpathout, f, site_files_prefix):
-  fdirname = dirname(fpath)
-  contents = utils.read_file_binary(fpath)
-  def g(match):
-    rel_ref = match.group('ref').decode('utf-8')
-    origin_match = re.search(r'^((?:https?:)?//[^/]+)(.*)$', rel_ref)
-    if origin_match:
-      origin = origin_match.group(1)
-      rel_ref = origin_match.group(2)
+      rel_ref = origin_match.group(3)
     else:
       origin = ''
     if rel_ref[:1] == '/': ref = site_files_prefix+rel_ref
     else: ref = join(fdirname, rel_ref)
-    result = f(normpath(ref))
+    yield RRRef(start, end, origin, ref)
+
+def direct_rr_deps_of_file(rr_ref_re, fpath, site_files_prefix, origins_to_assume_contain_the_resources):
+  for rr_ref in rr_refs_of_file(rr_ref_re, fpath, site_files_prefix,
+                                origins_to_assume_contain_the_resources):
+    yield normpath(rr_ref.ref)
+
+def write_resolved_rr_refs(out, chunks, rr_refs, f):
+  """
+  Writes to out (a binary file) the bytes that are the concatenation of
+  chunks, with each of their RRRefs (in order) replaced using f, which
+  takes the normalized path that a ref refers to and returns its new
+  URL.  Refs can span chunks; only a chunk at a time is held in memory.
+  """
+  def replacement(rr_ref):
+    result = f(normpath(rr_ref.ref))
     # some/dir/?rr keeps the trailing slash when rewritten:
-    if ref[-1:] == '/' and result[-1:] != '/':
+    if rr_ref.ref[-1:] == '/' and result[-1:] != '/':
       result += '/'
-    result = origin + result
+    result = rr_ref.origin + result
     return result.encode('utf-8')
-  contentsout = re.sub(rr_ref_re, g, contents)
-  utils.write_file_binary(fpathout, contentsout)
+  rr_refs = iter(rr_refs)
+  rr_ref = next(rr_refs, None)
+  # (how much of the input is written or replaced, and where chunk starts)
+  done = 0
+  offset = 0
+  for chunk in chunks:
+    end = offset + len(chunk)
+    while done < end:
+      if rr_ref != None and rr_ref.start() == done:
+        out.write(replacement(rr_ref))
+        done = rr_ref.end()
+        rr_ref = next(rr_refs, None)
+      else:
+        stop = end if rr_ref == None else min(end, rr_ref.start())
+        out.write(chunk[done - offset:stop - offset])
+        done = stop
+    offset = end
+
+def resolve_rr_deps_of_file(rr_ref_re, fpath, fpathout, f, site_files_prefix):
+  rr_refs = list(rr_refs_of_file(rr_ref_re, fpath, site_files_prefix, None))
+  with open(fpathout, 'wb') as out:
+    write_resolved_rr_refs(out, utils.read_file_chunks(fpath), rr_refs, f)
+
+def serialize_rr_refs(rr_refs):
+  return json.dumps([[r.start(), r.end(), r.origin, r.ref] for r in rr_refs]).encode('utf-8')
+
+def deserialize_rr_refs(data):
+  return [RRRef(*r) for r in json.loads(data.decode('utf-8'))]
+
+
+class ReferencerIndex(object):
+  """
+  The reverse of the rr dependency graph: for each file, which files
+  refer to it, directly and transitively (through rewritable files and
+  directories).  Computed once, so that "what changes if I edit f" is
+  a lookup.
+  """
+  def __init__(self, direct_deps, dirs = ()):
+    """
+    direct_deps: {f: f's direct deps} for the files that have deps.
+    dirs: the referenced directories (see affected()).
+    """
+    referenced_by = {}
+    for f, deps in direct_deps.items():
+      for dep in deps:
+        referenced_by.setdefault(dep, set()).add(f)
+    self._direct = {dep: frozenset(fs) for dep, fs in referenced_by.items()}
+    self._transitive = utils.transitive_closures(
+      self._direct, lambda f: self._direct.get(f, ()))
+    self._dirs = frozenset(dirs)
+    # A file in a referenced directory is renamed along with the
+    # directory (see ResourceRewriter._name_base), so whatever refers
+    # to the file changes when the directory does.
+    renamed_with = {}
+    for f in referenced_by:
+      base = f
+      while dirname(base) in self._dirs:
+        base = dirname(base)
+      if base != f:
+        renamed_with.setdefault(base, set()).add(f)
+    self._affects = utils.transitive_closures(self._direct, lambda f:
+      self._direct.get(f, frozenset()) | renamed_with.get(f, frozenset()))
+
+  def direct(self, f):
+    return self._direct.get(f, frozenset())
+
+  def transitive(self, f):
+    return self._transitive.get(f, frozenset())
+
+  def affected(self, changed_files):
+    """
+    changed_files and every file that transitively refers to one of
+    them, or to a file renamed along with one of them.  (Creating or
+    removing a file changes its directory's listing.)
+    """
+    changed = set(changed_files)
+    changed |= {dirname(f) for f in changed if dirname(f) in self._dirs}
+    result = set(changed)
+    for f in changed:
+      result.update(self._affects.get(f, ()))
+    return result
 
 
 # random hex of length equal to a sha384 hash,
@@ -81,9 +241,7 @@ class ResourceRewriter(object):
       rewritable_files,
       site_source_prefix = '.',
       rr_cache_dir = 'rr',
-      rr_ref_re = br'(?<!'+urlregexps.urlbyte+br')'+
-                  br'(?P<ref>'+urlregexps.urlbytes+br')\?rr'+
-                  br'(?!'+urlregexps.urlbyte+br')',
+      rr_ref_re = default_rr_ref_re,
       rr_path_rewriter = lambda f, hashdigest:
         # Attempt to keep the base filename before the hash and the file-type
         # extensions after the hash, for general friendliness.
@@ -93,7 +251,9 @@ class ResourceRewriter(object):
           f),
       do = None,
       hashed_data_prepend = b'',
-      origins_to_assume_contain_the_resources = set()
+      origins_to_assume_contain_the_resources = set(),
+      hash_jobs = None,
+      hash_algorithm = 'sha384'
       ):
     """
     Must be called with keyword arguments.  Most have defaults but you must specify
@@ -102,7 +262,7 @@ class ResourceRewriter(object):
     Expects (join(site_source_prefix, f) for f in rewritable_files) to be existent files
     that can contain links to rewrite.  Also expects all linked resources to exist.
 
-    Creates and caches information in rr_cache_dir.
+    Creates and caches information in rr_cache_dir (see record_store).
 
     Expects 'do' to be from a current buildsystem.run() invocation,
     or None (default) for no caching of information between runs.
@@ -125,9 +285,16 @@ class ResourceRewriter(object):
     to your testing environment when used in the testing environment, they won't
     adapt to the refering page's http/https-ness, etc.
     Example: origins_to_assume_contain_the_resources = {'www.example.com'}
+
+    hash_jobs: how many files to hash at once (see utils.hashfiles);
+    None (default) hashes them one at a time.
+
+    hash_algorithm: the hash that rewritten resource names come from,
+    e.g. 'blake2b-256' (see utils.new_hash).  Changing it renames every
+    resource, and recomputes every record.
     """
     if do == None:
-      def do(srcs, dests):
+      def do(srcs, dests, fingerprint = None):
         # This impl would set timestamps the way 'buildsystem' does, except
         # that it doesn't work when one of the srcs is a file "generated"
         # but not actually generated by writestore(). :
@@ -139,148 +306,420 @@ class ResourceRewriter(object):
         from os import makedirs
         for dest in dests: makedirs(dirname(dest), exist_ok=True)
         yield (srcs, dests)
-      store = {}
-      def readstore(f): return store[normpath(f)]
-      def writestore(f, v): store[normpath(f)] = v
-      io = { 'r': readstore, 'rb': readstore, 'w': writestore, 'wb': writestore }
-    else:
-      io = { 'r': utils.read_file_text, 'rb': utils.read_file_binary,
-             'w': utils.write_file_text, 'wb': utils.write_file_binary }
     self._do = do
-    self._io = io
-    self._rewritable_files = rewritable_files = frozenset(rewritable_files)
-    self._referenced_resource_files = set()
+    self._rewritable_files = frozenset(rewritable_files)
+    self._referenced_resource_files = frozenset()
+    self._referenced_dirs = frozenset()
+    self._covered_files = frozenset()
+    # {f: whether it's a directory}
+    self._isdir = {}
+    # {referenced dir: its 'dir-entries' before update() changed it}
+    self._stale_dir_entries = {}
+    # {(kind, f): a record as recall_* return it}
+    self._recalled = {}
     self._site_source_prefix = site_source_prefix
     self._rr_cache_dir = rr_cache_dir
     self._rr_ref_re = rr_ref_re
     self._rr_path_rewriter = rr_path_rewriter
-    referenced_and_rewritable_files = set(rewritable_files)
+    self._hashed_data_prepend = hashed_data_prepend
+    self._origins_to_assume_contain_the_resources = origins_to_assume_contain_the_resources
+    self._hash_jobs = hash_jobs
+    self._hash_algorithm = hash_algorithm
     # Changes to this Python file are moderately likely to change rewriting
     # behaviour, though none of the files this file includes are very
     # likely to.  So hash this file and include it in resource name hashes.
-    this_file_hash = utils.sha384file(__file__).digest()
+    self._this_file_hash = this_file_hash = utils.sha384file(__file__).digest()
+    # The records below use only this file's code and that of its imports.
+    self._rules_fingerprint = rules_fingerprint = \
+      fingerprints.fingerprint(this_file_hash, urlregexps, utils)
+    self._store = self._make_store(do, fingerprints.fingerprint(
+      rules_fingerprint, repr(rr_ref_re), site_source_prefix,
+      repr(sorted(origins_to_assume_contain_the_resources)),
+      rr_path_rewriter, hashlib.sha384(hashed_data_prepend).hexdigest(), hash_algorithm))
+    self._compute_direct_deps_and_hashes()
+    self._compute_transitive_records()
+    self._store.save()
+
+  def _record(self, kind, f, files, records, compute):
+    """
+    The value of the record (kind, f): the one computed this run, or one
+    from a previous run that's fresh with respect to files (paths) and
+    records ((kind, f) pairs), or else compute().
+    """
+    store = self._store
+    value = store.get(kind, f)
+    if value == None:
+      stamp = store.stamp(files, records)
+      value = store.lookup(kind, f, stamp)
+      if value == None:
+        value = compute()
+        store.put(kind, f, stamp, value)
+    return value
+
+  def _forget(self, kinds, files):
+    for f in files:
+      for kind in kinds:
+        self._store.forget(kind, f)
+    self.invalidate(files)
+
+  def _compute_direct_deps_and_hashes(self):
+    """
+    Computes the records about each file by itself that aren't in the
+    store yet, and which files are referenced.
+    """
+    site_source_prefix = self._site_source_prefix
+    rr_ref_re = self._rr_ref_re
+    rewritable_files = self._rewritable_files
+    referenced_resource_files = set()
+    referenced_dirs = set()
+    def direct_deps_of(kind, f, compute):
+      src = join(site_source_prefix, f)
+      self._record(kind, f, [src], (), lambda: compute(src))
     for f in rewritable_files:
-      for [src], [dest] in do([join(site_source_prefix, f)], [self._direct_deps_f(f)]):
-        direct_deps = [relpath(dd, site_source_prefix) for dd in
-                       direct_rr_deps_of_file(rr_ref_re, src, site_source_prefix,
-                                              origins_to_assume_contain_the_resources)]
-        io['w'](dest, serialize_path_set(direct_deps))
-      self._referenced_resource_files.update(self.recall_direct_deps(f))
+      # The refs are scanned for once, and rewrite() uses them too.
+      direct_deps_of('rr-refs', f, lambda src: serialize_rr_refs(
+        rr_refs_of_file(rr_ref_re, src, site_source_prefix,
+                        self._origins_to_assume_contain_the_resources)))
+      self._record('direct-deps', f, (), [('rr-refs', f)], lambda: serialize_path_set(
+        [relpath(normpath(rr_ref.ref), site_source_prefix)
+         for rr_ref in self._recall_rr_refs(f)]).encode('utf-8'))
+      referenced_resource_files.update(self.recall_direct_deps(f))
     def referenced_dir(f):
-      if isdir(join(site_source_prefix, f)):
-        for [src], [dest] in do([join(site_source_prefix, f)], [self._direct_deps_f(f)]):
-          direct_deps = [relpath(join(src, dd), site_source_prefix) for dd in sorted(os.listdir(src))]
-          io['w'](dest, serialize_path_set(direct_deps))
-        self._referenced_resource_files.update(self.recall_direct_deps(f))
+      if f not in self._isdir:
+        self._isdir[f] = isdir(join(site_source_prefix, f))
+      if self._isdir[f]:
+        referenced_dirs.add(f)
+        direct_deps_of('dir-deps', f, lambda src: serialize_path_set(
+          [relpath(join(src, dd), site_source_prefix) for dd in sorted(os.listdir(src))]).encode('utf-8'))
+        referenced_resource_files.update(self.recall_direct_deps(f))
         return self.recall_direct_deps(f)
       else:
         return ()
     for _ in utils.make_transitive(referenced_dir,
-        multiple_base_cases=True)(self._referenced_resource_files): pass
-    for f in self._referenced_resource_files:
-      if f not in rewritable_files and not isdir(join(site_source_prefix, f)):
-        for [src], [dest] in do([join(site_source_prefix, f)], [self._direct_deps_f(f)]):
-          io['w'](dest, serialize_path_set(()))
-    self._referenced_resource_files = frozenset(self._referenced_resource_files)
-    referenced_and_rewritable_files = frozenset(self._referenced_resource_files | rewritable_files)
-    for f in referenced_and_rewritable_files:
-      for [src], [dest] in do([join(site_source_prefix, f)], [self._hash_f(f)]):
-        if exists(src):
-          sha = utils.sha384file(src).digest()
-        else:
-          sha = hash_for_nonexistent_file
-        io['wb'](dest, sha)
-    for f in referenced_and_rewritable_files:
-      # todo it is possible to do more work-sharing than this for more efficiency
-      transitive_deps = set(utils.make_transitive(self.recall_direct_deps)(f))
-      for _, [dest] in do([self._direct_deps_f(path) for path in {f} | transitive_deps],
-                          [self._transitive_deps_f(f)]):
-        io['w'](dest, serialize_path_set(transitive_deps))
+        multiple_base_cases=True)(set(referenced_resource_files)): pass
+    # (Other referenced files have no direct deps, and no records.)
+    self._referenced_resource_files = frozenset(referenced_resource_files)
+    self._referenced_dirs = frozenset(referenced_dirs)
+    self._referencers = ReferencerIndex(
+      {f: self.recall_direct_deps(f) for f in rewritable_files | referenced_dirs},
+      referenced_dirs)
+    # Each referenced directory is a Merkle node: one 'dir-entries'
+    # record holds the hashes of the files in it (but not of its
+    # subdirectories or rewritable files, which are nodes of their own).
+    # So the files that only their directory refers to, e.g. a photo
+    # gallery's, need no records of their own, and an unchanged
+    # directory costs a stat per file rather than several records.
+    dir_files = {d: [e for e in self.recall_direct_deps(d)
+                     if not self._isdir[e] and e not in rewritable_files]
+                 for d in referenced_dirs}
+    directly_referenced = set()
+    for f in rewritable_files:
+      directly_referenced.update(self.recall_direct_deps(f))
+    self._covered_files = frozenset(
+      e for files in dir_files.values() for e in files if e not in directly_referenced)
+    to_hash = []
+    for f in self._referenced_resource_files | rewritable_files:
+      if f in referenced_dirs or f in self._covered_files: continue
+      if self._store.get('hash', f) != None: continue
+      src = join(site_source_prefix, f)
+      stamp = self._store.stamp([src])
+      if self._store.lookup('hash', f, stamp) == None:
+        to_hash.append((f, src, stamp))
+    to_list = []
+    for d in referenced_dirs:
+      if self._store.get('dir-entries', d) != None: continue
+      srcs = [join(site_source_prefix, e) for e in dir_files[d]]
+      stamp = self._store.stamp([join(site_source_prefix, d)] + srcs)
+      if self._store.lookup('dir-entries', d, stamp) != None: continue
+      stale = self._stale_dir_entries.pop(d, None)
+      if stale == None:
+        stale = json.loads(self._store.stale('dir-entries', d) or b'{}')
+      entries = {}
+      for e, src in zip(dir_files[d], srcs):
+        mtime = self._store.mtime(src)
+        old = stale.get(basename(e))
+        entries[e] = (mtime, bytes.fromhex(old[1]) if old != None and old[0] == mtime else None)
+      to_list.append((d, stamp, entries))
+    digests = utils.hashfiles(
+      [src for f, src, stamp in to_hash if exists(src)] +
+      [join(site_source_prefix, e) for d, stamp, entries in to_list
+       for e, (mtime, digest) in entries.items()
+       if digest == None and exists(join(site_source_prefix, e))],
+      self._hash_algorithm, jobs = self._hash_jobs)
+    for f, src, stamp in to_hash:
+      self._store.put('hash', f, stamp, digests.get(src, hash_for_nonexistent_file))
+    for d, stamp, entries in to_list:
+      self._store.put('dir-entries', d, stamp, json.dumps(
+        {basename(e): [mtime, (digest or digests.get(join(site_source_prefix, e),
+                                                     hash_for_nonexistent_file)).hex()]
+         for e, (mtime, digest) in entries.items()}, sort_keys = True).encode('utf-8'))
+    for d in referenced_dirs:
+      self._record('hash', d, (), [('dir-deps', d), ('dir-entries', d)],
+                   lambda: self._dir_hash(d))
+
+  def _dir_hash(self, d):
+    """A directory's own hash: of its listing and the files' hashes in 'dir-entries'."""
+    entries = self._recall_dir_entries(d)
+    h = utils.new_hash(self._hash_algorithm)
+    for e in self.recall_direct_deps(d):
+      h.update(basename(e).encode('utf-8') + b'\0' + entries.get(e, b'') + b'\n')
+    return h.digest()
+
+  def _merkle_hash(self, members, deps):
+    """
+    The hash including deps shared by members (a dependency cycle, or
+    one file), from their hashes and their deps' hashes including deps.
+    """
+    h = utils.new_hash(self._hash_algorithm)
+    h.update(self._hashed_data_prepend + self._this_file_hash)
+    h.update(str(len(members)).encode('ascii') + b'\n')
+    for member in members: h.update(self.recall_hash(member))
+    for dep in deps: h.update(self.recall_transitive_hash(dep))
+    return h.digest()
+
+  def _compute_transitive_records(self):
+    """Computes the records about files and their deps that aren't in the store yet."""
+    referenced_and_rewritable_files = self._referenced_resource_files | self._rewritable_files
+    def known_closure(f):
+      closure = self._store.get('transitive-deps', f)
+      return None if closure == None else self._recall_paths('transitive-deps', f)
+    closures = utils.transitive_closures(referenced_and_rewritable_files,
+                                         self.recall_direct_deps, known_closure)
     for f in referenced_and_rewritable_files:
-      incl_deps = self.recall_transitive_deps_including_self(f)
-      incl_dep_sha_files = [self._hash_f(dep) for dep in incl_deps]
-      for _, [dest] in do(incl_dep_sha_files, [self._hash_incl_deps_f(f)]):
-        incl_dep_shas = (
-            [hashed_data_prepend, this_file_hash] +
-            [io['rb'](dep) for dep in incl_dep_sha_files])
-        incl_deps_sha = hashlib.sha384(b''.join(incl_dep_shas)).digest()
-        io['wb'](dest, incl_deps_sha)
+      if f in self._covered_files: continue
+      if self._store.get('transitive-deps', f) == None:
+        self._store.put('transitive-deps', f, self._store.stamp(),
+                        serialize_path_set(closures[f]).encode('utf-8'))
+    # Merkle-style: a file's hash including deps covers its own hash and
+    # its direct deps' hashes including deps.  The files in a dependency
+    # cycle share one, covering all their hashes and the cycle's deps'.
+    # So editing a file recomputes only the hashes of the files that
+    # depend on it.
+    for component in utils.strongly_connected_components(
+        referenced_and_rewritable_files, self.recall_direct_deps):
+      members = sorted(component)
+      # (A covered file's is computed when it's asked for.)
+      if members[0] in self._covered_files: continue
+      if all(self._store.get('hash-incl-deps', f) != None for f in members): continue
+      # (Covered files' hashes are in their directory's.)
+      deps = sorted(set().union(*map(self.recall_direct_deps, members)) -
+                    set(members) - self._covered_files)
+      sources = ([('hash', member) for member in members] +
+                 [('hash-incl-deps', dep) for dep in deps])
+      for f in members:
+        # (The other members share the first one's.)
+        self._record('hash-incl-deps', f, (), sources,
+                     lambda: self.recall_transitive_hash(members[0]) if f != members[0]
+                             else self._merkle_hash(members, deps))
     # sorted() will process directories before their contents
     for f in sorted(referenced_and_rewritable_files):
-      # Put the hash on the farthest self or ancestor directory that
-      # is rr-referenced by anyone.
-      f_base = f
-      f_rest = None
-      while dirname(f_base) in referenced_and_rewritable_files:
-        f_rest = joinif(basename(f_base), f_rest)
-        f_base = dirname(f_base)
-      src = self._hash_incl_deps_f(f_base)
-      dest = self._rewritten_resource_name_f(f)
+      if f in self._covered_files: continue
+      if self._store.get('rewritten-resource-name', f) != None: continue
+      f_base, f_rest = self._name_base(f, referenced_and_rewritable_files)
       # Specifying this dependency fully is too hard now that it depends
-      # on whether any rewritable file rr-links to each parent directory.
-      # Use do() to create directories if necessary with a
-      # reasonable-ish mtime, but then recompute the file regardless.
-      for _ in do([src], [dest]):
-        # Create file so that the buildsystem code won't get confused.
-        # It will be overwritten soon anyway, regardless of how this do()
-        # generates the file.
-        io['w'](dest, '')
-      hashdigest = io['rb'](src)
-      io['w'](dest, joinif(rr_path_rewriter(f_base, hashdigest), f_rest))
-
-  def _direct_deps_f(self, f):
-    return join(self._rr_cache_dir, 'direct-deps', f)+'.deps'
-  def _transitive_deps_f(self, f):
-    return join(self._rr_cache_dir, 'transitive-deps', f)+'.deps'
-  def _hash_f(self, f):
-    return join(self._rr_cache_dir, 'hash', f)+'.hash'
-  def _hash_incl_deps_f(self, f):
-    return join(self._rr_cache_dir, 'hash-incl-deps', f)+'.hash'
-  def _rewritten_resource_name_f(self, f):
-    return join(self._rr_cache_dir, 'rewritten-resource-name', f)+'.name'
+      # on whether any rewritable file rr-links to each parent directory,
+      # so it's computed every run.
+      hashdigest = self.recall_transitive_hash(f_base)
+      self._store.put('rewritten-resource-name', f, self._store.stamp(),
+        joinif(self._rr_path_rewriter(f_base, hashdigest), f_rest).encode('utf-8'))
+
+  def _name_base(self, f, referenced_and_rewritable_files):
+    """
+    (f_base, f_rest): f's farthest self or ancestor directory that is
+    rr-referenced by anyone, which the hash is put on, and the rest of f.
+    """
+    f_base = f
+    f_rest = None
+    while dirname(f_base) in referenced_and_rewritable_files:
+      f_rest = joinif(basename(f_base), f_rest)
+      f_base = dirname(f_base)
+    return f_base, f_rest
+
+  def update(self, changed_files, rewritable_files = None):
+    """
+    For a rewriter that's kept alive between builds (e.g. by a process
+    watching the files): recomputes the records that depend on
+    changed_files (paths relative to site_source_prefix that were
+    modified, created or removed), and only those.  rewritable_files
+    can give a new set of them.  The new records are only kept in
+    memory.
+
+    Returns the files whose rewrite() result changes: rewritable files
+    that changed or that refer to a resource whose rewritten name
+    changed, and changed or newly referenced resources.  Pass them as
+    rewrite()'s 'only'.
+    """
+    changed = {normpath(f) for f in changed_files}
+    old_nodes = self._referenced_resource_files | self._rewritable_files
+    old_names = {f: self.recall_rewritten_resource_name(f) for f in old_nodes}
+    old_covered = self._covered_files
+    if rewritable_files != None:
+      rewritable_files = frozenset(rewritable_files)
+      changed |= rewritable_files ^ self._rewritable_files
+      self._rewritable_files = rewritable_files
+    # (Creating or removing a file changes its directory's listing.)
+    changed |= {dirname(f) for f in changed if dirname(f) in self._referenced_dirs}
+    for f in changed:
+      self._isdir.pop(f, None)
+      entries = self._store.get('dir-entries', f)
+      if entries != None:
+        # (The hashes of its other files are still good.)
+        self._stale_dir_entries[f] = {name: entry for name, entry in json.loads(entries).items()
+                                      if join(f, name) not in changed}
+    self._forget(['rr-refs', 'direct-deps', 'dir-deps', 'dir-entries', 'hash'], changed)
+    self._compute_direct_deps_and_hashes()
+    nodes = self._referenced_resource_files | self._rewritable_files
+    # A file that starts or stops being covered by its directory (e.g.
+    # when a rewritable file starts referring to it directly) changes
+    # what the directory's hash including deps covers, and which
+    # records the file has of its own.
+    covered_changed = (old_covered ^ self._covered_files) & nodes
+    affected = self._referencers.affected(
+      (changed & nodes) | (nodes - old_nodes) | covered_changed |
+      {dirname(f) for f in covered_changed})
+    # (Whether a directory is referenced changes the names of the files in it.)
+    added_or_removed = nodes ^ old_nodes
+    self._forget(['transitive-deps', 'hash-incl-deps'], affected)
+    self._forget(['rewritten-resource-name'],
+      {f for f in nodes if self._name_base(f, nodes)[0] in affected or
+                           any(f.startswith(d + '/') for d in added_or_removed)})
+    self._forget(['rr-refs', 'direct-deps', 'dir-deps', 'dir-entries', 'hash', 'transitive-deps',
+                  'hash-incl-deps', 'rewritten-resource-name'], old_nodes - nodes)
+    self._stale_dir_entries.clear()
+    self._compute_transitive_records()
+    renamed = {f for f in nodes if old_names.get(f) != self.recall_rewritten_resource_name(f)}
+    return ({f for f in self._rewritable_files
+             if f in changed or any(dep in renamed for dep in self.recall_direct_deps(f))} |
+            (self._referenced_resource_files & (changed | (nodes - old_nodes))))
+
+  def _make_store(self, do, config):
+    """
+    With a buildsystem 'do', the records are kept in rr_cache_dir/index.sqlite,
+    and those that are still fresh are taken from the previous builds'.
+    """
+    if not hasattr(do, 'dirs_with_already_built_stuff'):
+      return record_store.RecordStore(':memory:')
+    path = join(self._rr_cache_dir, 'index.sqlite')
+    os.makedirs(self._rr_cache_dir, exist_ok=True)
+    previous_paths = [path] + [join(built, path) for built in do.dirs_with_already_built_stuff]
+    return record_store.RecordStore(path, previous_paths, config,
+      lambda f: do.stat_cache.mtime_or_ancestor_mtime(normpath(abspath(f))))
+
+  def _recall(self, kind, f, compute):
+    """compute(), remembered as (kind, f) until invalidate()d."""
+    try:
+      return self._recalled[(kind, f)]
+    except KeyError:
+      value = self._recalled[(kind, f)] = compute()
+      return value
+
+  def invalidate(self, files = None):
+    """
+    Forgets the decoded records that recall_* keep in memory for files
+    (None: for all files), so that the next recall reads them from the
+    record store again.  For use when those records have changed.
+    """
+    if files == None:
+      self._recalled.clear()
+    else:
+      files = set(files)
+      for key in [key for key in self._recalled if key[1] in files]:
+        del self._recalled[key]
+
+  def _recall_rr_refs(self, f):
+    return self._recall('rr-refs', f, lambda:
+      deserialize_rr_refs(self._store.get('rr-refs', f)))
+
+  def _recall_paths(self, kind, f):
+    return self._recall(kind, f, lambda:
+      tuple(deserialize_paths(self._store.get(kind, f, b'').decode('utf-8'))))
 
   def recall_direct_deps(self, f):
     """do() wise, this depends only on f."""
-    return deserialize_paths(self._io['r'](self._direct_deps_f(f)))
+    return list(self._recall_paths(
+      'direct-deps' if f in self._rewritable_files else 'dir-deps', f))
   def recall_transitive_deps(self, f):
     """do() wise, this depends on f and all its rewritable transitive dependencies."""
-    return deserialize_paths(self._io['r'](self._transitive_deps_f(f)))
+    return list(self._recall_paths('transitive-deps', f))
   def recall_transitive_deps_including_self(self, f):
     """do() wise, this depends on f and all its rewritable transitive dependencies."""
-    return sorted(set(self.recall_transitive_deps(f)) | {f})
+    return list(self._recall('transitive-deps-including-self', f, lambda:
+      tuple(sorted(set(self._recall_paths('transitive-deps', f)) | {f}))))
+
+  def _recall_dir_entries(self, d):
+    return self._recall('dir-entries', d, lambda:
+      {join(d, name): bytes.fromhex(digest) for name, [mtime, digest]
+       in json.loads(self._store.get('dir-entries', d)).items()})
 
   def recall_hash(self, f):
     """do() wise, this depends only on f."""
-    return self._io['rb'](self._hash_f(f))
+    if f in self._covered_files:
+      return self._recall_dir_entries(dirname(f))[f]
+    return self._store.get('hash', f)
   def recall_transitive_hash(self, f):
     """do() wise, this depends on f and all its rewritable transitive dependencies."""
-    return self._io['rb'](self._hash_incl_deps_f(f))
+    if f in self._covered_files:
+      return self._recall('hash-incl-deps', f, lambda: self._merkle_hash([f], []))
+    return self._store.get('hash-incl-deps', f)
 
   def recall_rewritten_resource_name(self, f):
     """do() wise, this depends on f and all its rewritable transitive dependencies."""
-    return self._io['r'](self._rewritten_resource_name_f(f))
+    def covered_name():
+      f_base, f_rest = self._name_base(f, self._referenced_dirs)
+      return joinif(self.recall_rewritten_resource_name(f_base), f_rest)
+    return self._recall('rewritten-resource-name', f, lambda:
+      covered_name() if f in self._covered_files else
+      self._store.get('rewritten-resource-name', f).decode('utf-8'))
 
   def recall_all_rewritable_files(self):
     return self._rewritable_files
 
   def recall_all_files_and_dirs_that_can_have_deps(self, required_files):
-    return set(filter(
-          lambda f: f in self._rewritable_files or isdir(join(self._site_source_prefix, f)),
-          set().union(*(self.recall_transitive_deps_including_self(f)
-                        for f in required_files if f in self._rewritable_files))))
+    required = self._rewritable_files.intersection(required_files)
+    if required == self._rewritable_files:
+      return self._rewritable_files | self._referenced_dirs
+    result = set()
+    for f in required:
+      result.update(self._recall_paths('transitive-deps', f))
+    result &= self._rewritable_files | self._referenced_dirs
+    result |= required
+    return result
 
   def recall_all_needed_resources(self, required_files, count_directories_as_resources=False):
     """do() wise, this depends on recall_all_files_and_dirs_that_can_have_deps(required_files)."""
-    return set(filter(
-          lambda f: count_directories_as_resources or not isdir(join(self._site_source_prefix, f)),
-          set().union(*(self.recall_transitive_deps(f)
-                        for f in required_files if f in self._rewritable_files))))
+    required = self._rewritable_files.intersection(required_files)
+    if required == self._rewritable_files:
+      result = self._referenced_resource_files
+    else:
+      result = set()
+      for f in required:
+        result.update(self._recall_paths('transitive-deps', f))
+    if not count_directories_as_resources:
+      result = result - self._referenced_dirs
+    return result
+
+  def recall_referencing_files(self, f):
+    """The rewritable files and directories that rr-refer to f."""
+    return sorted(self._referencers.direct(f))
+  def recall_transitive_referencing_files(self, f):
+    """The rewritable files and directories that refer to f through any chain of refs."""
+    return sorted(self._referencers.transitive(f))
+  def recall_affected_files(self, changed_files):
+    """
+    The rewritable files whose rewrite() result changes if changed_files
+    (paths relative to site_source_prefix) are edited, created or removed:
+    those among them, and those that refer to them through any chain of
+    refs (whose rewritten names all change), counting a file in a
+    referenced directory as changing with the directory.
+    """
+    return self._referencers.affected(changed_files) & self._rewritable_files
 
   def rewrite(self,
         dest_dir,
         resource_url_maker,
         copy_nonrewritable_resources=None,
-        copy_remaining_files_in_site_source_prefix=None
+        copy_remaining_files_in_site_source_prefix=None,
+        only=None
         ):
     """
     Broadly, rewrite() mirrors site_source_prefix into dest_dir.
@@ -303,33 +742,53 @@ class ResourceRewriter(object):
       argument and creates dest based on src, e.g. shutil.copyfile or os.link.
       If None, no copying of files not listed in rewritable_files is done.
     copy_remaining_files_in_site_source_prefix: like 
+    only: if not None, a set of files to (re)write, e.g. what update()
+      returned; the rest of dest_dir is assumed to be up to date already.
     """
     def resolver(dep_path):
       orig_path = relpath(dep_path, self._site_source_prefix)
       new_path = self.recall_rewritten_resource_name(orig_path)
       return resource_url_maker(new_path, orig_path)
+    def fingerprint(function):
+      return fingerprints.fingerprint(self._rules_fingerprint, function)
     already_copied = set()
     for f in self._rewritable_files:
+      if only != None and f not in only: continue
       incl_deps = [join(self._site_source_prefix, g)
                    for g in self.recall_transitive_deps_including_self(f)]
-      for _, [dest] in self._do(incl_deps, [join(dest_dir, f)]):
-        resolve_rr_deps_of_file(self._rr_ref_re,
-          join(self._site_source_prefix, f), dest, resolver,
-          self._site_source_prefix)
+      for _, [dest] in self._do(incl_deps, [join(dest_dir, f)],
+                                fingerprint = fingerprint(resource_url_maker)):
+        src = join(self._site_source_prefix, f)
+        # The refs found by __init__ are only good for the same contents,
+        # so check those while streaming, and if they've changed since,
+        # find the refs again.
+        h = utils.new_hash(self._hash_algorithm)
+        def hashed(chunks):
+          for chunk in chunks:
+            h.update(chunk)
+            yield chunk
+        with open(dest, 'wb') as out:
+          write_resolved_rr_refs(out, hashed(utils.read_file_chunks(src)),
+                                 self._recall_rr_refs(f), resolver)
+        if h.digest() != self.recall_hash(f):
+          resolve_rr_deps_of_file(self._rr_ref_re, src, dest, resolver, self._site_source_prefix)
       already_copied.add(f)
     if copy_nonrewritable_resources != None:
       for f in self._referenced_resource_files:
-        if f not in already_copied and not isdir(join(self._site_source_prefix, f)):
+        if f not in already_copied and f not in self._referenced_dirs and \
+            (only == None or f in only):
           src = join(self._site_source_prefix, f)
           if exists(src):
-            for _, [dest] in self._do([src], [join(dest_dir, f)]):
+            for _, [dest] in self._do([src], [join(dest_dir, f)],
+                fingerprint = fingerprint(copy_nonrewritable_resources)):
               copy_nonrewritable_resources(src, dest)
           already_copied.add(f)
     if copy_remaining_files_in_site_source_prefix != None:
       for f in utils.relpath_files_under(self._site_source_prefix):
-        if f not in already_copied:
+        if f not in already_copied and (only == None or f in only):
           for [src], [dest] in self._do(
-                [join(self._site_source_prefix, f)], [join(dest_dir, f)]):
+                [join(self._site_source_prefix, f)], [join(dest_dir, f)],
+                fingerprint = fingerprint(copy_remaining_files_in_site_source_prefix)):
             copy_remaining_files_in_site_source_prefix(src, dest)
           already_copied.add(f)
           
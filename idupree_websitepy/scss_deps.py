@@ -0,0 +1,97 @@
+"""
+Finds the files a Sass stylesheet (.scss or .sass) imports, directly or
+through other imports, with @import, @use, @forward and
+meta.load-css(), so that the build can recompile it only when one of
+those changes.
+
+Imports are resolved the way Sass does: relative to the importing file,
+then in each load path, trying the name as a partial (_name) and with
+the .scss, .sass and .css extensions, then as a directory's index file.
+Nothing is evaluated, so e.g. an import inside an @if counts either way.
+Plain CSS imports (url(...), http://..., foo.css, or with a media query)
+and built-in modules (sass:math) aren't files to depend on.
+"""
+
+import os, re
+from os.path import dirname, isfile
+
+from .utils import join, normpath
+
+# Comments are dropped; strings and url()s are kept whole, since they
+# can contain '//' and '/*'.
+_comment_re = re.compile(
+  r'''("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|url\([^)]*\))|/\*.*?\*/|//[^\n]*''', re.S)
+_scss_rule_re = re.compile(r'@(import|use|forward)\b([^;{}]*)|load-css\(\s*("[^"]*"|\'[^\']*\')')
+# (The indented syntax ends statements at newlines.)
+_sass_rule_re = re.compile(r'@(import|use|forward)\b([^;{}\n]*)|load-css\(\s*("[^"]*"|\'[^\']*\')')
+_string_re = re.compile(r'''\s*("[^"]*"|'[^']*')''')
+_import_item_re = re.compile(r'''\s*("[^"]*"|'[^']*'|url\([^)]*\)|[^,\s]+)([^,]*)''')
+_plain_css_re = re.compile(r'\.css$|^(?:[a-z][a-z0-9+.-]*:)?//|^url\(', re.I)
+
+def env_load_paths():
+  """The load paths in the SASS_PATH environment variable, which sassc and sass also use."""
+  return [p for p in os.environ.get('SASS_PATH', '').split(os.pathsep) if p != '']
+
+def imported_names(path):
+  """The names that the stylesheet at path imports (as written, not resolved)."""
+  with open(path, 'r', encoding='utf-8', errors='replace') as f:
+    text = _comment_re.sub(lambda m: m.group(1) or ' ', f.read())
+  rule_re = _sass_rule_re if path.endswith('.sass') else _scss_rule_re
+  names = []
+  for m in rule_re.finditer(text):
+    keyword, rest, load_css = m.groups()
+    if load_css != None:
+      names.append(load_css[1:-1])
+    elif keyword in ('use', 'forward'):
+      s = _string_re.match(rest)
+      if s != None:
+        names.append(s.group(1)[1:-1])
+    else:
+      for item, media in _import_item_re.findall(rest):
+        name = item[1:-1] if item[:1] in ('"', "'") else item
+        if media.strip() == '' and not _plain_css_re.search(name):
+          names.append(name)
+  # (Built-in modules and other importers' URLs, e.g. sass:math or pkg:foo)
+  return [name for name in names if not re.match(r'[a-z][a-z0-9+.-]*:', name, re.I)]
+
+def _candidates(base):
+  d, name = dirname(base), os.path.basename(base)
+  if re.search(r'\.(scss|sass|css)$', name):
+    return [base, join(d, '_' + name)]
+  return ([join(d, prefix + name + ext) for ext in ('.scss', '.sass', '.css') for prefix in ('', '_')] +
+          [join(base, prefix + 'index' + ext) for ext in ('.scss', '.sass', '.css') for prefix in ('_', '')])
+
+def resolve(name, importer, load_paths = ()):
+  """
+  The files that importer's import of name can load: the candidates that
+  exist in the first place (importer's directory, then load_paths) that
+  has any.  (Sass requires there to be one; this doesn't.)
+  """
+  for root in [dirname(importer)] + list(load_paths):
+    found = [normpath(c) for c in _candidates(join(root, name)) if isfile(c)]
+    if len(found) > 0:
+      return found
+  return []
+
+def sass_imports(path, load_paths = ()):
+  """
+  Returns (files, unresolved): the files that the stylesheet at path
+  imports directly or indirectly (sorted, not including path), and the
+  names that no file was found for.
+  """
+  files = set()
+  unresolved = set()
+  pending = [normpath(path)]
+  while pending:
+    importer = pending.pop()
+    if importer.endswith('.css'): continue
+    for name in imported_names(importer):
+      found = resolve(name, importer, load_paths)
+      if len(found) == 0:
+        unresolved.add(name)
+      for f in found:
+        if f not in files:
+          files.add(f)
+          pending.append(f)
+  files.discard(normpath(path))
+  return sorted(files), sorted(unresolved)
@@ -1,5 +1,6 @@
 
-import os, sys, hashlib, re, gzip, random
+import os, sys, hashlib, re, gzip, random, json, shutil, mmap, threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from os.path import isdir, basename
 
 # We use forward slashes for paths even on Windows
@@ -96,6 +97,93 @@ def make_transitive(relation, always_include_base_case = False, multiple_base_ca
         newdeps.extend(relation(newdep))
   return ret
 
+def strongly_connected_components(initial, relation):
+  """
+  Yields the strongly connected components (as lists) of the graph of
+  the objects in 'initial' and everything reachable from them by
+  relation, each after every component reachable from it.  (Tarjan's
+  algorithm, without recursion so that deep graphs are fine.)
+
+  >>> list(strongly_connected_components([0], lambda x: {0: [1], 1: [2, 0], 2: []}[x]))
+  [[2], [1, 0]]
+  """
+  index = {}
+  lowlink = {}
+  stack = []
+  on_stack = set()
+  def visit(node):
+    index[node] = lowlink[node] = len(index)
+    stack.append(node); on_stack.add(node)
+    return (node, iter(relation(node)))
+  for root in initial:
+    if root in index: continue
+    work = [visit(root)]
+    while work:
+      node, children = work[-1]
+      for child in children:
+        if child not in index:
+          work.append(visit(child))
+          break
+        elif child in on_stack:
+          lowlink[node] = min(lowlink[node], index[child])
+      else:
+        work.pop()
+        if work:
+          parent = work[-1][0]
+          lowlink[parent] = min(lowlink[parent], lowlink[node])
+        if lowlink[node] == index[node]:
+          component = []
+          while True:
+            member = stack.pop(); on_stack.discard(member)
+            component.append(member)
+            if member == node: break
+          yield component
+
+def transitive_closures(initial, relation, known = lambda x: None):
+  """
+  Returns {x: frozenset(make_transitive(relation)(x))} for every x in
+  'initial' and everything reachable from them, calling relation once
+  per object.  It closes strongly connected components in dependency
+  order, so each closure is the union of already-computed ones, and
+  the members of a component share theirs.  known(x) can give closures
+  that are already known (or None), whose objects' relations then
+  aren't followed.
+
+  >>> closures = transitive_closures(['a', 'd'],
+  ...   lambda x: {'a': ['b'], 'b': ['c', 'a'], 'c': [], 'd': ['c', 'd']}[x])
+  >>> [sorted(closures[x]) for x in 'abcd']
+  [['a', 'b', 'c'], ['a', 'b', 'c'], [], ['c', 'd']]
+  >>> sorted(transitive_closures(['e'], lambda x: ['b'], {'b': {'a', 'b', 'c'}}.get)['e'])
+  ['a', 'b', 'c']
+  """
+  edges = {}
+  closures = {}
+  def relation_once(x):
+    if x not in edges:
+      closure = known(x)
+      if closure != None:
+        closures[x] = frozenset(closure)
+        edges[x] = ()
+      else:
+        edges[x] = set(relation(x))
+    return edges[x]
+  for component in strongly_connected_components(initial, relation_once):
+    if component[0] in closures: continue
+    members = set(component)
+    closure = set()
+    for member in component:
+      for dep in edges[member]:
+        if dep not in members:
+          closure.add(dep)
+          closure |= closures[dep]
+    # (A component of one object is only a cycle if it relates to itself.)
+    if len(component) > 1 or component[0] in edges[component[0]]:
+      closure |= members
+    closure = frozenset(closure)
+    for member in component:
+      closures[member] = closure
+  return closures
+
 characters_that_are_easy_to_read_and_type = '23456789abcdefghijkmnpqrstuvwxyz'
 alphanumeric_characters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
 def alnum_secret(length = 22):
@@ -106,6 +194,36 @@ def alnum_secret(length = 22):
   rng = random.SystemRandom()
   return ''.join(rng.choice(alphanumeric_characters) for _ in range(length))
 
+def new_hash(algorithm = 'sha384'):
+  """
+  A new hashlib hash object for algorithm: a name for hashlib.new(),
+  optionally followed by -<digest size in bits> for hashes whose digest
+  size can be chosen, e.g. 'blake2b-256'.  Extendable-output hashes
+  (shake_128, shake_256), whose digest() needs a length, aren't supported.
+
+  >>> new_hash('blake2b-256').digest_size
+  32
+  >>> new_hash('shake_128')
+  Traceback (most recent call last):
+  ...
+  ValueError: shake_128 has no fixed digest size
+  >>> new_hash('sha256-128')
+  Traceback (most recent call last):
+  ...
+  ValueError: sha256's digest size can't be chosen
+  """
+  name, _, bits = algorithm.partition('-')
+  if bits:
+    try:
+      h = hashlib.new(name, digest_size=int(bits) // 8)
+    except TypeError:
+      raise ValueError(name + "'s digest size can't be chosen") from None
+  else:
+    h = hashlib.new(name)
+  if h.digest_size == 0:
+    raise ValueError(name + ' has no fixed digest size')
+  return h
+
 def sha384file(path):
   """
   Returns a hashlib hash object giving the sha384 of the argument
@@ -122,16 +240,93 @@ def sha384file(path):
   faster on 64-bit computers (which I develop on), and has more result bits
   (for the unlikely chance that matters), so use sha384.
   """
+  return hashfile(path, 'sha384')
+
+def hashfile(path, algorithm = 'sha384'):
+  """Like sha384file, with another algorithm (see new_hash)."""
   # http://stackoverflow.com/questions/1131220/get-md5-hash-of-big-files-in-python
-  h = hashlib.sha384()
+  h = new_hash(algorithm)
   if isdir(path):
     h.update(b''.join(p.encode()+b'\0' for p in sorted(os.listdir(path))))
   else:
     with open(path, 'rb') as f:
+      # A single update() from a mapping of the file saves copying it
+      # (and hashlib doesn't hold the GIL meanwhile).
+      try:
+        if os.fstat(f.fileno()).st_size > 0:
+          with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            h.update(m)
+          return h
+      except (OSError, ValueError):
+        # (e.g. a file that can't be mapped; read it instead)
+        h = new_hash(algorithm)
       for chunk in iter(lambda: f.read(2**20), b''):
         h.update(chunk)
   return h
 
+class ParallelHasher(object):
+  """
+  Hashes files (hashfile(path, algorithm).digest()) on up to 'jobs'
+  threads (None: each in the thread that asks for it).  A file is only
+  started while the ones being hashed total less than max_bytes_in_flight
+  bytes (or if none are), which bounds how much of them is mapped into
+  memory at once; submit() waits until then.  Use it in a 'with'.
+  """
+  def __init__(self, algorithm = 'sha384', jobs = None, max_bytes_in_flight = 2**28):
+    self.algorithm = algorithm
+    self.max_bytes_in_flight = max_bytes_in_flight
+    self._executor = ThreadPoolExecutor(jobs) if jobs != None and jobs > 1 else None
+    self._budget = threading.Condition()
+    self._in_flight = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    if self._executor != None: self._executor.shutdown()
+
+  def _hash(self, path, size):
+    try:
+      return hashfile(path, self.algorithm).digest()
+    finally:
+      with self._budget:
+        self._in_flight -= size
+        self._budget.notify_all()
+
+  def submit(self, path, size = None):
+    """A Future of path's digest.  size: path's size, if known."""
+    if size == None:
+      size = os.stat(path).st_size
+    with self._budget:
+      self._budget.wait_for(lambda: self._in_flight == 0 or
+                                    self._in_flight + size <= self.max_bytes_in_flight)
+      self._in_flight += size
+    if self._executor != None:
+      return self._executor.submit(self._hash, path, size)
+    future = Future()
+    try:
+      future.set_result(self._hash(path, size))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+def hashfiles(paths, algorithm = 'sha384', jobs = None, max_bytes_in_flight = 2**28):
+  """
+  Returns {path: hashfile(path, algorithm).digest()} for paths, hashing up to
+  'jobs' files at once, largest first (see ParallelHasher).
+  """
+  paths = set(paths)
+  if jobs == None or jobs <= 1 or len(paths) <= 1:
+    return {path: hashfile(path, algorithm).digest() for path in paths}
+  sizes = {path: os.stat(path).st_size for path in paths}
+  with ParallelHasher(algorithm, jobs, max_bytes_in_flight) as hasher:
+    futures = {path: hasher.submit(path, sizes[path])
+               for path in sorted(paths, key=lambda path: -sizes[path])}
+  return {path: future.result() for path, future in futures.items()}
+
 def file_re_sub(infile, outfile, *sub_args, **sub_kwargs):
   """
   Calls re.sub(...) on the contents of infile and writes it to outfile.
@@ -165,12 +360,47 @@ def gzip_omitting_metadata(infile, outfile):
         #per python docs http://docs.python.org/3/library/gzip.html
         f_gzip.writelines(f_in)
 
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+def clone_file(src, dest):
+  """
+  Copies the contents of src to a new file dest, as cheaply as the
+  filesystem allows: a reflink (FICLONE, which shares storage
+  copy-on-write, e.g. on btrfs and XFS), else copy_file_range (the kernel
+  copies without going through userspace), else a plain copy.
+  Like shutil.copyfile, doesn't copy permissions or other metadata.
+  """
+  with open(src, 'rb') as f_in:
+    with open(dest, 'wb') as f_out:
+      try:
+        import fcntl
+        fcntl.ioctl(f_out.fileno(), _FICLONE, f_in.fileno())
+        return
+      except (ImportError, OSError):
+        pass
+      try:
+        while os.copy_file_range(f_in.fileno(), f_out.fileno(), 2**30) > 0:
+          pass
+        return
+      except (AttributeError, OSError):
+        # (AttributeError: python < 3.8)
+        f_in.seek(0)
+        f_out.seek(0)
+        f_out.truncate()
+      shutil.copyfileobj(f_in, f_out, 2**20)
+
 def read_file_text(path):
   with open(path, 'r', encoding='utf-8') as f:
     return f.read()
 def read_file_binary(path):
   with open(path, 'rb') as f:
     return f.read()
+def read_file_chunks(path, chunk_size = 2**20):
+  """Yields the file's contents (bytes) a chunk at a time."""
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      yield chunk
 
 def write_file_text(path, data):
   with open(path, 'w', encoding='utf-8') as f:
@@ -179,6 +409,27 @@ def write_file_binary(path, data):
   with open(path, 'wb') as f:
     return f.write(data)
 
+def write_file_text_atomically(path, data):
+  """
+  Like write_file_text, but readers (and crashes) never see
+  a partially written file.
+  """
+  write_file_text(path+'.new', data)
+  os.replace(path+'.new', path)
+
+def read_json_or(path, default):
+  """
+  Returns the JSON contents of path, or default if path doesn't exist
+  or isn't valid JSON (e.g. from a format this code no longer writes).
+  """
+  try:
+    return json.loads(read_file_text(path))
+  except (FileNotFoundError, NotADirectoryError, ValueError):
+    return default
+
+def write_json_atomically(path, data):
+  write_file_text_atomically(path, json.dumps(data, sort_keys=True))
+
 
 def write_stdout_binary(data):
   try: #python3
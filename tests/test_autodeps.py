@@ -0,0 +1,72 @@
+import os, tempfile, time, unittest
+from os.path import join
+
+from idupree_websitepy import autodeps, buildsystem, utils
+
+# Runs the command and writes an empty log, like strace would
+# if the command opened nothing.
+fake_strace = '''#!/bin/sh
+while [ "$1" != "--" ]; do
+  if [ "$1" = "-o" ]; then shift; log="$1"; fi
+  shift
+done
+shift
+: > "$log"
+exec "$@"
+'''
+
+class CheckCallTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self._old_strace = autodeps._strace
+    if autodeps._strace_command() == '':
+      autodeps._strace = join(self.dir, 'strace')
+      with open(autodeps._strace, 'w') as f: f.write(fake_strace)
+      os.chmod(autodeps._strace, 0o755)
+    self.build_py = join(self.dir, 'build.py')
+    with open(self.build_py, 'w') as f: f.write('# build system\n')
+    self.input = join(self.dir, 'input.txt')
+    with open(self.input, 'w') as f: f.write('input\n')
+
+  def tearDown(self):
+    autodeps._strace = self._old_strace
+    self._tmp.cleanup()
+
+  def _build(self):
+    executed = []
+    for building_dir, do in buildsystem.run_basic(join(self.dir, 'builds'), [self.build_py],
+                                                  discover_deps = True):
+      with utils.pushd(building_dir):
+        for [src], [dest] in do([self.input], ['output.txt']):
+          executed.append(dest)
+          autodeps.check_call(['cp', src, dest])
+    return executed
+
+  def _use_temp_dir(self):
+    # Other programs use the temporary directory between builds.
+    time.sleep(0.02)
+    with tempfile.NamedTemporaryFile(): pass
+
+  def test_noop_rebuild_keeps_cmd_rule_fresh(self):
+    self.assertEqual(len(self._build()), 1)
+    self._use_temp_dir()
+    self.assertEqual(self._build(), [])
+    self._use_temp_dir()
+    self.assertEqual(self._build(), [])
+    with open(self.input, 'a') as f: f.write('more\n')
+    self.assertEqual(len(self._build()), 1)
+
+  def test_strace_log_is_not_a_dep(self):
+    recorder = autodeps.Recorder()
+    recorder.start()
+    try:
+      autodeps.check_call(['cp', self.input, join(self.dir, 'copy.txt')])
+    finally:
+      recorder.stop()
+    files = recorder.result()['files']
+    self.assertIn(self.input, files)
+    self.assertEqual([f for f in files if f.endswith('.strace')], [])
+
+if __name__ == '__main__':
+  unittest.main()
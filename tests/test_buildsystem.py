@@ -0,0 +1,177 @@
+import os, tempfile, threading, time, unittest
+from os.path import join
+
+from idupree_websitepy import buildsystem, utils
+
+class HardlinkStagingTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.srcdir = join(self.dir, 'src')
+    os.makedirs(join(self.srcdir, 'sub'))
+    self.sources = [join(self.srcdir, 'a.txt'), join(self.srcdir, 'sub', 'b.txt')]
+    for i, f in enumerate(self.sources):
+      with open(f, 'w') as fh: fh.write('source %d\n' % i)
+      # Older than the build system source, so that every rule's dests
+      # get a newer mtime than these.
+      os.utime(f, ns=(10**18 + i, 10**18 + i))
+    self.build_py = join(self.dir, 'build.py')
+    with open(self.build_py, 'w') as fh: fh.write('# build system\n')
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def _build(self):
+    for do in buildsystem.run(self.srcdir, [self.build_py],
+                              builds_dir = join(self.dir, 'builds'),
+                              staging = 'hardlink'):
+      for [src], [dest] in do(['src/a.txt'], ['site/a.txt']):
+        os.link(src, dest)
+      for [src, other], [dest] in do(['src/sub/b.txt', 'src/a.txt'], ['site/sub/b.txt']):
+        os.link(src, dest)
+
+  def _source_mtimes(self):
+    return {f: os.stat(f).st_mtime_ns for f in self.sources}
+
+  def test_build_leaves_source_mtimes_alone(self):
+    before = self._source_mtimes()
+    self._build()
+    self.assertEqual(self._source_mtimes(), before)
+    with open(self.build_py, 'a') as fh: fh.write('# changed\n')
+    self._build()
+    self._build()
+    self.assertEqual(self._source_mtimes(), before)
+
+class SubtreeReuseTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.build_py = join(self.dir, 'build.py')
+    with open(self.build_py, 'w') as fh: fh.write('# build system\n')
+    os.utime(self.build_py, ns=(10**18, 10**18))
+    self.sources = {}
+    for name in ['a', 'b', 'c']:
+      self.write_source(name, name + '1')
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def write_source(self, name, contents):
+    path = self.sources[name] = join(self.dir, name + '.txt')
+    with open(path, 'w') as fh: fh.write(contents)
+    mtime = 10**18 + len(contents) * 10**9 + sum(map(ord, contents))
+    os.utime(path, ns=(mtime, mtime))
+
+  def _build(self, names, fail = False):
+    for building_dir, do in buildsystem.run_basic(join(self.dir, 'builds'), [self.build_py],
+                                                  reuse_subtrees = True):
+      with utils.pushd(building_dir):
+        for name in names:
+          for [src], [dest] in do([self.sources[name]], [join('site', 'dir', name)]):
+            with open(src) as fin, open(dest, 'w') as fout: fout.write(fin.read())
+        do.settle('site')
+        if fail:
+          raise RuntimeError('build failed')
+
+  def _built(self):
+    result = {}
+    for d, _, files in os.walk(join(self.dir, 'builds', 'build')):
+      for name in files:
+        with open(join(d, name)) as fh:
+          result[os.path.relpath(join(d, name), join(self.dir, 'builds', 'build'))] = fh.read()
+    return result
+
+  def test_failed_run_keeps_build(self):
+    self._build(['a', 'b'])
+    good = self._built()
+    self.assertEqual(good, {'site/dir/a': 'a1', 'site/dir/b': 'b1'})
+    # Rebuilds a, adds c and drops b from the adopted directory, then fails.
+    self.write_source('a', 'a2')
+    with self.assertRaises(RuntimeError):
+      self._build(['a', 'c'], fail = True)
+    self.assertEqual(self._built(), good)
+    self._build(['a', 'c'])
+    self.assertEqual(self._built(), {'site/dir/a': 'a2', 'site/dir/c': 'c1'})
+
+class LaterTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.build_py = join(self.dir, 'build.py')
+    with open(self.build_py, 'w') as fh: fh.write('# build system\n')
+    os.utime(self.build_py, ns=(10**18, 10**18))
+    self.source = join(self.dir, 'a.txt')
+    self.write_source('a', 1)
+    self.ran = []
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def write_source(self, contents, n):
+    with open(self.source, 'w') as fh: fh.write(contents)
+    os.utime(self.source, ns=(10**18 + n * 10**9, 10**18 + n * 10**9))
+
+  def append(self, suffix, delay = 0):
+    def body(sources, dests):
+      time.sleep(delay)
+      with open(sources[0]) as fin, open(dests[0], 'w') as fout:
+        fout.write(fin.read() + suffix)
+      self.ran.append(dests[0])
+    return body
+
+  def _build(self, rules):
+    for building_dir, do in buildsystem.run_basic(join(self.dir, 'builds'), [self.build_py],
+                                                  jobs = 4):
+      with utils.pushd(building_dir):
+        rules(do)
+        do.wait()
+
+  def _chain(self, do):
+    # Declared in order, each reading the previous one's dest, with the
+    # first one slow so that the others would overtake it if they could.
+    do.later([self.source], ['b'], self.append('b', delay = 0.2))
+    do.later(['b'], ['c'], self.append('c'))
+    do.later(['c', 'b'], ['d'], self.append('d'))
+
+  def _mtimes(self):
+    return {name: os.stat(join(self.dir, 'builds', 'build', name)).st_mtime_ns
+            for name in ['b', 'c', 'd']}
+
+  def test_chain_waits_for_its_sources(self):
+    self._build(self._chain)
+    with open(join(self.dir, 'builds', 'build', 'd')) as fh:
+      self.assertEqual(fh.read(), 'abcd')
+    self.assertEqual(self.ran, ['b', 'c', 'd'])
+    # Dests get their latest source's mtime, through the whole chain.
+    self.assertEqual(self._mtimes(), dict.fromkeys(['b', 'c', 'd'], 10**18 + 10**9))
+    self.ran = []
+    self._build(self._chain)
+    self.assertEqual(self.ran, [])
+    self.write_source('A', 2)
+    self._build(self._chain)
+    self.assertEqual(self.ran, ['b', 'c', 'd'])
+    self.assertEqual(self._mtimes(), dict.fromkeys(['b', 'c', 'd'], 10**18 + 2 * 10**9))
+
+  def test_independent_rules_run_in_parallel(self):
+    both = threading.Barrier(2, timeout = 10)
+    def body(sources, dests):
+      both.wait()
+      self.append('')(sources, dests)
+    def rules(do):
+      do.later([self.source], ['b'], body)
+      do.later([self.source], ['c'], body)
+    self._build(rules)
+    self.assertEqual(sorted(self.ran), ['b', 'c'])
+
+  def test_failure_skips_dependents(self):
+    def fail(sources, dests):
+      raise RuntimeError('rule failed')
+    def rules(do):
+      do.later([self.source], ['b'], fail)
+      do.later(['b'], ['c'], self.append('c'))
+    with self.assertRaises(RuntimeError):
+      self._build(rules)
+    self.assertEqual(self.ran, [])
+
+if __name__ == '__main__':
+  unittest.main()
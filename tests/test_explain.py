@@ -0,0 +1,67 @@
+import os, tempfile, unittest
+from os.path import join, exists
+
+from idupree_websitepy import buildsystem, explain, utils
+
+class ExplainTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.builds_dir = join(self.dir, 'builds')
+    self.build_py = join(self.dir, 'build.py')
+    with open(self.build_py, 'w') as fh: fh.write('# build system\n')
+    os.utime(self.build_py, ns=(10**18, 10**18))
+    self.sources = {}
+    for name in ['a', 'b']:
+      self.write_source(name, name + '1')
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def write_source(self, name, contents):
+    path = self.sources[name] = join(self.dir, name + '.txt')
+    with open(path, 'w') as fh: fh.write(contents)
+    mtime = 10**18 + len(contents) * 10**9 + sum(map(ord, contents))
+    os.utime(path, ns=(mtime, mtime))
+
+  def _build(self, fingerprints = {}, rule_log = True):
+    for building_dir, do in buildsystem.run_basic(self.builds_dir, [self.build_py],
+                                                  rule_log = rule_log):
+      with utils.pushd(building_dir):
+        for name in sorted(self.sources):
+          for [src], [dest] in do([self.sources[name]], [name],
+                                  fingerprint = fingerprints.get(name, 'v1')):
+            with open(src) as fin, open(dest, 'w') as fout: fout.write(fin.read())
+
+  def test_rule_log_is_opt_in(self):
+    self._build(rule_log = False)
+    self.assertFalse(exists(join(self.builds_dir, 'rule-log')))
+    self.assertEqual(explain.explain(self.builds_dir), None)
+    self._build()
+    self.assertEqual(explain.explain(self.builds_dir), [])
+    # An old log would be out of date.
+    self._build(rule_log = False)
+    self.assertEqual(explain.explain(self.builds_dir), None)
+
+  def test_changed_source(self):
+    self._build()
+    self.write_source('b', 'b22')
+    [(dests, reasons)] = explain.explain(self.builds_dir)
+    self.assertEqual(dests, ['b'])
+    self.assertEqual(len(reasons), 1)
+    self.assertTrue(reasons[0].startswith('source changed: '), reasons)
+
+  def test_fingerprint_changed(self):
+    self._build()
+    self.assertEqual(explain.fingerprint_changes(self.builds_dir), [])
+    self._build({'a': 'v2'})
+    self.assertEqual(explain.fingerprint_changes(self.builds_dir), [(['a'], 'v2')])
+    self.assertEqual(explain.explain(self.builds_dir), [])
+    self.assertIn('fingerprint changed',
+      explain.format_explanation(explain.explain(self.builds_dir),
+                                 explain.fingerprint_changes(self.builds_dir)))
+    self._build({'a': 'v2'})
+    self.assertEqual(explain.fingerprint_changes(self.builds_dir), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+import os, tempfile, unittest
+from os.path import join
+
+from idupree_websitepy import buildsystem, fingerprints, utils
+from idupree_websitepy.fingerprints import Fingerprints
+
+class FingerprintsTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.path = join(self._tmp.name, 'fingerprints')
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def test_virtual_mtime(self):
+    fps = Fingerprints(self.path)
+    # Never recorded: the dests are checked against their sources only.
+    self.assertEqual(fps.mtime(['a'], 'f1'), 0)
+    self.assertFalse(fps.changed(['a'], 'f1'))
+    fps.record(['a'], 'f1', 0, 5 * 10**9 + 123)
+    fps.record(['b', 'c'], 'f1', 7, 8)
+    fps.save()
+    fps = Fingerprints(self.path)
+    self.assertEqual(fps.mtime(['a'], 'f1'), 0)
+    self.assertFalse(fps.changed(['a'], 'f1'))
+    # The next whole second after the dests' mtime: newer than the
+    # dests, but not than sources restored with older mtimes.
+    self.assertEqual(fps.mtime(['a'], 'f2'), 6 * 10**9)
+    self.assertTrue(fps.changed(['a'], 'f2'))
+    self.assertEqual(fps.mtime(['b', 'c'], 'f1'), 7)
+    self.assertEqual(fps.mtime(['b'], 'f1'), 0)
+    # Rules not recorded by a run are forgotten.
+    fps.record(['a'], 'f2', 6 * 10**9, 6 * 10**9)
+    fps.save()
+    fps = Fingerprints(self.path)
+    self.assertEqual(fps.mtime(['a'], 'f2'), 6 * 10**9)
+    self.assertEqual(fps.mtime(['b', 'c'], 'f3'), 0)
+
+  def test_fingerprint(self):
+    def f(): return 1
+    g = f
+    def f(): return 2
+    self.assertEqual(fingerprints.fingerprint(f, 'x'), fingerprints.fingerprint(f, 'x'))
+    self.assertNotEqual(fingerprints.fingerprint(f, 'x'), fingerprints.fingerprint(g, 'x'))
+    self.assertNotEqual(fingerprints.fingerprint(f, 'x'), fingerprints.fingerprint(f, b'y'))
+    self.assertNotEqual(fingerprints.fingerprint('ab', 'c'), fingerprints.fingerprint('a', 'bc'))
+    with self.assertRaises(TypeError):
+      fingerprints.fingerprint(3)
+
+class FingerprintRulesTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.build_py = join(self.dir, 'build.py')
+    self.code_py = join(self.dir, 'code.py')
+    self.source = join(self.dir, 'a.txt')
+    for path in [self.build_py, self.code_py, self.source]:
+      with open(path, 'w') as fh: fh.write(path + '\n')
+      os.utime(path, ns=(10**18, 10**18))
+    self.ran = []
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def _build(self, fingerprint):
+    for building_dir, do in buildsystem.run_basic(join(self.dir, 'builds'), [self.build_py],
+                                                  code_sources = [self.code_py]):
+      with utils.pushd(building_dir):
+        for [src], [dest] in do([self.source], ['b'], fingerprint = fingerprint):
+          self.ran.append(dest)
+          with open(src) as fin, open(dest, 'w') as fout: fout.write(fin.read())
+        for [src], [dest] in do(['b'], ['c']):
+          self.ran.append(dest)
+          with open(src) as fin, open(dest, 'w') as fout: fout.write(fin.read())
+
+  def _mtime(self, name):
+    return os.stat(join(self.dir, 'builds', 'build', name)).st_mtime_ns
+
+  def test_rebuilds_when_fingerprint_changes(self):
+    self._build('f1')
+    self.assertEqual(self.ran, ['b', 'c'])
+    self.assertEqual(self._mtime('b'), 10**18)
+    # Code that the fingerprinted rule doesn't depend on.
+    os.utime(self.code_py, ns=(10**18 + 10, 10**18 + 10))
+    self.ran = []
+    self._build('f1')
+    self.assertEqual(self.ran, ['c'])
+    self.ran = []
+    self._build('f2')
+    self.assertEqual(self.ran, ['b', 'c'])
+    self.assertEqual(self._mtime('b'), 10**18 + 10**9)
+    self.assertEqual(self._mtime('c'), 10**18 + 10**9)
+    self.ran = []
+    self._build('f2')
+    self.assertEqual(self.ran, [])
+    self._build('f1')
+    self.assertEqual(self.ran, ['b', 'c'])
+    self.assertEqual(self._mtime('b'), 10**18 + 2 * 10**9)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,24 @@
+import io, sys, tempfile, unittest
+from contextlib import redirect_stderr
+from os.path import join
+
+from idupree_websitepy import impact
+
+class MissingRecordsTest(unittest.TestCase):
+  def test_names_the_expected_path(self):
+    with tempfile.TemporaryDirectory() as builds_dir:
+      with self.assertRaises(FileNotFoundError):
+        impact.referencer_index(builds_dir)
+      stderr = io.StringIO()
+      old_argv = sys.argv
+      sys.argv = ['impact', builds_dir, 'style.css']
+      try:
+        with redirect_stderr(stderr), self.assertRaises(SystemExit) as exit:
+          impact.main()
+      finally:
+        sys.argv = old_argv
+      self.assertNotEqual(exit.exception.code, 0)
+      self.assertIn(join(builds_dir, 'build', 'rr', 'index.sqlite'), stderr.getvalue())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+import os, tempfile, unittest
+from os.path import join, exists
+
+from idupree_websitepy import output_cache
+from idupree_websitepy.output_cache import LocalDirectoryCache
+
+class RuleKeyTest(unittest.TestCase):
+  def test_key_covers_everything(self):
+    key = output_cache.rule_key('f', ['d'], [('s', 'aa')], ['bb'])
+    self.assertEqual(key, output_cache.rule_key('f', ['d'], [('s', 'aa')], ['bb']))
+    for other in [output_cache.rule_key(None, ['d'], [('s', 'aa')], ['bb']),
+                  output_cache.rule_key('f', ['e'], [('s', 'aa')], ['bb']),
+                  output_cache.rule_key('f', ['d'], [('t', 'aa')], ['bb']),
+                  output_cache.rule_key('f', ['d'], [('s', 'ab')], ['bb']),
+                  output_cache.rule_key('f', ['d'], [('s', None)], ['bb']),
+                  output_cache.rule_key('f', ['d'], [('s', 'aa')], ['bc'])]:
+      self.assertNotEqual(key, other)
+
+class LocalDirectoryCacheTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.cache_dir = join(self.dir, 'cache')
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def write(self, name, contents):
+    path = join(self.dir, name)
+    with open(path, 'w') as fh: fh.write(contents)
+    return path
+
+  def read(self, name):
+    with open(join(self.dir, name)) as fh: return fh.read()
+
+  def test_get_and_put(self):
+    cache = LocalDirectoryCache(self.cache_dir)
+    dests = [join(self.dir, 'a'), join(self.dir, 'b')]
+    self.assertFalse(cache.get('ab' * 20, dests))
+    self.assertFalse(any(map(exists, dests)))
+    self.write('a', 'A')
+    self.write('b', 'B')
+    cache.put('ab' * 20, dests)
+    cache.put('ab' * 20, dests)
+    for dest in dests: os.unlink(dest)
+    self.assertTrue(cache.get('ab' * 20, dests))
+    self.assertEqual((self.read('a'), self.read('b')), ('A', 'B'))
+    # Entries don't share inodes with the build's files.
+    self.write('a', 'changed')
+    self.assertTrue(LocalDirectoryCache(self.cache_dir).get('ab' * 20, dests))
+    self.assertEqual(self.read('a'), 'A')
+    self.assertEqual(cache.metrics(), {'output_cache_hits': 1, 'output_cache_misses': 1,
+                                       'output_cache_stores': 1, 'output_cache_evictions': 0})
+
+  def test_trim_evicts_least_recently_used(self):
+    cache = LocalDirectoryCache(self.cache_dir, max_bytes = 2500)
+    keys = ['{:02x}'.format(i) * 20 for i in range(4)]
+    dest = join(self.dir, 'd')
+    for i, key in enumerate(keys):
+      self.write('d', str(i) * 1000)
+      cache.put(key, [dest])
+      os.utime(cache._entry(key), ns=(10**18 + i, 10**18 + i))
+    # Using an entry makes it the most recently used.
+    self.assertTrue(cache.get(keys[0], [dest]))
+    cache.trim()
+    self.assertEqual([cache.get(key, [dest]) for key in keys], [True, False, False, True])
+    self.assertEqual(cache.metrics()['output_cache_evictions'], 2)
+    self.assertEqual([name for name in os.listdir(self.cache_dir) if name.startswith('.')], [])
+
+  def test_trim_unlimited(self):
+    cache = LocalDirectoryCache(self.cache_dir)
+    self.write('d', 'x' * 1000)
+    cache.put('cd' * 20, [join(self.dir, 'd')])
+    cache.trim()
+    self.assertTrue(cache.get('cd' * 20, [join(self.dir, 'd')]))
+
+if __name__ == '__main__':
+  unittest.main()
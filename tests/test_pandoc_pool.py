@@ -0,0 +1,111 @@
+import os, re, shutil, subprocess, sys, tempfile, unittest
+from os.path import join
+
+from idupree_websitepy import pandoc_pool
+
+# Stands in for pandoc: the command line and 'pandoc lua' workers render
+# a document as its own text, except that workers add an x to documents
+# with math in them.  Each run is logged.
+fake_pandoc = r'''#!{python}
+import sys, json
+log = open({log!r}, 'a')
+def render(src, dest, worker):
+  data = open(src, 'rb').read()
+  if worker and b'$' in data: data += b'x'
+  return b'<html>' + data + b'[' + dest.encode() + b']</html>\n'
+args = sys.argv[1:]
+if args[0] == 'lua':
+  log.write('worker\n'); log.flush()
+  for line in sys.stdin:
+    request = json.loads(line)
+    html = render(request['src'], request['dest'], True)
+    sys.stdout.write(json.dumps({{'html': html.decode()}}) + '\n')
+    sys.stdout.flush()
+else:
+  log.write('cli\n'); log.flush()
+  dest = args[args.index('-V') + 1][len('outputfile='):]
+  sys.stdout.buffer.write(render(args[-1], dest, False))
+'''
+
+class FakePandocPoolTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.log = join(self.dir, 'log')
+    self.pandoc = join(self.dir, 'pandoc')
+    with open(self.pandoc, 'w') as f:
+      f.write(fake_pandoc.format(python = sys.executable, log = self.log))
+    os.chmod(self.pandoc, 0o755)
+    self.pool = pandoc_pool.PandocPool(self.pandoc, workers = 2, check_documents = 2)
+    self.count = 0
+
+  def tearDown(self):
+    self.pool.close()
+    self._tmp.cleanup()
+
+  def render(self, text):
+    """Renders text with the pool; returns how many command line runs that took."""
+    self.count += 1
+    src = join(self.dir, '{}.md'.format(self.count))
+    dest = join(self.dir, '{}.html'.format(self.count))
+    with open(src, 'w') as f: f.write(text)
+    before = self._cli_runs()
+    html = self.pool.render(src, dest)
+    self.assertEqual(html, b'<html>' + text.encode() + b'[' + dest.encode() + b']</html>\n')
+    return self._cli_runs() - before
+
+  def _cli_runs(self):
+    try:
+      with open(self.log) as f: return f.read().split().count('cli')
+    except FileNotFoundError:
+      return 0
+
+  def test_checks_each_feature(self):
+    self.assertEqual([self.render('plain\n') for _ in range(4)], [1, 1, 0, 0])
+    self.assertEqual([self.render('```\ncode\n```\n') for _ in range(3)], [1, 1, 0])
+    self.assertEqual(self.render('a <b>raw</b> tag\n'), 1)
+    self.assertEqual(self.render('plain again\n'), 0)
+
+  def test_falls_back_when_a_feature_differs(self):
+    self.assertEqual([self.render('plain\n') for _ in range(3)], [1, 1, 0])
+    sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+    try:
+      self.assertEqual(self.render('math: $x$\n'), 1)
+    finally:
+      sys.stderr.close()
+      sys.stderr = stderr
+    self.assertEqual(self.render('plain\n'), 1)
+
+def _pandoc_version():
+  if shutil.which('pandoc') == None:
+    return None
+  output = subprocess.check_output(['pandoc', '--version']).decode('utf-8')
+  return tuple(int(n) for n in re.match(r'pandoc\S* ([\d.]+)', output).group(1).split('.'))
+
+@unittest.skipUnless((_pandoc_version() or ()) >= (3, 1, 1), 'needs pandoc 3.1.1 or later')
+class PandocWorkerTest(unittest.TestCase):
+  documents = {
+    'math': 'Inline $e^{i\\pi} + 1 = 0$ and display:\n\n$$\\int_0^1 x\\,dx$$\n',
+    'code': '```python\ndef f(x):\n\treturn x  # tab\n```\n\nand `inline`{.haskell}\n',
+    'citations': ('---\ntitle: Cited\nreferences:\n- id: doe\n  author: [{family: Doe}]\n'
+                  '  title: A Book\n---\n\nAs [@doe, p. 3] says, @doe.\n'),
+    'raw html': '<div class="x">\n*emph*\n</div>\n\nA <span>span</span> &amp; &eacute;.\n',
+    'mixed': ('% A Title\n\r\n| a | b |\n|---|---|\n| 1 | 2 |\n\nNote[^n].\n\n'
+              '[^n]: The note.\n\n::: warning\nfenced div\n:::\n\n\\LaTeX\n'),
+    }
+
+  def test_worker_matches_command_line(self):
+    with tempfile.TemporaryDirectory() as d:
+      pool = pandoc_pool.PandocPool('pandoc', check_documents = 0)
+      try:
+        for name, text in self.documents.items():
+          src, dest = join(d, 'doc.md'), join(d, 'doc.html')
+          with open(src, 'w', newline = '') as f: f.write(text)
+          with self.subTest(name):
+            self.assertEqual(pool.render(src, dest),
+                             subprocess.check_output(pandoc_pool.command_line('pandoc', src, dest)))
+      finally:
+        pool.close()
+
+if __name__ == '__main__':
+  unittest.main()
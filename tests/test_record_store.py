@@ -0,0 +1,73 @@
+import tempfile, unittest
+from os.path import join
+
+from idupree_websitepy import record_store
+from idupree_websitepy.record_store import RecordStore
+
+class RecordStoreTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+    self.path = join(self.dir, 'index.sqlite')
+    self.mtimes = {'a': 10, 'b': 20, 'c': 30}
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def store(self, config = 'v1'):
+    return RecordStore(self.path, [join(self.dir, 'missing.sqlite'), self.path],
+                       config, self.mtimes.__getitem__)
+
+  def test_stamps(self):
+    store = self.store()
+    self.assertEqual(store.stamp(['a', 'b'])[0], 20)
+    self.assertEqual(store.stamp()[0], 0)
+    # The inputs' names count, not just their mtimes.
+    self.assertNotEqual(store.stamp(['a', 'b']), store.stamp(['b', 'a']))
+    self.assertNotEqual(store.stamp(['b']), store.stamp(['a', 'b']))
+    store.put('x', 'a', store.stamp(['a']), b'1')
+    store.put('x', 'c', store.stamp(['c']), b'3')
+    # A record's stamp carries over to the records computed from it.
+    stamp = store.stamp(['b'], [('x', 'a'), ('x', 'c')])
+    self.assertEqual(stamp[0], 30)
+    self.assertNotEqual(stamp, store.stamp(['b'], [('x', 'a')]))
+    self.assertNotEqual(store.stamp(records = [('x', 'a')]), store.stamp(['a']))
+
+  def test_reuses_fresh_records(self):
+    store = self.store()
+    self.assertEqual(store.lookup('x', 'a', store.stamp(['a'])), None)
+    store.put('x', 'a', store.stamp(['a']), b'A')
+    store.put('x', 'b', store.stamp(['b']), b'B')
+    store.put('y', 'ab', store.stamp(records = [('x', 'a'), ('x', 'b')]), b'AB')
+    self.assertEqual(store.lookup('x', 'a', store.stamp(['a'])), b'A')
+    store.save()
+    self.assertEqual(record_store.read_records(self.path, 'x'), {'a': b'A', 'b': b'B'})
+
+    self.mtimes['b'] = 21
+    store = self.store()
+    self.assertEqual(store.lookup('x', 'a', store.stamp(['a'])), b'A')
+    # (Once it's in this store, it's this run's record.)
+    self.assertEqual(store.lookup('x', 'a', store.stamp(['a', 'c'])), b'A')
+    self.assertEqual(store.lookup('x', 'b', store.stamp(['b'])), None)
+    self.assertEqual(store.stale('x', 'b'), b'B')
+    store.put('x', 'b', store.stamp(['b']), b'B2')
+    self.assertEqual(store.lookup('y', 'ab', store.stamp(records = [('x', 'a'), ('x', 'b')])),
+                     None)
+    self.assertEqual((store.reused, store.computed), (1, 1))
+    store.save()
+
+    store = self.store()
+    self.assertEqual(store.lookup('x', 'b', store.stamp(['b'])), b'B2')
+    # Records not carried over by the last run are gone.
+    self.assertEqual(store.stale('y', 'ab'), None)
+
+  def test_config_change_discards_previous(self):
+    store = self.store()
+    store.put('x', 'a', store.stamp(['a']), b'A')
+    store.save()
+    store = self.store('v2')
+    self.assertEqual(store.lookup('x', 'a', store.stamp(['a'])), None)
+    self.assertEqual(store.stale('x', 'a'), None)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+import os, random, tempfile, unittest
+from os.path import join, dirname, relpath
+
+from idupree_websitepy.resource_rewriting import ResourceRewriter
+
+class UpdateTest(unittest.TestCase):
+  """update() after random edits gives the same records as a fresh ResourceRewriter."""
+
+  dirs = ['img', 'img/sub', 'img/sub/deeper', 'misc']
+  pages = ['a.html', 'b.css', 'd.js', 'img/p.html']
+
+  def write(self, f, data):
+    path = join(self.src, f)
+    with open(path, 'w') as fh: fh.write(data)
+    # (Every edit gets a new mtime, however fast they come.)
+    self.mtime += 10**9
+    os.utime(path, ns = (self.mtime, self.mtime))
+
+  def resources(self):
+    return sorted(relpath(join(d, f), self.src) for d, _, fs in os.walk(self.src) for f in fs
+                  if relpath(join(d, f), self.src) not in self.pages)
+
+  def refs(self):
+    return {ref for refs in self.pages_content.values() for ref in refs}
+
+  def write_page(self, rng, page):
+    targets = self.resources() + self.dirs + self.pages
+    refs = rng.sample(targets, rng.randint(0, 4))
+    self.pages_content[page] = refs
+    self.write(page, ''.join(
+      '"{}{}?rr"\n'.format(relpath(ref, dirname(page) or '.'), '/' if ref in self.dirs else '')
+      for ref in refs))
+
+  def make(self):
+    return ResourceRewriter(rewritable_files = self.rewritable, site_source_prefix = self.src,
+                            rr_cache_dir = join(self.src, '.cache'))
+
+  def state(self, r):
+    nodes = sorted(r.recall_all_files_and_dirs_that_can_have_deps(list(self.rewritable)))
+    return (nodes,
+            {f: (r.recall_direct_deps(f), sorted(r.recall_transitive_deps(f)), r.recall_hash(f),
+                 r.recall_transitive_hash(f), r.recall_rewritten_resource_name(f))
+             for f in nodes},
+            sorted(r.recall_all_needed_resources(list(self.rewritable), True)))
+
+  def edit(self, rng):
+    """Makes a random edit, returning the changed files."""
+    kind = rng.choice(['resource', 'resource', 'new', 'remove', 'page', 'page', 'rewritable'])
+    resources = self.resources()
+    if kind == 'resource' and resources:
+      f = rng.choice(resources)
+      self.write(f, str(rng.random()))
+      return [f]
+    if kind == 'new':
+      f = join(rng.choice(self.dirs), 'n{}.png'.format(rng.randint(0, 9)))
+      self.write(f, str(rng.random()))
+      return [f]
+    removable = [f for f in resources if f not in self.refs()]
+    if kind == 'remove' and removable:
+      f = rng.choice(removable)
+      os.unlink(join(self.src, f))
+      return [f]
+    if kind == 'rewritable':
+      page = rng.choice(self.pages)
+      self.rewritable ^= {page}
+      return []
+    page = rng.choice(self.pages)
+    self.write_page(rng, page)
+    return [page]
+
+  def check_seed(self, seed):
+    rng = random.Random(seed)
+    self.mtime = 10**18
+    for d in self.dirs:
+      os.makedirs(join(self.src, d))
+      for i in range(rng.randint(0, 3)):
+        self.write(join(d, 'f{}.png'.format(i)), str(rng.random()))
+    self.pages_content = {}
+    for page in self.pages:
+      self.write_page(rng, page)
+    self.rewritable = set(self.pages[:3])
+    r = self.make()
+    for step in range(25):
+      rewritable = set(self.rewritable)
+      changed = self.edit(rng)
+      r.update(changed, self.rewritable if self.rewritable != rewritable else None)
+      self.assertEqual(self.state(r), self.state(self.make()),
+                       'seed {} step {}: {}'.format(seed, step, changed))
+
+  def test_update_matches_fresh(self):
+    for seed in range(12):
+      with self.subTest(seed = seed), tempfile.TemporaryDirectory() as self.src:
+        self.check_seed(seed)
+
+class TransitiveHashTest(unittest.TestCase):
+  """Hashes including deps change exactly for the edited file and what depends on it."""
+
+  files = {
+    'a.html': '"b.css?rr" "x.png?rr"',
+    'b.css': 'url("c.png?rr")',
+    'c.png': 'c',
+    'x.png': 'x',
+    # A dependency cycle, with a dep outside it.
+    'p.html': '"q.html?rr"',
+    'q.html': '"p.html?rr" "x.png?rr"',
+    }
+
+  def write(self, f, data):
+    with open(join(self.src, f), 'w') as fh: fh.write(data)
+    self.mtime += 10**9
+    os.utime(join(self.src, f), ns = (self.mtime, self.mtime))
+
+  def hashes(self):
+    r = ResourceRewriter(rewritable_files = ['a.html', 'b.css', 'p.html', 'q.html'],
+                         site_source_prefix = self.src, rr_cache_dir = join(self.src, '.cache'))
+    return {f: r.recall_transitive_hash(f) for f in self.files}
+
+  def changed(self, f, data):
+    before = self.hashes()
+    self.write(f, data)
+    after = self.hashes()
+    return sorted(f for f in self.files if before[f] != after[f])
+
+  def test_edits(self):
+    with tempfile.TemporaryDirectory() as self.src:
+      self.mtime = 10**18
+      for f, data in self.files.items():
+        self.write(f, data)
+      hashes = self.hashes()
+      self.assertEqual(hashes['p.html'], hashes['q.html'])
+      self.assertEqual(len(set(hashes.values())), len(self.files) - 1)
+      self.assertEqual(self.changed('c.png', 'c2'), ['a.html', 'b.css', 'c.png'])
+      self.assertEqual(self.changed('a.html', '"b.css?rr"'), ['a.html'])
+      self.assertEqual(self.changed('p.html', '"q.html?rr" '), ['p.html', 'q.html'])
+      self.assertEqual(self.changed('x.png', 'x2'), ['p.html', 'q.html', 'x.png'])
+
+if __name__ == '__main__':
+  unittest.main()
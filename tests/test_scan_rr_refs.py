@@ -0,0 +1,45 @@
+import random, re, unittest
+
+from idupree_websitepy.resource_rewriting import default_rr_ref_re, scan_rr_refs
+
+def regex_matches(data):
+  return [(m.start(), m.end(), m.group('ref')) for m in re.finditer(default_rr_ref_re, data)]
+
+def chunked(data, sizes):
+  chunks = []
+  i = 0
+  for size in sizes:
+    chunks.append(data[i:i+size])
+    i += size
+  return chunks + [data[i:]]
+
+class ScanRrRefsTest(unittest.TestCase):
+  """scan_rr_refs finds what re.finditer(default_rr_ref_re) does, however the data is chunked."""
+
+  examples = [
+    b'', b'?rr', b'a?rr', b'"a?rr"', b'a?rrb', b'a?rr?rr', b'??rr', b'a??rr x',
+    b'<img src="img/a.png?rr"> <a href=\'/b.html?rr#top\'>',
+    b'url(c.css?rr) url( d.css?rr ) e.js?rr\n\tf?rr\x7f?rr',
+    b'x' * 5000 + b'?rr ' + b'y' * 70000 + b'?rr',
+    'café.png?rr ☃?rr'.encode('utf-8'),
+    ]
+
+  def check(self, data, chunks):
+    self.assertEqual(list(scan_rr_refs(chunks)), regex_matches(data), (data[:100], len(chunks)))
+
+  def test_examples(self):
+    for data in self.examples:
+      self.check(data, [data])
+      for size in [1, 2, 3, 4, 7] if len(data) < 100 else [1000, 4096]:
+        self.check(data, chunked(data, [size] * (len(data) // size)))
+
+  def test_random(self):
+    rng = random.Random(1)
+    alphabet = [b'a', b'/', b'.', b'?', b'r', b'rr', b'?rr', b' ', b'"', b'<', b'\n', b'\xc3\xa9', b'#']
+    for _ in range(500):
+      data = b''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+      sizes = [rng.randint(0, 8) for _ in range(rng.randint(0, 10))]
+      self.check(data, chunked(data, sizes))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+import os, tempfile, unittest
+from os.path import join, dirname
+
+from idupree_websitepy import scss_deps
+
+class ScssDepsTest(unittest.TestCase):
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def write(self, f, text = ''):
+    path = join(self.dir, f)
+    os.makedirs(dirname(path), exist_ok = True)
+    with open(path, 'w') as fh: fh.write(text)
+    return path
+
+  def test_imported_names(self):
+    path = self.write('main.scss', '''
+      @use "sass:math";
+      @use 'config' as c;
+      @forward "theme" show color;
+      @import "a", 'b', url(plain), "plain.css", "http://x/y", "print" print;
+      a { background: url(//cdn/x.png); content: "// @import 'not1'"; }
+      // @import "not2";
+      /* @import "not3"; */
+      .x { @include meta.load-css("loaded"); }
+      ''')
+    self.assertEqual(scss_deps.imported_names(path), ['config', 'theme', 'a', 'b', 'loaded'])
+    path = self.write('main.sass', '@import a, b\n@use "c"\n.x\n  color: red\n')
+    self.assertEqual(scss_deps.imported_names(path), ['a', 'b', 'c'])
+
+  def test_resolve(self):
+    importer = self.write('css/main.scss')
+    partial = self.write('css/_partial.scss')
+    index = self.write('css/dir/_index.sass')
+    in_lib = self.write('lib/shared.scss')
+    shadowed = self.write('lib/partial.scss')
+    plain = self.write('lib/sub/plain.css')
+    lib = join(self.dir, 'lib')
+    self.assertEqual(scss_deps.resolve('partial', importer, [lib]), [partial])
+    self.assertEqual(scss_deps.resolve('_partial.scss', importer, [lib]), [partial])
+    self.assertEqual(scss_deps.resolve('dir', importer, [lib]), [index])
+    self.assertEqual(scss_deps.resolve('shared', importer, [lib]), [in_lib])
+    self.assertEqual(scss_deps.resolve('sub/plain', importer, [lib]), [plain])
+    self.assertEqual(scss_deps.resolve('missing', importer, [lib]), [])
+    # (Ambiguous to Sass; either one counts.)
+    both = self.write('css/partial.scss')
+    self.assertEqual(scss_deps.resolve('partial', importer, [lib]), [both, partial])
+    self.assertNotIn(shadowed, scss_deps.resolve('partial', importer, [lib]))
+
+  def test_sass_imports(self):
+    main = self.write('main.scss', '@use "a"; @import "missing", "c";')
+    a = self.write('_a.scss', '@forward "lib/b";')
+    b = self.write('lib/b.scss', '@import "../main", "plain";')
+    plain = self.write('lib/plain.css', '@import "not-sass";')
+    c = self.write('c.sass', '@use "a"\n')
+    self.assertEqual(scss_deps.sass_imports(main), (sorted([a, b, plain, c]), ['missing']))
+
+if __name__ == '__main__':
+  unittest.main()